@@ -1,42 +1,135 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.db import models
+import threading
+
+from django.db import models, connections
 from django import forms
 from django.contrib import admin
-from .models import LedgerEntry, Peer, ValidatedTransaction, EpochSummary
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
+from .models import (
+    LedgerEntry, Peer, ValidatedTransaction, ValidatedMovement, EpochSummary,
+    PeerPerformance
+)
+
+EXACT_COUNT_BELOW = 10000
+
+def estimated_count(queryset):
+    """
+    Row count of the queryset's table from the database's own statistics,
+    instead of a COUNT(*) over millions of rows. None when the backend keeps
+    no such figure.
+    """
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s", [table])
+        elif connection.vendor == 'mysql':
+            cursor.execute(
+                "SELECT table_rows FROM information_schema.tables "
+                "WHERE table_schema = DATABASE() AND table_name = %s", [table]
+            )
+        elif connection.vendor == 'sqlite':
+            cursor.execute("SELECT MAX(rowid) FROM %s" % connection.ops.quote_name(table))
+        else:
+            return None
+        row = cursor.fetchone()
+    if not row or row[0] is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Unfiltered changelists of big tables get their count from table
+    statistics. Searches and filters still count exactly.
+    """
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if isinstance(queryset, models.QuerySet) and not queryset.query.where:
+            estimate = estimated_count(queryset)
+            if estimate is not None and estimate >= EXACT_COUNT_BELOW:
+                return estimate
+        return super(EstimatedCountPaginator, self).count
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
-class PeerAdmin(admin.ModelAdmin):
+# Peer.ranking() for the changelist being rendered, so each row doesn't
+# fetch it from the cache again
+_ranking = threading.local()
+
+def ranking_by_domain():
+    by_domain = getattr(_ranking, 'by_domain', None)
+    if by_domain is None:
+        by_domain = {x['domain']: x for x in Peer.ranking()}
+    return by_domain
+
+class RankingAdmin(admin.ModelAdmin):
+    def changelist_view(self, request, extra_context=None):
+        _ranking.by_domain = {x['domain']: x for x in Peer.ranking()}
+        response = super(RankingAdmin, self).changelist_view(request, extra_context)
+        if hasattr(response, 'add_post_render_callback'):
+            # rows are rendered after this returns
+            response.add_post_render_callback(self.forget_ranking)
+        else:
+            self.forget_ranking()
+        return response
+
+    def forget_ranking(self, response=None):
+        _ranking.by_domain = None
+
+class PeerAdmin(RankingAdmin):
     list_display = (
         'domain', 'reputation', 'payout_address', 'first_registered',
-        'rank', 'disp_rep_percent', 'disp_rep_percentile'
+        'disp_rank', 'disp_rep_percent', 'disp_rep_percentile'
     )
     ordering = ('-reputation', 'first_registered')
     formfield_overrides = {
         models.TextField: {'widget': forms.TextInput(attrs={'size': 40})},
     }
 
+    # a peer registered since the ranking was computed isn't in it yet
+    def disp_rank(self, obj):
+        ranking = ranking_by_domain().get(obj.domain)
+        return ranking['rank'] if ranking else '-'
+    disp_rank.short_description = "Rank"
+
     def disp_rep_percentile(self, obj):
-        return "%.2f%%" % obj.rep_percentile()
+        ranking = ranking_by_domain().get(obj.domain)
+        return "%.2f%%" % ranking['percentile'] if ranking else '-'
 
     def disp_rep_percent(self, obj):
-        return "%.2f%%" % obj.rep_percent()
+        ranking = ranking_by_domain().get(obj.domain)
+        return "%.2f%%" % ranking['percent'] if ranking else '-'
 
-class LedgerAdmin(admin.ModelAdmin):
+class LedgerAdmin(LargeTableAdmin):
     list_display = ('address', 'amount', 'last_updated')
     ordering = ('last_updated', )
 
-class ValidatedTransactionAdmin(admin.ModelAdmin):
+class ValidatedTransactionAdmin(RankingAdmin, LargeTableAdmin):
     list_display = (
-        'txid', 'epoch', 'timestamp', 'rejected_reputation_percent',
+        'txid', 'epoch', 'timestamp', 'disp_rejected_reputation_percent',
         'column_movements'
     )
     readonly_fields = (
         'readonly_movements', 'epoch', 'timestamp', 'txid',
-        'rejected_reputation_percent', 'fee'
+        'disp_rejected_reputation_percent', 'fee'
     )
     ordering = ('-timestamp', )
 
+    def get_queryset(self, request):
+        return super(ValidatedTransactionAdmin, self).get_queryset(request).prefetch_related(
+            'validatedmovement_set', 'validatedrejection_set'
+        )
+
+    def disp_rejected_reputation_percent(self, obj):
+        return "%.2f%%" % obj.rejected_reputation_percent(ranking_by_domain())
+    disp_rejected_reputation_percent.short_description = "Rejected reputation percent"
+
     def column_movements(self, obj):
         movements = ""
         for mov in obj.validatedmovement_set.all():
@@ -52,17 +145,35 @@ class ValidatedTransactionAdmin(admin.ModelAdmin):
     readonly_movements.allow_tags = True
     readonly_movements.short_description = "Movements"
 
+class ValidatedMovementAdmin(LargeTableAdmin):
+    list_display = ('tx', 'address', 'disp_amount')
+    list_select_related = ('tx', )
+    raw_id_fields = ('tx', )
+    search_fields = ('=address', )
+
 class EpochSummaryAdmin(admin.ModelAdmin):
-    list_display = ('epoch', 'transaction_count', 'epoch_seed', 'speed')
+    list_display = ('epoch', 'transaction_count', 'fee_total', 'epoch_seed', 'speed')
     ordering = ('-epoch', )
-    readonly_fields = ('epoch', 'transaction_count', 'epoch_seed', 'speed')
+    readonly_fields = (
+        'epoch', 'transaction_count', 'fee_total', 'epoch_seed', 'speed',
+        'count_peak_memory', 'apply_peak_memory', 'seed_peak_memory',
+        'step1_lag', 'step1_duration', 'step2_duration'
+    )
 
     def speed(self, obj):
-        return "%.2f tx/sec" % (
-            obj.transaction_count / obj.apply_duration.total_seconds()
-        )
+        seconds = obj.apply_duration.total_seconds()
+        if not seconds:
+            return "-"
+        return "%.2f tx/sec" % (obj.transaction_count / seconds)
 
 admin.site.register(Peer, PeerAdmin)
 admin.site.register(LedgerEntry, LedgerAdmin)
 admin.site.register(ValidatedTransaction, ValidatedTransactionAdmin)
+admin.site.register(ValidatedMovement, ValidatedMovementAdmin)
 admin.site.register(EpochSummary, EpochSummaryAdmin)
+
+class PeerPerformanceAdmin(admin.ModelAdmin):
+    list_display = ('domain', 'latency', 'error_rate', 'throughput', 'calls', 'failures', 'open_until')
+    ordering = ('latency', )
+
+admin.site.register(PeerPerformance, PeerPerformanceAdmin)
@@ -0,0 +1,115 @@
+"""
+Separate concurrency budgets per class of request, so a flood of
+transactions or wallet traffic can't take every worker (and database
+connection) while the node needs them for consensus. Off unless
+ADMISSION_CONTROL is set.
+
+Each request is put in a class by it's path. Classes with a limit in
+REQUEST_CLASS_LIMITS get at most that many concurrent requests per process,
+anything over is turned away right away with a 503 and a Retry-After header
+rather than queued behind the others. Consensus pushes, penalties and
+rejections (which only peers send) are never limited, so with N worker
+threads at least N minus the other limits are always free for them. For
+CONSENSUS_WINDOW_SECONDS after each epoch starts, while the last epoch is
+closed and it's hashes are pushed and checked, ingestion is held to
+CONSENSUS_WINDOW_INGEST_LIMIT instead. Peers relaying a transaction that
+was turned away send it again after the Retry-After (see main.transport).
+
+The counts are per process, so this only does anything with threaded
+workers (gunicorn --threads, or the ingestserver command). A worker that
+handles one request at a time never has more than one in progress.
+"""
+import threading
+import datetime
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
+
+from staeon.consensus import get_epoch_number, get_epoch_range
+
+CONSENSUS = 'consensus'
+INGEST = 'ingest'
+READ = 'read'
+
+REQUEST_CLASSES = (
+    ('/staeon/consensus/', CONSENSUS),
+    ('/staeon/transaction/', INGEST),
+    ('/staeon/rejections/', None),
+    ('/staeon/', READ),
+    ('/wallet/', READ),
+)
+
+def request_class(path):
+    for prefix, name in REQUEST_CLASSES:
+        if path.startswith(prefix):
+            return name
+    return None
+
+def consensus_window_remaining(now=None):
+    """
+    Seconds left in the consensus window at the start of the current epoch,
+    0 outside of it.
+    """
+    now = now or datetime.datetime.now()
+    start, end = get_epoch_range(get_epoch_number(now))
+    elapsed = (now - start).total_seconds()
+    return max(settings.CONSENSUS_WINDOW_SECONDS - elapsed, 0)
+
+class Budget(object):
+    """
+    Counts the requests of one class in progress in this process.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.shed = 0
+
+    def acquire(self, limit):
+        with self.lock:
+            if limit is not None and self.active >= limit:
+                self.shed += 1
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+budgets = {CONSENSUS: Budget(), INGEST: Budget(), READ: Budget()}
+
+def current_limit(name):
+    limit = settings.REQUEST_CLASS_LIMITS.get(name)
+    if name == INGEST and consensus_window_remaining():
+        window_limit = settings.CONSENSUS_WINDOW_INGEST_LIMIT
+        limit = window_limit if limit is None else min(limit, window_limit)
+    return limit
+
+def too_busy(retry_after):
+    response = HttpResponse("Busy, try again later", status=503)
+    response['Retry-After'] = str(int(max(retry_after, 1)))
+    return response
+
+class AdmissionMiddleware(object):
+    def __init__(self, get_response):
+        if not settings.ADMISSION_CONTROL:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        name = request_class(request.path)
+        if name is None:
+            return self.get_response(request)
+
+        budget = budgets[name]
+        if not budget.acquire(current_limit(name)):
+            retry_after = 1
+            if name == INGEST:
+                # once the window is over there's room again
+                retry_after = consensus_window_remaining() or 1
+            return too_busy(retry_after)
+        try:
+            return self.get_response(request)
+        finally:
+            budget.release()
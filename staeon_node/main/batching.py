@@ -0,0 +1,84 @@
+"""
+Outbound rejections are collected for a short window and sent as one signed
+batch per destination peer, instead of one POST per rejection per peer.
+"""
+import json
+import atexit
+import datetime
+import threading
+from collections import OrderedDict
+
+from bitcoin import ecdsa_sign
+from django.conf import settings
+from django.db import connection
+
+from . import transport
+
+def rejection_batch_message(batch):
+    """
+    The text a rejection batch signature covers.
+    """
+    return json.dumps(
+        [batch['domain'], batch['timestamp'], batch['rejections']], sort_keys=True
+    )
+
+def make_rejection_batch(rejections, domain, private_key):
+    batch = {
+        'domain': domain,
+        'timestamp': datetime.datetime.now().isoformat(),
+        'rejections': rejections,
+    }
+    batch['signature'] = ecdsa_sign(rejection_batch_message(batch), private_key)
+    return batch
+
+class RejectionBatcher(object):
+    """
+    Holds rejections until the window closes. The same (txid, domain)
+    rejection added twice within a window is only sent once. A window of 0
+    means nothing is sent until flush() is called.
+    """
+    def __init__(self, window=None):
+        self.window = settings.REJECTION_BATCH_SECONDS if window is None else window
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.timer = None
+
+    def add(self, rejection):
+        with self.lock:
+            self.pending[(rejection['txid'], rejection['domain'])] = rejection
+            if self.window and not self.timer:
+                self.timer = threading.Timer(self.window, self._flush_in_thread)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _flush_in_thread(self):
+        try:
+            self.flush()
+        finally:
+            connection.close()
+
+    def flush(self):
+        """
+        Send everything pending. Each destination gets one batch, leaving out
+        the rejections that peer made itself.
+        """
+        from .models import Peer, EpochSummary
+
+        with self.lock:
+            rejections = list(self.pending.values())
+            self.pending.clear()
+            self.timer = None
+        if not rejections:
+            return
+
+        my_domain, my_pk = Peer.my_node_data()
+        for destination in EpochSummary.prop_domains():
+            batch = [x for x in rejections if x['domain'] != destination]
+            if batch:
+                transport.propagate(
+                    [destination], make_rejection_batch(batch, my_domain, my_pk),
+                    "rejection batch"
+                )
+
+rejection_batcher = RejectionBatcher()
+atexit.register(rejection_batcher.flush)
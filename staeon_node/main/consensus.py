@@ -0,0 +1,40 @@
+"""
+The two consensus steps run at the start of each epoch, shared by the
+consensus_step1/consensus_step2 commands and the simulator.
+"""
+from staeon.consensus import EpochHashPush, NodePenalization
+
+from .models import EpochSummary, EpochHash, NodePenaltyVote
+from . import transport
+
+def push_epoch_hashes(node, epoch):
+    """
+    Step 1: settle the penalty votes cast during the last epoch, close the
+    epoch that just ended and push the mini hashes of it's seed to every node
+    this node is assigned to. Votes are settled first so the reputation
+    changes are part of the new epoch's shuffle.
+    """
+    NodePenaltyVote.tally(epoch - 1)
+    es = EpochSummary.close_epoch(epoch)
+
+    for domain, mini_hashes in es.consensus_pushes(domain=node.domain).items():
+        push = EpochHashPush.make(
+            epoch, node.domain, domain, node.private_key, mini_hashes
+        )
+        transport.propagate([domain], push, "epoch hash")
+    return es
+
+def check_epoch_hashes(node, epoch):
+    """
+    Step 2: check the pushes received for the epoch against our own seed.
+    Returns the pushes that never arrived, the ones that were wrong, and a
+    penalization for each wrong one.
+    """
+    not_present, wrong = EpochHash.validate_pulls_for_epoch(epoch)
+
+    penalties = []
+    for push, correct_hash in wrong:
+        penalties.append(NodePenalization.make(
+            epoch, correct_hash, push.as_dict(), node.private_key
+        ))
+    return not_present, wrong, penalties
@@ -0,0 +1,235 @@
+"""
+Threaded serving mode for the node to node endpoints (transactions,
+rejections and consensus pushes). Connection threads only read HTTP and hold
+keep-alive connections open, at most INGEST_MAX_CONNECTIONS of them; past
+that a new connection is answered 503 with Retry-After and closed right away,
+without a thread, and the peer's relay sends it again later. Every complete
+request is run through the regular Django WSGI application in
+a pool of INGEST_WORKERS threads, so at most that many requests are doing
+validation and database work at once, using exactly the same views, models
+and validation code as the WSGI deployment.
+
+A request is read with a bounded readline for each header line and one read
+of exactly Content-Length bytes, so a connection never buffers more than
+MAX_HEADER_SIZE plus MAX_BODY_SIZE. Chunked bodies are refused.
+
+Outbound propagation still happens inside the views, so run this with
+GOSSIP_STREAMS on, where propagating only queues the message. TLS is left to
+the same terminating proxy that fronts the WSGI app.
+"""
+from __future__ import print_function
+
+import io
+import sys
+import socket
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.wsgi import get_wsgi_application
+from django.utils.six.moves import socketserver
+from django.utils.six.moves.urllib.parse import unquote
+
+INGEST_PATHS = (
+    '/staeon/transaction/', '/staeon/rejections/', '/staeon/consensus/push',
+)
+MAX_HEADER_SIZE = 16 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+BUSY_RESPONSE = (
+    b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n'
+    b'Content-Length: 0\r\nConnection: close\r\n\r\n'
+)
+
+class BadRequest(Exception):
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+def run_wsgi(application, environ):
+    """
+    Call the WSGI application and collect the whole response. Runs in the
+    worker pool.
+    """
+    response = []
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, headers]
+
+    result = application(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close() # sends request_finished, which closes the db connection
+    status, headers = response
+    return status, headers, body
+
+def read_request(rfile):
+    """
+    Returns (method, target, version, headers, body), or None when the peer
+    closed the connection between requests. Raises BadRequest.
+    """
+    line = rfile.readline(MAX_HEADER_SIZE + 1)
+    if not line:
+        return None
+    size = len(line)
+    try:
+        method, target, version = line.rstrip(b'\r\n').split(b' ')
+    except ValueError:
+        raise BadRequest('400 Bad Request')
+
+    headers = {}
+    while True:
+        line = rfile.readline(MAX_HEADER_SIZE + 1)
+        size += len(line)
+        if size > MAX_HEADER_SIZE:
+            raise BadRequest('431 Request Header Fields Too Large')
+        if not line:
+            return None
+        line = line.rstrip(b'\r\n')
+        if not line:
+            break
+        name, _, value = line.partition(b':')
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get(b'transfer-encoding'):
+        raise BadRequest('411 Length Required')
+    try:
+        length = int(headers.get(b'content-length', 0) or 0)
+    except ValueError:
+        raise BadRequest('400 Bad Request')
+    if length < 0:
+        raise BadRequest('400 Bad Request')
+    if length > MAX_BODY_SIZE:
+        raise BadRequest('413 Payload Too Large')
+    body = rfile.read(length)
+    if len(body) < length:
+        return None # closed in the middle of the body
+    return method, target, version, headers, body
+
+class IngestHandler(socketserver.StreamRequestHandler):
+    """
+    One peer connection. Requests are handled one at a time per connection
+    (keep-alive and pipelining both work), while other connections carry on.
+    """
+    def setup(self):
+        self.request.settimeout(settings.INGEST_IDLE_TIMEOUT)
+        socketserver.StreamRequestHandler.setup(self)
+
+    def handle(self):
+        while True:
+            try:
+                request = read_request(self.rfile)
+            except BadRequest as exc:
+                return self.write_response(exc.status, [('Content-Type', 'text/plain')], exc.status, close=True)
+            except socket.error:
+                return # timed out while idle, or reset
+            if not request:
+                return
+
+            method, target, version, headers, body = request
+            keep_alive = (
+                version == b'HTTP/1.1' and headers.get(b'connection', b'').lower() != b'close'
+            )
+            path, _, query = target.partition(b'?')
+            if not path.startswith(INGEST_PATHS):
+                self.write_response('404 Not Found', [('Content-Type', 'text/plain')], b'Not Found')
+            else:
+                environ = self.make_environ(method, path, query, version, headers, body)
+                try:
+                    status, response_headers, response_body = self.server.pool.apply(
+                        run_wsgi, (self.server.application, environ)
+                    )
+                except Exception as exc:
+                    print("ingest: %s %s failed: %s" % (method, path, exc))
+                    status, response_headers, response_body = (
+                        '500 Internal Server Error', [('Content-Type', 'text/plain')], b'Error'
+                    )
+                self.write_response(status, response_headers, response_body, close=not keep_alive)
+            if not keep_alive:
+                return
+
+    def make_environ(self, method, path, query, version, headers, body):
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': headers.get(b'host', b'localhost').split(b':')[0],
+            'SERVER_PORT': str(self.server.server_address[1]),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': self.client_address[0],
+            'CONTENT_TYPE': headers.get(b'content-type', b''),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            if name not in (b'content-type', b'content-length'):
+                environ[str('HTTP_') + name.upper().replace(b'-', b'_')] = value
+        return environ
+
+    def write_response(self, status, headers, body, close=False):
+        lines = ['HTTP/1.1 %s' % status]
+        lines += ['%s: %s' % (name, value) for name, value in headers
+                  if name.lower() not in ('content-length', 'connection')]
+        lines.append('Content-Length: %s' % len(body))
+        lines.append('Connection: %s' % ('close' if close else 'keep-alive'))
+        self.wfile.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        self.wfile.flush()
+
+class IngestServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, workers=None, max_connections=None):
+        self.request_queue_size = settings.INGEST_BACKLOG
+        self.application = get_wsgi_application()
+        self.pool = ThreadPool(workers or settings.INGEST_WORKERS)
+        self.connections = threading.BoundedSemaphore(
+            max_connections or settings.INGEST_MAX_CONNECTIONS
+        )
+        socketserver.TCPServer.__init__(self, address, IngestHandler)
+
+    def process_request(self, request, client_address):
+        if not self.connections.acquire(False):
+            return self.refuse(request)
+        try:
+            socketserver.ThreadingMixIn.process_request(self, request, client_address)
+        except Exception:
+            self.connections.release() # no thread to release it
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            socketserver.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.connections.release()
+
+    def refuse(self, request):
+        # a fresh socket's send buffer is empty, this doesn't wait on the peer
+        try:
+            request.settimeout(1)
+            request.sendall(BUSY_RESPONSE)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def server_close(self):
+        socketserver.TCPServer.server_close(self)
+        self.pool.close()
+        self.pool.join()
+
+def serve(host, port, workers=None, max_connections=None):
+    """
+    Run the ingest server until interrupted.
+    """
+    server = IngestServer((host, port), workers, max_connections)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
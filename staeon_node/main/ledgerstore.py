@@ -0,0 +1,243 @@
+"""
+In-process copy of the ledger, held as columns: a sorted list of addresses
+with the amounts and last updated times in contiguous arrays at the same
+positions. With USE_LEDGER_STORE on, balance lookups during validation are
+a binary search instead of a query, and the epoch seed is computed from the
+arrays instead of sorting the LedgerEntry table. Nothing is ever written
+based on what's in here.
+
+LedgerEntry stays the durable copy and is written as before. When an epoch
+closes the arrays are also checkpointed to LEDGER_CHECKPOINT_PATH (if set),
+so a restart loads them from there instead of reading every row.
+
+Every write to the ledger bumps the version of the LedgerBuckets it touched,
+through LedgerBucket.adjust (apply_deltas) or LedgerBucket.rebuild (anything
+else), and the store remembers the sum of those versions it's columns match.
+At most every LEDGER_STORE_REFRESH_SECONDS, and always before the epoch seed,
+that sum is read again, one row per bucket, and the columns are reloaded when
+it's moved on, e.g. after another process wrote the ledger. Writes made in
+this process add their own bumps when they update the columns, so only
+someone else's write causes a reload.
+"""
+import os
+import json
+import time
+import bisect
+import datetime
+import threading
+from array import array
+
+from django.conf import settings
+
+from staeon.consensus import get_epoch_number
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def to_seconds(dt):
+    return (dt - EPOCH).total_seconds()
+
+def from_seconds(seconds):
+    return EPOCH + datetime.timedelta(seconds=seconds)
+
+class LedgerStore(object):
+    def __init__(self):
+        self.lock = threading.RLock()
+        # (addresses, amounts, updated), replaced as a whole when entries
+        # are added so readers never see the columns out of step
+        self.columns = None
+        self.epoch = None # last closed epoch the columns include
+        self.version = None # LedgerBucket.ledger_version() the columns match
+        self.checked = 0
+
+    @property
+    def loaded(self):
+        return self.columns is not None
+
+    def reset(self):
+        """
+        Forget everything, the next lookup reloads from the database. Called
+        when LedgerEntry is written other than through apply_deltas.
+        """
+        with self.lock:
+            self.columns = None
+            self.epoch = None
+            self.version = None
+
+    def ensure_current(self, force=False):
+        """
+        Load the first time it's used. After that, at most every
+        LEDGER_STORE_REFRESH_SECONDS (or right away with force), reload if
+        the ledger has been written since.
+        """
+        if not force and self.loaded:
+            if time.time() - self.checked < settings.LEDGER_STORE_REFRESH_SECONDS:
+                return
+        with self.lock:
+            self.checked = time.time()
+            # read before the rows, so a write in between only means an
+            # extra reload next time
+            version = self._ledger_version()
+            latest = self._latest_epoch()
+            if self.loaded and self.version == version:
+                self.epoch = latest
+                return
+            if not self._load_checkpoint(latest, version):
+                self._load_database(latest, version)
+
+    def matches_database(self):
+        """
+        Whether nothing has been written to the ledger that the columns
+        don't have.
+        """
+        return self.loaded and self.version == self._ledger_version()
+
+    def _ledger_version(self):
+        from .models import LedgerBucket
+        return LedgerBucket.ledger_version()
+
+    def _latest_epoch(self):
+        from .models import EpochSummary
+        return EpochSummary.objects.order_by('-epoch').values_list('epoch', flat=True).first()
+
+    def _load_database(self, epoch, version):
+        from .models import LedgerEntry
+        addresses, amounts, updated = [], array('d'), array('d')
+        # sorted here rather than by the database, whose collation might
+        # not be by code point like bisect
+        rows = sorted(LedgerEntry.objects.values_list(
+            'address', 'amount', 'last_updated'
+        ).iterator())
+        for address, amount, last_updated in rows:
+            addresses.append(address)
+            amounts.append(amount)
+            updated.append(to_seconds(last_updated))
+        self.columns = (addresses, amounts, updated)
+        self.epoch = epoch
+        self.version = version
+
+    def _load_checkpoint(self, epoch, version):
+        path = settings.LEDGER_CHECKPOINT_PATH
+        if not path or not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline().decode('utf-8'))
+            if header['epoch'] != epoch or header.get('version') != version:
+                return False
+            amounts, updated = array('d'), array('d')
+            amounts.fromfile(f, header['count'])
+            updated.fromfile(f, header['count'])
+            addresses = f.read().decode('ascii').split('\n') if header['count'] else []
+        self.columns = (addresses, amounts, updated)
+        self.epoch = epoch
+        self.version = version
+        return True
+
+    def checkpoint(self, epoch):
+        """
+        Record that the columns now include this closed epoch, and write
+        them to LEDGER_CHECKPOINT_PATH if set.
+        """
+        with self.lock:
+            if not self.loaded:
+                return
+            self.epoch = epoch
+            path = settings.LEDGER_CHECKPOINT_PATH
+            if not path:
+                return
+            addresses, amounts, updated = self.columns
+            tmp = "%s.tmp" % path
+            with open(tmp, 'wb') as f:
+                header = {'epoch': epoch, 'version': self.version, 'count': len(addresses)}
+                f.write(json.dumps(header).encode('utf-8') + b"\n")
+                amounts.tofile(f)
+                updated.tofile(f)
+                f.write('\n'.join(addresses).encode('ascii'))
+            os.rename(tmp, path) # readers never see a partial checkpoint
+
+    def _position(self, addresses, address):
+        i = bisect.bisect_left(addresses, address)
+        if i < len(addresses) and addresses[i] == address:
+            return i
+        return None
+
+    def get(self, address):
+        """
+        (amount, last_updated) or None if there's no entry.
+        """
+        self.ensure_current()
+        addresses, amounts, updated = self.columns
+        i = self._position(addresses, address)
+        if i is None:
+            return None
+        return amounts[i], from_seconds(updated[i])
+
+    def amounts(self, addresses):
+        """
+        {address: amount} for the ones that have an entry.
+        """
+        self.ensure_current()
+        columns, amounts, _ = self.columns
+        found = {}
+        for address in addresses:
+            i = self._position(columns, address)
+            if i is not None:
+                found[address] = amounts[i]
+        return found
+
+    def update(self, rows, bumped):
+        """
+        Set (address, amount, last_updated) for each row, after they have
+        been written to the database in a transaction that bumped the ledger
+        version by bumped.
+        """
+        with self.lock:
+            if not self.loaded:
+                return
+            self.version += bumped
+            addresses, amounts, updated = self.columns
+            new = []
+            for address, amount, last_updated in rows:
+                i = self._position(addresses, address)
+                if i is None:
+                    new.append((address, amount, to_seconds(last_updated)))
+                else:
+                    amounts[i] = amount
+                    updated[i] = to_seconds(last_updated)
+            if new:
+                self.columns = self._merge(self.columns, sorted(new))
+
+    def _merge(self, columns, new):
+        addresses, amounts, updated = columns
+        merged = ([], array('d'), array('d'))
+        i = 0
+        for address, amount, last_updated in new:
+            j = bisect.bisect_left(addresses, address, i)
+            merged[0].extend(addresses[i:j])
+            merged[1].extend(amounts[i:j])
+            merged[2].extend(updated[i:j])
+            merged[0].append(address)
+            merged[1].append(amount)
+            merged[2].append(last_updated)
+            i = j
+        merged[0].extend(addresses[i:])
+        merged[1].extend(amounts[i:])
+        merged[2].extend(updated[i:])
+        return merged
+
+    def count(self):
+        self.ensure_current()
+        return len(self.columns[0])
+
+    def seed_order(self):
+        """
+        Addresses ordered like the epoch seed wants them, by amount
+        descending then address.
+        """
+        self.ensure_current()
+        addresses, amounts, _ = self.columns
+        # addresses are already sorted, so a stable sort on amount alone
+        # leaves equal amounts in address order
+        order = sorted(range(len(addresses)), key=lambda i: -amounts[i])
+        return (addresses[i] for i in order)
+
+ledger_store = LedgerStore()
@@ -0,0 +1,245 @@
+"""
+Generates transaction load against a node. Funded keys and signed
+transactions are made up front in a process pool, so signing never slows
+down the replay. The replay then sends them at a fixed rate from a pool of
+threads and measures how long the node takes to answer each one.
+
+Latency is measured from when each transaction was due to be sent, not from
+when a thread got around to sending it, so a node that falls behind shows it
+in the percentiles instead of quietly lowering the rate.
+
+Funding mints coins into this node's own ledger, so it's only done when
+asked for, only when the transactions go to this node, and undone once the
+replay is over. A funded replay runs the views in this process instead of
+over HTTP, with a NullTransport installed so none of the transactions (or
+rejections of them) reach real peers, and it has to be over EPOCH_MARGIN
+seconds before the epoch ends, so the funding is never part of an epoch
+seed.
+"""
+from __future__ import print_function
+
+import json
+import time
+import random
+import datetime
+import threading
+from collections import Counter
+from multiprocessing import Pool
+
+import requests
+from bitcoin import random_key, encode_privkey, privtoaddr
+from django.db import transaction
+from django.test import Client
+from django.utils.six.moves import queue
+from django.utils.six.moves.urllib.parse import urlparse
+
+from staeon.consensus import get_epoch_number, get_epoch_range
+from staeon.transaction import make_transaction, make_txid
+
+from .models import (
+    LedgerEntry, LedgerBucket, StagedLedgerDelta, ValidatedTransaction, Peer,
+    FOLD_CHUNK_SIZE
+)
+from . import wire, statetree
+
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+EPOCH_MARGIN = 30 # seconds before the epoch ends a funded replay has to be done
+
+# forked pool workers would all share the parent's random state
+_random = random.SystemRandom()
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(int(len(values) * percent / 100.0), len(values) - 1)]
+
+def make_funded_tx(fee):
+    """
+    One signed transaction spending from a new address, plus the amount that
+    address needs to be funded with. Module level so it can be sent to a
+    process pool.
+    """
+    spend_priv = encode_privkey(random_key(), 'wif_compressed')
+    spend_addr = privtoaddr(spend_priv)
+    receive_addr = privtoaddr(random_key())
+    amount = float("%.8f" % (_random.random() * 5 + 0.1))
+    tx = make_transaction(
+        [[spend_addr, amount, spend_priv]],
+        [[receive_addr, float("%.8f" % (amount - fee))]]
+    )
+    return tx, spend_addr, amount
+
+def generate(count, processes=None, fee=0.01):
+    """
+    Make count funded transactions in a process pool. Returns a list of
+    (tx, address, amount).
+    """
+    pool = Pool(processes)
+    try:
+        return list(pool.imap_unordered(make_funded_tx, [fee] * count, chunksize=100))
+    finally:
+        pool.close()
+        pool.join()
+
+def is_this_node(url):
+    """
+    Whether url points at this node, the one whose database fund() writes to.
+    """
+    host = urlparse(url).hostname
+    if host in LOCAL_HOSTS:
+        return True
+    try:
+        return host == Peer.my_node_data()[0]
+    except (IOError, IndexError):
+        return False
+
+class NullTransport(object):
+    """
+    Drops everything sent to peers while a funded replay runs.
+    """
+    def __init__(self):
+        self.dropped = 0
+
+    def propagate(self, domains, obj, type):
+        self.dropped += 1
+
+def funding_deadline(now=None):
+    """
+    When a funded replay has to stop sending: EPOCH_MARGIN seconds before
+    the current epoch ends.
+    """
+    now = now or datetime.datetime.now()
+    end = get_epoch_range(get_epoch_number(now))[1]
+    return end - datetime.timedelta(seconds=EPOCH_MARGIN)
+
+def fund(generated):
+    """
+    Give every spending address it's balance in this node's ledger. Undo it
+    with unfund().
+    """
+    last_updated = datetime.datetime.now() - datetime.timedelta(hours=1)
+    with transaction.atomic():
+        LedgerEntry.apply_deltas([
+            (address, amount, last_updated) for tx, address, amount in generated
+        ])
+
+def unfund(generated):
+    """
+    Remove what fund() minted: the transactions that were sent, and the
+    ledger entries and staged deltas of the generated addresses, which
+    nothing else uses. Then rebuild the state tree buckets they were in.
+    """
+    txids = [tx.get('txid') or make_txid(tx) for tx, address, amount in generated]
+    addresses = set()
+    for tx, address, amount in generated:
+        addresses.add(address)
+        addresses.update(output[0] for output in tx['outputs'])
+    addresses = list(addresses)
+
+    with transaction.atomic():
+        for i in range(0, len(txids), FOLD_CHUNK_SIZE):
+            ValidatedTransaction.objects.filter(txid__in=txids[i:i + FOLD_CHUNK_SIZE]).delete()
+        for i in range(0, len(addresses), FOLD_CHUNK_SIZE):
+            chunk = addresses[i:i + FOLD_CHUNK_SIZE]
+            LedgerEntry.objects.filter(address__in=chunk).delete()
+            StagedLedgerDelta.objects.filter(address__in=chunk).delete()
+    LedgerBucket.rebuild(buckets=set(statetree.bucket_for(x) for x in addresses))
+
+def save(generated, path):
+    with open(path, 'w') as f:
+        for item in generated:
+            f.write(json.dumps(item) + "\n")
+
+def load(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def encode_tx(tx, format):
+    """
+    Request body and headers for one transaction: a form post like staeon
+    does, or an encoded body (see main.wire).
+    """
+    if format == 'form':
+        return {'tx': json.dumps(tx)}, {}
+    content_type = wire.MSGPACK if format == 'msgpack' else wire.JSON
+    return wire.encode(tx, content_type)
+
+def local_post(client, url, body, headers):
+    """
+    Post to url's view through Django in this process, like requests would
+    over HTTP. Returns the status code.
+    """
+    path = urlparse(url).path
+    if not headers:
+        return client.post(path, data=body).status_code
+    extra = {}
+    if 'Content-Encoding' in headers:
+        extra['HTTP_CONTENT_ENCODING'] = headers['Content-Encoding']
+    return client.post(
+        path, data=body, content_type=headers['Content-Type'], **extra
+    ).status_code
+
+def replay(txs, url, rate, threads=32, timeout=10, format='form', local=False, deadline=None):
+    """
+    Send every transaction at rate per second. Returns a dict with the
+    latencies of the ones that were answered, errors by status code or
+    exception, and the wall time taken. With local the views are called in
+    this process (see local_post). Transactions due after deadline (a unix
+    time) aren't sent, they count as 'deadline' errors.
+    """
+    bodies = queue.Queue()
+    for i, tx in enumerate(txs):
+        bodies.put((i, encode_tx(tx, format)))
+
+    latencies = []
+    errors = Counter()
+    lock = threading.Lock()
+    start = time.time() + 0.5 # leave time for the threads to start
+
+    def send():
+        session = Client() if local else requests.Session()
+        while True:
+            try:
+                i, (body, headers) = bodies.get_nowait()
+            except queue.Empty:
+                return
+            due = start + i / float(rate)
+            if deadline and due > deadline:
+                with lock:
+                    errors['deadline'] += 1
+                continue
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                if local:
+                    status = local_post(session, url, body, headers)
+                else:
+                    status = session.post(url, data=body, headers=headers, timeout=timeout).status_code
+                error = None if status == 200 else status
+            except requests.exceptions.RequestException as exc:
+                error = exc.__class__.__name__
+            except Exception as exc:
+                if not local:
+                    raise
+                error = exc.__class__.__name__ # raised by the view itself
+            latency = time.time() - due
+            with lock:
+                if error:
+                    errors[error] += 1
+                else:
+                    latencies.append(latency)
+
+    workers = [threading.Thread(target=send) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    return {
+        'sent': len(txs),
+        'latencies': latencies,
+        'errors': dict(errors),
+        'wall': time.time() - start,
+    }
@@ -1,6 +1,8 @@
 from django.core.management.base import BaseCommand, CommandError
-from main.models import Peer, LedgerEntry, EpochSummary
-from staeon.consensus import get_epoch_number, EpochHashPush, propagate_to_peers
+from main.profiling import profiled
+from main.models import Peer
+from main.consensus import push_epoch_hashes
+from staeon.consensus import get_epoch_number
 
 class Command(BaseCommand):
     help = "Perform consensus part 1. Called every 10 minutes at the start of each epoch."
@@ -8,6 +10,7 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--rank', type=int, help='calculate as rank')
 
+    @profiled('consensus_step1')
     def handle(self, *args, **options):
         if options['rank']:
             rank = options['rank']
@@ -17,10 +20,4 @@ class Command(BaseCommand):
 
         # close last epoch that just ended
         epoch = get_epoch_number() - 1
-        es = EpochSummary.close_epoch(epoch)
-
-        for domain, mini_hashes in es.consensus_pushes().items():
-            push = EpochHashPush.make(
-                epoch, node.domain, domain, node.private_key, mini_hashes
-            )
-            propagate_to_peers([domain], push, "epoch hash")
+        push_epoch_hashes(node, epoch)
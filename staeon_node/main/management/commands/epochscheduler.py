@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+from main.models import Peer
+from main.scheduler import EpochScheduler
+
+class Command(BaseCommand):
+    help = "Stay running and perform both consensus steps at the start of every epoch. Replaces the consensus_step1/2 cron jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rank', type=int, help='calculate as rank')
+
+    def handle(self, *args, **options):
+        node = Peer.get_by_rank(options['rank']) if options['rank'] else None
+        scheduler = EpochScheduler(node, out=self.stdout)
+        try:
+            scheduler.run_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,25 @@
+import time
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from main.models import ValidatedTransaction
+from staeon.network import PROPAGATION_WINDOW_SECONDS
+
+class Command(BaseCommand):
+    help = "Continuously folds transactions older than the propagation window into the staged ledger delta."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='fold once and exit')
+
+    def handle(self, *args, **options):
+        while True:
+            until = datetime.datetime.now() - datetime.timedelta(seconds=PROPAGATION_WINDOW_SECONDS)
+            folded = ValidatedTransaction.fold(until=until)
+            if folded:
+                self.stdout.write("folded %s transactions" % folded)
+            if options['once']:
+                return
+            connection.close()
+            time.sleep(settings.LEDGER_FOLD_SECONDS)
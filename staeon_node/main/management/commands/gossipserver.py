@@ -0,0 +1,27 @@
+import ssl
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from main.streams import GossipServer
+
+class Command(BaseCommand):
+    help = "Accept persistent gossip streams from other nodes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=settings.GOSSIP_STREAM_PORT)
+
+    def handle(self, *args, **options):
+        context = None
+        if settings.GOSSIP_STREAM_TLS:
+            if not settings.GOSSIP_STREAM_CERT:
+                raise CommandError("GOSSIP_STREAM_TLS is on but GOSSIP_STREAM_CERT is not set")
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(settings.GOSSIP_STREAM_CERT, settings.GOSSIP_STREAM_KEY)
+
+        server = GossipServer((options['host'], options['port']), ssl_context=context)
+        self.stdout.write("Accepting gossip streams on %s:%s" % (options['host'], options['port']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
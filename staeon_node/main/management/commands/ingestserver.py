@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from main import ingest
+
+class Command(BaseCommand):
+    help = "Serve the node to node endpoints (transactions, rejections, consensus pushes) from a bounded pool of worker threads."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--workers', type=int, default=settings.INGEST_WORKERS,
+            help='threads running validation and database work')
+        parser.add_argument('--max-connections', type=int, default=settings.INGEST_MAX_CONNECTIONS,
+            help='connections open at once, more are answered 503')
+
+    def handle(self, *args, **options):
+        self.stdout.write("Ingest server on %s:%s with %s workers, %s connections" % (
+            options['host'], options['port'], options['workers'], options['max_connections']
+        ))
+        try:
+            ingest.serve(
+                options['host'], options['port'], options['workers'],
+                options['max_connections']
+            )
+        except KeyboardInterrupt:
+            pass
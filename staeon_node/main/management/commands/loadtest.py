@@ -0,0 +1,102 @@
+import time
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from main import loadgen, transport
+from main.batching import rejection_batcher
+from main.loadgen import percentile
+from main.mempool import mempool
+
+class Command(BaseCommand):
+    help = "Replay pre-signed, funded transactions against a node at a target rate and report latency percentiles."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://localhost:8000/staeon/transaction/', help='transaction endpoint to send to')
+        parser.add_argument('--transactions', type=int, default=1000, help='transactions to generate')
+        parser.add_argument('--rate', type=float, default=100, help='transactions per second to send')
+        parser.add_argument('--threads', type=int, default=32, help='sending threads')
+        parser.add_argument('--processes', type=int, help='processes generating transactions, defaults to one per CPU')
+        parser.add_argument('--timeout', type=float, default=10, help='seconds before a request counts as failed')
+        parser.add_argument('--format', choices=['form', 'json', 'msgpack'], default='form', help='how transactions are posted')
+        parser.add_argument('--fund', action='store_true', help="fund the spending addresses in this node's ledger and run the views in this process, nothing is sent to peers. Only when --url is this node, and the run has to end before the epoch does")
+        parser.add_argument('--save', metavar='PATH', help='save the generated transactions instead of sending them')
+        parser.add_argument('--load', metavar='PATH', help='send transactions saved with --save instead of generating')
+
+    def handle(self, *args, **options):
+        if options['rate'] <= 0:
+            raise CommandError("--rate has to be above 0")
+        if options['fund'] and options['save']:
+            raise CommandError("--fund happens when sending, use it with --load instead of --save")
+        if options['fund'] and not loadgen.is_this_node(options['url']):
+            raise CommandError(
+                "--fund writes to this node's database, --url has to point at this node"
+            )
+
+        if options['load']:
+            generated = loadgen.load(options['load'])
+            self.stdout.write("Loaded %s transactions" % len(generated))
+        else:
+            generated = loadgen.generate(options['transactions'], options['processes'])
+            self.stdout.write("Generated %s transactions" % len(generated))
+
+        if options['save']:
+            loadgen.save(generated, options['save'])
+            self.stdout.write("Saved to %s" % options['save'])
+            return
+
+        txs = [tx for tx, address, amount in generated]
+        if options['fund']:
+            report = self.funded_replay(generated, txs, options)
+        else:
+            report = loadgen.replay(
+                txs, options['url'], options['rate'], threads=options['threads'],
+                timeout=options['timeout'], format=options['format']
+            )
+        latencies = report['latencies']
+        self.stdout.write("Sent %s transactions in %.3fs (target %.1f tx/sec)" % (
+            report['sent'], report['wall'], options['rate']
+        ))
+        self.stdout.write("Accepted: %s, throughput %.1f tx/sec" % (
+            len(latencies), len(latencies) / report['wall']
+        ))
+        for error, count in sorted(report['errors'].items()):
+            self.stdout.write("Failed (%s): %s" % (error, count))
+        if latencies:
+            self.stdout.write("Latency: p50 %.1fms, p95 %.1fms, p99 %.1fms, max %.1fms" % tuple(
+                x * 1000 for x in (
+                    percentile(latencies, 50), percentile(latencies, 95),
+                    percentile(latencies, 99), max(latencies)
+                )
+            ))
+
+    def funded_replay(self, generated, txs, options):
+        deadline = loadgen.funding_deadline()
+        left = (deadline - datetime.datetime.now()).total_seconds()
+        needed = len(txs) / options['rate'] + 1
+        if needed > left:
+            raise CommandError(
+                "The epoch ends in %ds and the run needs about %ds, the funding "
+                "would end up in it's seed. Wait for the next epoch or send fewer "
+                "transactions." % (left + loadgen.EPOCH_MARGIN, needed)
+            )
+
+        null = loadgen.NullTransport()
+        previous = transport.set_transport(null)
+        loadgen.fund(generated)
+        try:
+            return loadgen.replay(
+                txs, options['url'], options['rate'], threads=options['threads'],
+                format=options['format'], local=True,
+                deadline=time.mktime(deadline.timetuple())
+            )
+        finally:
+            if settings.USE_MEMPOOL:
+                mempool.flush()
+            rejection_batcher.flush() # into the null transport
+            loadgen.unfund(generated)
+            transport.set_transport(previous)
+            self.stdout.write(
+                "Removed the funding and the transactions sent, held back %s "
+                "messages to peers" % null.dropped
+            )
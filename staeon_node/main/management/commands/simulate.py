@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from main.simulator import Simulation
+from main.loadgen import percentile
+
+class Command(BaseCommand):
+    help = "Run many simulated nodes through an epoch close and both consensus steps."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--nodes', type=int, default=100, help='number of simulated nodes')
+        parser.add_argument('--transactions', type=int, default=0, help='transactions to inject before the close')
+        parser.add_argument('--latency', type=float, default=50, help='mean message latency in ms')
+        parser.add_argument('--jitter', type=float, default=20, help='latency jitter in ms')
+        parser.add_argument('--loss', type=float, default=0.0, help='chance a message is dropped, 0 to 1')
+        parser.add_argument('--tick', type=float, default=10, help='delivery tick in ms')
+        parser.add_argument('--processes', type=int, default=0, help='size of process pool, 0 runs everything in this process')
+        parser.add_argument('--seed', type=int, help='random seed for latency and loss')
+        parser.add_argument('--keep', action='store_true', help='keep the node databases afterwards')
+
+    def handle(self, *args, **options):
+        if options['nodes'] < 2:
+            raise CommandError("Need at least 2 nodes")
+
+        sim = Simulation(
+            options['nodes'], latency=options['latency'], jitter=options['jitter'],
+            loss=options['loss'], tick=options['tick'],
+            processes=options['processes'], seed=options['seed']
+        )
+        try:
+            report = sim.run(transactions=options['transactions'])
+        finally:
+            if options['keep']:
+                self.stdout.write("Node databases kept in %s" % sim.workdir)
+            else:
+                sim.cleanup()
+
+        self.stdout.write("Nodes: %(nodes)s, epoch: %(epoch)s, transactions: %(transactions)s" % report)
+        self.stdout.write("Transactions reached all nodes after %.3f simulated sec" % report['transaction_spread'])
+        if report['convergence_time'] is None:
+            self.stdout.write("Consensus did not converge: %s of %s nodes got every push" % (
+                report['converged_nodes'], report['nodes']
+            ))
+        else:
+            self.stdout.write("Consensus converged after %.3f simulated sec" % report['convergence_time'])
+        self.stdout.write("Distinct epoch seeds: %s" % report['distinct_seeds'])
+
+        for type in sorted(report['sent']):
+            self.stdout.write("%s messages: %s sent, %s delivered, %s dropped" % (
+                type, report['sent'][type], report['delivered'].get(type, 0),
+                report['dropped'].get(type, 0)
+            ))
+
+        for phase, times in sorted(report['cpu'].items()):
+            times = times.values()
+            self.stdout.write("%s CPU per node: p50 %.4fs, p99 %.4fs, max %.4fs, total %.3fs" % (
+                phase, percentile(times, 50), percentile(times, 99), max(times), sum(times)
+            ))
+
+        for stage, seconds in sorted(report['wall'].items()):
+            self.stdout.write("%s wall time: %.3fs" % (stage, seconds))
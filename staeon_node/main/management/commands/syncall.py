@@ -1,10 +1,12 @@
 from django.core.management.base import BaseCommand, CommandError
+from main.profiling import profiled
 from main.sync import sync_ledger, sync_peers
 
 
 class Command(BaseCommand):
     help = 'Sync ledger with other nodes. Called when first coming online.'
 
+    @profiled('syncall')
     def handle(self, *args, **options):
         sync_ledger()
         sync_peers()
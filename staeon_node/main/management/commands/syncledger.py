@@ -1,9 +1,19 @@
 from django.core.management.base import BaseCommand, CommandError
-from main.sync import sync_ledger
+from main.sync import sync_ledger, repair_ledger
 
 
 class Command(BaseCommand):
     help = 'Sync ledger with other nodes. Called when first coming online.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--repair', metavar='DOMAIN',
+            help="only re-sync the address buckets that differ from this peer's"
+        )
+
     def handle(self, *args, **options):
-        sync_ledger()
+        if options['repair']:
+            differing = repair_ledger(options['repair'])
+            self.stdout.write("%s buckets differed" % len(differing))
+        else:
+            sync_ledger()
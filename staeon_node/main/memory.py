@@ -0,0 +1,57 @@
+"""
+Peak memory use of a block of code, for the per stage figures recorded on
+EpochSummary.
+"""
+import os
+import sys
+import resource
+import threading
+
+SAMPLE_SECONDS = 0.01
+
+def current_rss():
+    """
+    Resident set size of this process in bytes, None where /proc isn't
+    available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf(str('SC_PAGE_SIZE'))
+    except (IOError, OSError, ValueError):
+        return None
+
+def max_rss():
+    """
+    Highest resident set size this process has ever had, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class PeakMemory(object):
+    """
+    with PeakMemory() as peak:
+        ...
+    peak.bytes is then the highest resident set size seen while the block
+    ran, sampled by a background thread. Without /proc it falls back to the
+    process' all time peak.
+    """
+    def __enter__(self):
+        self.bytes = current_rss()
+        if self.bytes is not None:
+            self.done = threading.Event()
+            self.thread = threading.Thread(target=self._sample, name="peak-memory")
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def _sample(self):
+        while not self.done.wait(SAMPLE_SECONDS):
+            self.bytes = max(self.bytes, current_rss())
+
+    def __exit__(self, *exc_info):
+        if self.bytes is None:
+            self.bytes = max_rss()
+            return
+        self.done.set()
+        self.thread.join()
+        self.bytes = max(self.bytes, current_rss())
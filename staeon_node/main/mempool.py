@@ -0,0 +1,249 @@
+"""
+In-memory pool of the transactions not yet applied to the ledger, indexed by
+txid and by input address. With USE_MEMPOOL on, pending balance totals and
+conflicting spend lookups during validation are dictionary lookups instead of
+queries, duplicate checks only go to the database when the pool misses, and
+transactions are written to the database by a background thread. A
+transaction the writer fails to store is dropped from the pool again. On
+restart the pool is rebuilt from the unapplied transactions in the database.
+
+The pool only sees transactions that pass through this process, so turn it
+on when a single process does all ingestion (see the ingestserver command).
+Epochs are closed by another process (consensus_step1 or epochscheduler), so
+the pool drops the transactions of closed epochs by itself, after seeing a
+newer EpochSummary (checked at most every PRUNE_CHECK_SECONDS). The writer
+keeps MEMPOOL_WRITTEN_KEY in the shared cache at the time up to which
+everything it was handed is in the database, which close_epoch waits for.
+"""
+from __future__ import print_function
+
+import time
+import atexit
+import threading
+import dateutil.parser
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.utils.six.moves import queue
+
+from staeon.consensus import get_epoch_number
+from staeon.exceptions import RejectedObject
+
+PRUNE_CHECK_SECONDS = 1
+MEMPOOL_WRITTEN_KEY = "mempool-written"
+MARK_WRITTEN_SECONDS = 5
+WRITER_IDLE_CLOSE = 30 # seconds idle before the writer closes it's connection
+
+def wait_for_writes(since):
+    """
+    Wait (up to MEMPOOL_WRITE_WAIT seconds) until the ingest process's writer
+    has stored everything it was handed before since, a unix time. Returns
+    right away when no writer is running. Returns False if it timed out.
+    """
+    cache = caches[settings.MEMPOOL_WRITTEN_CACHE]
+    deadline = time.time() + settings.MEMPOOL_WRITE_WAIT
+    while True:
+        written = cache.get(MEMPOOL_WRITTEN_KEY)
+        # a running writer marks at least every MARK_WRITTEN_SECONDS
+        if written is None or written >= since or written < since - 3 * MARK_WRITTEN_SECONDS:
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.5)
+
+class Mempool(object):
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.closed = None # latest closed epoch already dropped
+        self.checked = 0
+        self.marked = 0
+        self.txs = {} # txid -> (epoch, [(address, amount), ...])
+        self.pending = defaultdict(float) # address -> net unapplied amount
+        self.spends = defaultdict(set) # input address -> accepted txids spending it
+        self.writes = queue.Queue()
+        self.writer = None
+
+    def ensure_current(self):
+        """
+        Load the pool the first time it's used, and drop closed epochs.
+        """
+        self.ensure_loaded()
+        self.prune()
+
+    def prune(self):
+        """
+        Drop every epoch up to the latest one closed, by whichever process.
+        """
+        from .models import EpochSummary
+        if time.time() - self.checked < PRUNE_CHECK_SECONDS:
+            return
+        self.checked = time.time()
+        latest = EpochSummary.objects.order_by('-epoch').values_list('epoch', flat=True).first()
+        if latest is not None and latest != self.closed:
+            self.discard_epoch(latest)
+            self.closed = latest
+
+    def ensure_loaded(self):
+        """
+        Rebuild the pool from the database the first time it's used.
+        """
+        if self.loaded:
+            return
+        from .models import ValidatedMovement, ValidatedRejection
+
+        with self.lock:
+            if self.loaded:
+                return
+            movements = defaultdict(list)
+            epochs = {}
+            rows = ValidatedMovement.objects.filter(tx__applied=False).values_list(
+                'tx_id', 'tx__timestamp', 'address', 'amount'
+            )
+            for txid, timestamp, address, amount in rows.iterator():
+                movements[txid].append((address, amount))
+                epochs[txid] = get_epoch_number(timestamp)
+            rejected = set(ValidatedRejection.objects.filter(
+                tx__applied=False
+            ).values_list('tx_id', flat=True))
+            for txid, tx_movements in movements.items():
+                self._index(txid, epochs[txid], tx_movements, spends=txid not in rejected)
+            self.loaded = True
+
+    def _index(self, txid, epoch, movements, spends=True):
+        """
+        Rejected transactions still count towards pending totals, but not as
+        spends, so they don't block a valid spend from the same address.
+        """
+        self.txs[txid] = (epoch, movements)
+        for address, amount in movements:
+            self.pending[address] += amount
+            if amount < 0 and spends:
+                self.spends[address].add(txid)
+
+    def _unindex(self, txid):
+        epoch, movements = self.txs.pop(txid)
+        for address, amount in movements:
+            self.pending[address] -= amount
+            if abs(self.pending[address]) < 1e-9:
+                del self.pending[address]
+            self.spends[address].discard(txid)
+            if not self.spends[address]:
+                del self.spends[address]
+
+    def __contains__(self, txid):
+        self.ensure_current()
+        return txid in self.txs
+
+    def pending_total(self, address):
+        """
+        Net amount of all unapplied movements for this address.
+        """
+        self.ensure_current()
+        return self.pending.get(address, 0)
+
+    def conflicting_spends(self, tx):
+        """
+        txids of the accepted pending transactions from the same epoch that
+        spend from any of this transaction's inputs.
+        """
+        self.ensure_current()
+        epoch = get_epoch_number(
+            dateutil.parser.parse(tx['timestamp']).replace(tzinfo=None)
+        )
+        conflicts = set()
+        with self.lock:
+            for address, amount, sig in tx['inputs']:
+                conflicts |= set(
+                    txid for txid in self.spends.get(address, ())
+                    if self.txs[txid][0] == epoch
+                )
+        conflicts.discard(tx.get('txid'))
+        return conflicts
+
+    def add(self, tx, timestamp, as_reject=False):
+        """
+        Index a validated transaction and queue it to be written to the
+        database. Returns False if it was already in the pool. Raises
+        RejectedObject when a conflicting spend got into the pool since the
+        transaction was validated.
+        """
+        self.ensure_current()
+        movements = [(address, amount * -1) for address, amount, sig in tx['inputs']]
+        movements += [(address, amount) for address, amount in tx['outputs']]
+        with self.lock:
+            if tx['txid'] in self.txs:
+                return False
+            if not as_reject and self.conflicting_spends(tx):
+                raise RejectedObject("Conflicts with a pending spend")
+            self._index(tx['txid'], get_epoch_number(timestamp), movements, spends=not as_reject)
+        self.persist(tx, as_reject)
+        return True
+
+    def remove(self, txid):
+        with self.lock:
+            if txid in self.txs:
+                self._unindex(txid)
+
+    def discard_epoch(self, epoch):
+        """
+        Drop every transaction from this epoch or earlier, called once they
+        have been applied to the ledger.
+        """
+        with self.lock:
+            for txid, (tx_epoch, movements) in list(self.txs.items()):
+                if tx_epoch <= epoch:
+                    self._unindex(txid)
+
+    def persist(self, tx, as_reject):
+        with self.lock:
+            if not self.writer:
+                self.writer = threading.Thread(target=self._write_forever, name="mempool-writer")
+                self.writer.daemon = True
+                self.writer.start()
+        self.writes.put((tx, as_reject))
+
+    def flush(self):
+        """
+        Block until every queued transaction has been written.
+        """
+        self.writes.join()
+
+    def _mark_written(self, since):
+        """
+        Everything handed to the writer before since is in the database.
+        """
+        if since - self.marked < MARK_WRITTEN_SECONDS:
+            return
+        self.marked = since
+        caches[settings.MEMPOOL_WRITTEN_CACHE].set(MEMPOOL_WRITTEN_KEY, since, None)
+
+    def _write_forever(self):
+        from .models import ValidatedTransaction
+        idle = 0
+        while True:
+            now = time.time()
+            try:
+                tx, as_reject = self.writes.get(timeout=1)
+            except queue.Empty:
+                self._mark_written(now)
+                idle += 1
+                if idle >= WRITER_IDLE_CLOSE:
+                    idle = 0
+                    connection.close() # don't hold a connection while idle
+                continue
+            idle = 0
+            try:
+                ValidatedTransaction.write(tx, as_reject=as_reject)
+            except Exception as exc:
+                print("mempool: could not write %s: %s" % (tx.get('txid'), exc))
+                self.remove(tx['txid'])
+            finally:
+                self.writes.task_done()
+            if self.writes.empty():
+                self._mark_written(time.time())
+
+mempool = Mempool()
+atexit.register(mempool.flush) # don't lose queued writes on exit
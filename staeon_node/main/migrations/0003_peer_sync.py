@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.18 on 2026-10-19 16:20
+from __future__ import unicode_literals
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_validatedrejection_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PeerSyncState',
+            fields=[
+                ('seed_domain', models.TextField(primary_key=True, serialize=False)),
+                ('as_of', models.DateTimeField()),
+                ('etag', models.CharField(blank=True, default='', max_length=64)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='peer',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=datetime.datetime.now),
+            preserve_default=False,
+        ),
+    ]
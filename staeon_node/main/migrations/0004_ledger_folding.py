@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.18 on 2026-10-19 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_peer_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StagedLedgerDelta',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('epoch', models.IntegerField()),
+                ('address', models.CharField(max_length=35)),
+                ('amount', models.FloatField(default=0)),
+                ('last_updated', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='validatedtransaction',
+            name='folded',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterUniqueTogether(
+            name='stagedledgerdelta',
+            unique_together=set([('epoch', 'address')]),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.18 on 2026-10-19 16:07
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+from main import statetree
+
+
+def build_state_tree(apps, schema_editor):
+    LedgerEntry = apps.get_model('main', 'LedgerEntry')
+    LedgerBucket = apps.get_model('main', 'LedgerBucket')
+    totals = defaultdict(lambda: [0, 0])
+    for entry in LedgerEntry.objects.all().iterator():
+        bucket = statetree.bucket_for(entry.address)
+        LedgerEntry.objects.filter(address=entry.address).update(bucket=bucket)
+        totals[bucket][0] += statetree.entry_hash(entry.address, entry.amount)
+        totals[bucket][1] += 1
+    LedgerBucket.objects.bulk_create([
+        LedgerBucket(bucket=bucket, digest=statetree.add_hashes(statetree.EMPTY, added), count=count)
+        for bucket, (added, count) in totals.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_ledger_folding'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerBucket',
+            fields=[
+                ('bucket', models.CharField(max_length=3, primary_key=True, serialize=False)),
+                ('digest', models.CharField(default='0000000000000000000000000000000000000000000000000000000000000000', max_length=64)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='ledgerentry',
+            name='bucket',
+            field=models.CharField(db_index=True, default='', max_length=3),
+        ),
+        migrations.RunPython(build_state_tree, migrations.RunPython.noop),
+    ]
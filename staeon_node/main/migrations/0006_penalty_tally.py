@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.18 on 2026-10-19 16:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_ledger_state_tree'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='epochsummary',
+            name='votes_tallied',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterUniqueTogether(
+            name='nodepenaltyvote',
+            unique_together=set([('epoch', 'penalized_peer', 'voting_peer')]),
+        ),
+    ]
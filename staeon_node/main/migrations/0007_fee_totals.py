@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.18 on 2026-10-19 16:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum, Case, When, F, Func, Value, FloatField
+from django.db.models.functions import Coalesce
+
+from staeon.consensus import get_epoch_range
+
+
+def fill_fee_totals(apps, schema_editor):
+    ValidatedTransaction = apps.get_model('main', 'ValidatedTransaction')
+    ValidatedMovement = apps.get_model('main', 'ValidatedMovement')
+    EpochSummary = apps.get_model('main', 'EpochSummary')
+
+    def movement_sum(amount):
+        return Coalesce(Subquery(
+            ValidatedMovement.objects.filter(tx=OuterRef('pk')).order_by()
+            .values('tx').annotate(s=Sum(amount)).values('s'),
+            output_field=FloatField()
+        ), 0)
+
+    spent = Case(When(amount__lt=0, then=F('amount')), default=0, output_field=FloatField())
+    ValidatedTransaction.objects.update(
+        input_amount=movement_sum(spent) * -1,
+        fee_amount=Func(movement_sum('amount') * -1, Value(8), function='ROUND'),
+    )
+    for es in EpochSummary.objects.all():
+        start, end = get_epoch_range(es.epoch)
+        fees = ValidatedTransaction.objects.filter(
+            timestamp__gte=start, timestamp__lte=end
+        ).aggregate(s=Sum('fee_amount'))['s']
+        EpochSummary.objects.filter(epoch=es.epoch).update(fee_total=round(fees or 0, 8))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0006_penalty_tally'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='epochsummary',
+            name='fee_total',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='validatedtransaction',
+            name='fee_amount',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='validatedtransaction',
+            name='input_amount',
+            field=models.FloatField(default=0),
+        ),
+        migrations.RunPython(fill_fee_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.18 on 2026-10-19 16:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0007_fee_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='epochsummary',
+            name='apply_peak_memory',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='epochsummary',
+            name='count_peak_memory',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='epochsummary',
+            name='seed_peak_memory',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
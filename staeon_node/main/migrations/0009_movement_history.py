@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.18 on 2026-10-19 16:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+from staeon.consensus import get_epoch_number, get_epoch_range
+
+
+CHUNK_SIZE = 5000 # movements updated per statement
+
+
+def copy_tx_fields(apps, schema_editor):
+    """
+    Backfill in chunks of CHUNK_SIZE ids, so no single statement holds the
+    whole table, and only for the epochs that have movements in a chunk.
+    """
+    ValidatedTransaction = apps.get_model('main', 'ValidatedTransaction')
+    ValidatedMovement = apps.get_model('main', 'ValidatedMovement')
+
+    tx = ValidatedTransaction.objects.filter(txid=OuterRef('tx_id'))
+    last_id = 0
+    while True:
+        ids = list(ValidatedMovement.objects.filter(id__gt=last_id).order_by(
+            'id').values_list('id', flat=True)[:CHUNK_SIZE])
+        if not ids:
+            return
+        last_id = ids[-1]
+
+        chunk = ValidatedMovement.objects.filter(id__gte=ids[0], id__lte=ids[-1])
+        chunk.update(
+            tx_timestamp=Subquery(tx.values('timestamp')[:1]),
+            tx_fee=Subquery(tx.values('fee_amount')[:1]),
+        )
+        timestamps = chunk.exclude(tx_timestamp=None).values_list('tx_timestamp', flat=True)
+        for epoch in sorted(set(get_epoch_number(x) for x in timestamps)):
+            start, end = get_epoch_range(epoch)
+            chunk.filter(tx_timestamp__gte=start, tx_timestamp__lte=end).update(epoch=epoch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0008_epoch_peak_memory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='validatedmovement',
+            name='epoch',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='validatedmovement',
+            name='tx_fee',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='validatedmovement',
+            name='tx_timestamp',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='validatedmovement',
+            index_together=set([('address', 'epoch')]),
+        ),
+        migrations.RunPython(copy_tx_fields, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.18 on 2026-10-19 16:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0009_movement_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='epochsummary',
+            name='step1_duration',
+            field=models.DurationField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='epochsummary',
+            name='step1_lag',
+            field=models.DurationField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='epochsummary',
+            name='step2_duration',
+            field=models.DurationField(blank=True, null=True),
+        ),
+    ]
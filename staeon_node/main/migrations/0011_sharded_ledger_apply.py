@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.18 on 2026-10-19 16:19
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from main import statetree
+
+
+def fill_buckets(apps, schema_editor):
+    StagedLedgerDelta = apps.get_model('main', 'StagedLedgerDelta')
+    for delta in StagedLedgerDelta.objects.all().iterator():
+        StagedLedgerDelta.objects.filter(pk=delta.pk).update(
+            bucket=statetree.bucket_for(delta.address)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0010_scheduler_timing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stagedledgerdelta',
+            name='bucket',
+            field=models.CharField(default='', max_length=3),
+        ),
+        migrations.AlterIndexTogether(
+            name='stagedledgerdelta',
+            index_together=set([('epoch', 'bucket')]),
+        ),
+        migrations.RunPython(fill_buckets, migrations.RunPython.noop),
+    ]
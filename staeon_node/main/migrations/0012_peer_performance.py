@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.18 on 2026-10-19 16:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0011_sharded_ledger_apply'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PeerPerformance',
+            fields=[
+                ('domain', models.TextField(primary_key=True, serialize=False)),
+                ('latency', models.FloatField(null=True)),
+                ('error_rate', models.FloatField(default=0)),
+                ('throughput', models.FloatField(null=True)),
+                ('calls', models.IntegerField(default=0)),
+                ('failures', models.IntegerField(default=0)),
+                ('open_until', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
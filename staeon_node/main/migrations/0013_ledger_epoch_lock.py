@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+from staeon.consensus import get_epoch_number
+
+
+def stage_folded(apps, schema_editor):
+    """
+    Transactions folded before this migration were staged into their own
+    epoch.
+    """
+    ValidatedTransaction = apps.get_model('main', 'ValidatedTransaction')
+    by_epoch = defaultdict(list)
+    folded = ValidatedTransaction.objects.filter(folded=True, applied=False)
+    for txid, timestamp in folded.values_list('txid', 'timestamp').iterator():
+        by_epoch[get_epoch_number(timestamp)].append(txid)
+    for epoch, txids in by_epoch.items():
+        for i in range(0, len(txids), 500):
+            ValidatedTransaction.objects.filter(txid__in=txids[i:i + 500]).update(
+                staged_epoch=epoch
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0012_peer_performance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerEpoch',
+            fields=[
+                ('epoch', models.IntegerField(primary_key=True, serialize=False)),
+                ('closed', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='validatedtransaction',
+            name='staged_epoch',
+            field=models.IntegerField(db_index=True, null=True),
+        ),
+        migrations.RunPython(stage_folded, migrations.RunPython.noop),
+    ]
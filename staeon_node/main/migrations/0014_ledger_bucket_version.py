@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0013_ledger_epoch_lock'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ledgerbucket',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+    ]
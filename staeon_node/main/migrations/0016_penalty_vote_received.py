@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import datetime
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0015_admin_ordering_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nodepenaltyvote',
+            name='received',
+            field=models.DateTimeField(default=datetime.datetime.now),
+        ),
+    ]
@@ -1,25 +1,43 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import time
 import datetime
 import random
 import os
 import hashlib
+import threading
+from array import array
+from multiprocessing import Pool
 import dateutil.parser
 from collections import defaultdict
 import json
 
-from django.db import models
+from django.db import models, transaction, connection, connections, IntegrityError
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.conf import settings
 from django.core.cache import caches
 
+from bitcoin import ecdsa_verify
 from staeon.consensus import (
     make_epoch_seed, get_epoch_range, get_epoch_number, make_matrix,
-    EpochHashPush, make_mini_hashes, propagate_to_peers
+    EpochHashPush, make_mini_hashes, validate_rejection_authorization,
+    make_transaction_rejection, NodePenalization
 )
 from staeon.transaction import make_txid, validate_transaction
 from staeon.network import PROPAGATION_WINDOW_SECONDS
-from staeon.exceptions import RejectedObject
+from staeon.exceptions import RejectedObject, InvalidObject
+
+from . import transport
+from .batching import rejection_batcher, rejection_batch_message
+from .mempool import mempool, wait_for_writes
+from .ledgerstore import ledger_store
+from .memory import PeakMemory
+from . import statetree
+
+# lets one process act as different nodes, see Peer.set_node_identity
+_node_identity = threading.local()
 
 def filter_for_epoch(epoch=None, prefix=''):
     if not epoch: epoch = get_epoch_number()
@@ -29,26 +47,57 @@ def filter_for_epoch(epoch=None, prefix=''):
         '%stimestamp__gte' % prefix: epoch_start,
     }
 
-def ledger(address, timestamp):
-    try:
-        entry = LedgerEntry.objects.get(address=address)
-    except LegderEntry.DoesNotExist:
-        raise Exception("%s does not exist" % address)
+def epoch_cache_timeout(epochs=3):
+    """
+    Cache timeout long enough to cover this many epochs.
+    """
+    epoch_start, epoch_end = get_epoch_range(get_epoch_number())
+    return int((epoch_end - epoch_start).total_seconds() * epochs)
 
-    last_updated = entry.last_updated
-    current_balance = entry.amount
-    adjusted = ValidatedMovement.adjusted_balance(address, get_epoch_number(timestamp))
+def ledger(address, timestamp):
+    if settings.USE_LEDGER_STORE:
+        entry = ledger_store.get(address)
+        if entry is None:
+            raise Exception("%s does not exist" % address)
+        current_balance, last_updated = entry
+    else:
+        try:
+            entry = LedgerEntry.objects.get(address=address)
+        except LedgerEntry.DoesNotExist:
+            raise Exception("%s does not exist" % address)
+        last_updated = entry.last_updated
+        current_balance = entry.amount
+
+    if settings.USE_MEMPOOL:
+        adjusted = mempool.pending_total(address)
+    else:
+        adjusted = ValidatedMovement.adjusted_balance(address, get_epoch_number(timestamp))
     #spend_this_epoch = ValidatedTransaction.last_spend(address)
 
     return (current_balance + adjusted) #, spend_this_epoch or last_updated
 
+FOLD_CHUNK_SIZE = 500 # stays under sqlite's limit on query parameters
+
+def commit_ledger_shard(args):
+    """
+    Commit one range of buckets of an epoch's staged deltas in it's own
+    transaction. Module level so it can be sent to a process pool.
+    """
+    epoch, bucket_range = args
+    try:
+        with transaction.atomic():
+            return StagedLedgerDelta.commit(epoch, bucket_range)
+    finally:
+        connection.close()
+
 def propagate_to_assigned_peers(obj, type):
-    return propagate_to_peers(EpochSummary.prop_domains(), obj=obj, type=type)
+    return transport.propagate(EpochSummary.prop_domains(), obj=obj, type=type)
 
 class LedgerEntry(models.Model):
     address = models.CharField(max_length=35, primary_key=True)
     amount = models.FloatField(default=0)
-    last_updated = models.DateTimeField()
+    last_updated = models.DateTimeField(db_index=True)
+    bucket = models.CharField(max_length=statetree.BUCKET_DIGITS, db_index=True, default='')
 
     class Meta:
         get_latest_by = 'last_updated'
@@ -57,14 +106,303 @@ class LedgerEntry(models.Model):
     def total_issued(cls):
         return cls.objects.aggregate(s=models.Sum('amount'))['s']
 
+    @classmethod
+    def balances(cls, addresses):
+        """
+        Confirmed balance for each address in one IN query. Addresses with no
+        ledger entry are left out.
+        """
+        if settings.USE_LEDGER_STORE:
+            return ledger_store.amounts(addresses)
+        return dict(
+            cls.objects.filter(address__in=addresses).values_list('address', 'amount')
+        )
+
+    @classmethod
+    def apply_deltas(cls, deltas):
+        """
+        Add net amounts to the ledger and update the state tree to match.
+        deltas is a list of (address, amount, last_updated), one per address.
+        The state tree needs each entry's old amount, so the entries are read
+        locked, and the amounts are still added in the database. The ledger
+        store is only told the new amounts once the transaction commits.
+        """
+        for i in range(0, len(deltas), FOLD_CHUNK_SIZE):
+            chunk = deltas[i:i + FOLD_CHUNK_SIZE]
+            addresses = [address for address, _, _ in chunk]
+            while True:
+                existing = dict(cls.objects.select_for_update().filter(
+                    address__in=addresses
+                ).values_list('address', 'amount'))
+                new_entries = [
+                    cls(address=address, amount=amount, last_updated=last_updated,
+                        bucket=statetree.bucket_for(address))
+                    for address, amount, last_updated in chunk if address not in existing
+                ]
+                try:
+                    with transaction.atomic():
+                        cls.objects.bulk_create(new_entries)
+                    break
+                except IntegrityError:
+                    pass # some were created by another process since, read again
+
+            written = []
+            changes = defaultdict(lambda: [0, 0, 0]) # bucket -> added, removed, count
+            for address, amount, last_updated in chunk:
+                change = changes[statetree.bucket_for(address)]
+                if address in existing:
+                    old_amount = existing[address]
+                    new_amount = old_amount + amount
+                    cls.objects.filter(address=address).update(
+                        amount=models.F('amount') + amount, last_updated=last_updated
+                    )
+                    change[1] += statetree.entry_hash(address, old_amount)
+                else:
+                    new_amount = amount
+                    change[2] += 1
+                change[0] += statetree.entry_hash(address, new_amount)
+                written.append((address, new_amount, last_updated))
+            LedgerBucket.adjust(changes)
+            if settings.USE_LEDGER_STORE:
+                # adjust bumped the version of every bucket in changes
+                transaction.on_commit(
+                    lambda written=written, bumped=len(changes): ledger_store.update(written, bumped)
+                )
+
+    def save(self, *args, **kwargs):
+        # saving an entry directly (instead of through apply_deltas) means
+        # calling LedgerBucket.rebuild for it's bucket afterwards
+        self.bucket = statetree.bucket_for(self.address)
+        super(LedgerEntry, self).save(*args, **kwargs)
+
     def __unicode__(self):
         return "%s %s" % (self.address[:8], self.amount)
 
+class LedgerBucket(models.Model):
+    """
+    Leaf of the ledger state tree, one per bucket of addresses. See
+    main.statetree. version counts the writes to the bucket and never goes
+    down, so their sum changes whenever the ledger does (see main.ledgerstore).
+    """
+    bucket = models.CharField(max_length=statetree.BUCKET_DIGITS, primary_key=True)
+    digest = models.CharField(max_length=64, default=statetree.EMPTY)
+    count = models.IntegerField(default=0)
+    version = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return "%s %s" % (self.bucket, self.digest[:8])
+
+    @classmethod
+    def adjust(cls, changes):
+        """
+        changes is {bucket: (added, removed, count)}, the sums of the entry
+        hashes added to and removed from each bucket, and how many entries
+        it gained.
+        """
+        with transaction.atomic():
+            existing = cls.objects.select_for_update().in_bulk(list(changes.keys()))
+            new_buckets = []
+            for bucket, (added, removed, count) in changes.items():
+                leaf = existing.get(bucket)
+                if leaf:
+                    cls.objects.filter(bucket=bucket).update(
+                        digest=statetree.add_hashes(leaf.digest, added, removed),
+                        count=leaf.count + count, version=models.F('version') + 1
+                    )
+                else:
+                    new_buckets.append(cls(
+                        bucket=bucket, count=count, version=1,
+                        digest=statetree.add_hashes(statetree.EMPTY, added, removed)
+                    ))
+            cls.objects.bulk_create(new_buckets)
+        caches['default'].delete("state-tree")
+
+    @classmethod
+    def rebuild(cls, buckets=None):
+        """
+        Recompute buckets (or all of them) from the ledger itself. Call after
+        LedgerEntry rows are written any way other than apply_deltas, it's
+        what tells the ledger store in every process that they changed.
+        Buckets left empty keep their leaf, so their version isn't lost.
+        """
+        entries = LedgerEntry.objects.all()
+        leaves = cls.objects.all()
+        if buckets is not None:
+            entries = entries.filter(bucket__in=buckets)
+            leaves = leaves.filter(bucket__in=buckets)
+
+        totals = defaultdict(lambda: [0, 0])
+        for address, amount, bucket in entries.values_list('address', 'amount', 'bucket').iterator():
+            totals[bucket][0] += statetree.entry_hash(address, amount)
+            totals[bucket][1] += 1
+
+        with transaction.atomic():
+            existing = set(leaves.select_for_update().values_list('bucket', flat=True))
+            leaves.update(
+                digest=statetree.EMPTY, count=0, version=models.F('version') + 1
+            )
+            new_buckets = []
+            for bucket, (added, count) in totals.items():
+                digest = statetree.add_hashes(statetree.EMPTY, added)
+                if bucket in existing:
+                    cls.objects.filter(bucket=bucket).update(digest=digest, count=count)
+                else:
+                    new_buckets.append(cls(bucket=bucket, digest=digest, count=count, version=1))
+            cls.objects.bulk_create(new_buckets)
+        caches['default'].delete("state-tree")
+        ledger_store.reset()
+
+    @classmethod
+    def ledger_version(cls):
+        """
+        Goes up with every write to the ledger.
+        """
+        return cls.objects.aggregate(version=models.Sum('version'))['version'] or 0
+
+    @classmethod
+    def tree(cls):
+        """
+        {prefix: digest} for every node of the state tree. Only changes when
+        the ledger does, so it's cached between changes.
+        """
+        cache = caches['default']
+        tree = cache.get("state-tree")
+        if tree is None:
+            tree = statetree.build_tree(dict(cls.objects.values_list('bucket', 'digest')))
+            # other processes only see the delete when the cache is shared
+            cache.set("state-tree", tree, 60)
+        return tree
+
+class StagedLedgerDelta(models.Model):
+    """
+    Net change to an address from transactions folded during an epoch but
+    not yet committed to the ledger. Committed and cleared when the epoch
+    closes.
+    """
+    epoch = models.IntegerField()
+    address = models.CharField(max_length=35)
+    amount = models.FloatField(default=0)
+    last_updated = models.DateTimeField()
+    bucket = models.CharField(max_length=statetree.BUCKET_DIGITS, default='')
+
+    class Meta:
+        unique_together = ('epoch', 'address')
+        index_together = [('epoch', 'bucket')]
+
+    def __unicode__(self):
+        return "%s %s %s" % (self.epoch, self.address[:8], self.amount)
+
+    @classmethod
+    def stage(cls, epoch, totals):
+        """
+        Add {address: (amount, last_updated)} to this epoch's staged deltas.
+        """
+        addresses = list(totals.keys())
+        for i in range(0, len(addresses), FOLD_CHUNK_SIZE):
+            chunk = addresses[i:i + FOLD_CHUNK_SIZE]
+            existing = {
+                x.address: x for x in cls.objects.filter(epoch=epoch, address__in=chunk)
+            }
+            new_deltas = []
+            for address in chunk:
+                amount, last_updated = totals[address]
+                delta = existing.get(address)
+                if delta:
+                    cls.objects.filter(pk=delta.pk).update(
+                        amount=models.F('amount') + amount,
+                        last_updated=max(delta.last_updated, last_updated)
+                    )
+                else:
+                    new_deltas.append(cls(
+                        epoch=epoch, address=address, amount=amount,
+                        last_updated=last_updated,
+                        bucket=statetree.bucket_for(address)
+                    ))
+            cls.objects.bulk_create(new_deltas)
+
+    @classmethod
+    def commit(cls, epoch, bucket_range=None):
+        """
+        Apply this epoch's staged deltas to the ledger and clear them, only
+        the ones in bucket_range (first, last) if given. Returns how many
+        were applied.
+        """
+        staged = cls.objects.filter(epoch=epoch).order_by('id')
+        if bucket_range:
+            staged = staged.filter(bucket__range=bucket_range)
+        applied = 0
+        last_id = 0
+        while True:
+            chunk = list(staged.filter(id__gt=last_id).values_list(
+                'id', 'address', 'amount', 'last_updated'
+            )[:FOLD_CHUNK_SIZE])
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+            LedgerEntry.apply_deltas([x[1:] for x in chunk])
+            applied += len(chunk)
+        staged.delete()
+        return applied
+
+    @classmethod
+    def commit_sharded(cls, epoch, processes):
+        """
+        commit() split into ranges of buckets, each committed by a process
+        in a pool. The ranges share no addresses and no LedgerBuckets, so
+        the shards never touch the same rows. Each shard is it's own
+        transaction and deletes the deltas it applied, so if one fails the
+        others stay applied and running this again only does what's left.
+        """
+        connections.close_all() # forked workers must not share connections
+        pool = Pool(processes)
+        try:
+            tasks = [(epoch, r) for r in statetree.bucket_ranges(processes)]
+            return sum(pool.imap_unordered(commit_ledger_shard, tasks))
+        finally:
+            pool.close()
+            pool.join()
+            # the workers cleared their own copies of the cached tree, a
+            # LocMemCache isn't shared with this process
+            caches['default'].delete("state-tree")
+
+class LedgerEpoch(models.Model):
+    """
+    Lock row for an epoch's staged deltas. Folding locks the row of every
+    epoch it stages into and close_epoch locks it while folding what's left,
+    then marks it closed, so nothing can be staged for an epoch once it's
+    deltas are being committed. Deltas folded after that go to the next open
+    epoch.
+    """
+    epoch = models.IntegerField(primary_key=True)
+    closed = models.BooleanField(default=False)
+
+    def __unicode__(self):
+        return "%s%s" % (self.epoch, " (closed)" if self.closed else "")
+
+    @classmethod
+    def lock(cls, epoch):
+        """
+        Lock this epoch's row until the transaction ends, creating it first
+        if needed. Must be called inside a transaction.
+        """
+        cls.objects.get_or_create(epoch=epoch)
+        return cls.objects.select_for_update().get(epoch=epoch)
+
+    @classmethod
+    def open_epoch(cls, epoch):
+        """
+        The first epoch from this one on that isn't closed, locked.
+        """
+        while cls.lock(epoch).closed:
+            epoch += 1
+        return epoch
+
 class Peer(models.Model):
     domain = models.TextField(primary_key=True)
     reputation = models.FloatField(default=0)
     first_registered = models.DateTimeField()
     payout_address = models.TextField(max_length=40, unique=True)
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     def __unicode__(self):
         return "%s (rank %s)" % (self.domain, self.rank())
@@ -133,15 +471,139 @@ class Peer(models.Model):
 
     @classmethod
     def my_node_data(cls):
+        identity = getattr(_node_identity, 'data', None)
+        if identity:
+            return identity
         config = open("/etc/staeon-node.conf").readlines()
         my_domain = config[0].strip()
         my_pk = config[1].strip()
         return my_domain, my_pk
 
+    @classmethod
+    def set_node_identity(cls, domain=None, private_key=None):
+        """
+        Make my_node_data return this domain and key for the current thread
+        instead of reading the node config. Call with no arguments to go back
+        to the config file. Used by the simulator to run many nodes in one
+        process.
+        """
+        _node_identity.data = (domain, private_key) if domain else None
+
     @classmethod
     def get_by_rank(self, rank):
         return Peer.objects.order_by('-reputation', 'first_registered')[rank]
 
+    @classmethod
+    def accept_registration(cls, reg):
+        """
+        Record an already validated peer registration, and pass it on to our
+        assigned peers.
+        """
+        try:
+            p = cls.objects.get(
+                models.Q(domain=reg['domain']) |
+                models.Q(payout_address=reg['payout_address'])
+            )
+            p.domain = reg['domain']
+            p.payout_address = reg['payout_address']
+            p.save()
+        except cls.DoesNotExist:
+            cls.objects.create(
+                domain=reg['domain'],
+                payout_address=reg['payout_address'],
+                first_registered=dateutil.parser.parse(reg['timestamp']).replace(tzinfo=None)
+            )
+
+        propagate_to_assigned_peers(reg, "peers")
+
+    @classmethod
+    def ranking(cls, current=None):
+        """
+        All peers ordered by rank, each with it's rank, percent and percentile
+        already calculated. Served from cache until the peer table changes.
+        Given the table's current stats (see table_stats), it's rebuilt if it
+        was made from an older table, e.g. by another process.
+        """
+        ranking = caches[settings.PEER_CACHE].get("peer-ranking")
+        if ranking is None or (current is not None and cls.ranking_stats(ranking) != current):
+            ranking = cls.rebuild_ranking()
+        return ranking
+
+    @classmethod
+    def table_stats(cls):
+        """
+        (count, latest last_modified) of the peer table, changes whenever a
+        peer is added, modified or removed.
+        """
+        stats = cls.objects.aggregate(
+            count=models.Count('domain'), last_modified=models.Max('last_modified')
+        )
+        return stats['count'], stats['last_modified']
+
+    @staticmethod
+    def ranking_stats(ranking):
+        """
+        The table_stats a ranking was built from.
+        """
+        return len(ranking), max(x['last_modified'] for x in ranking) if ranking else None
+
+    @classmethod
+    def rebuild_ranking(cls):
+        """
+        Calculate rank, percent and percentile for every peer in one pass over
+        the peer table, instead of three aggregate queries per peer.
+        """
+        peers = list(cls.objects.order_by('-reputation', 'first_registered').values_list(
+            'domain', 'reputation', 'first_registered', 'payout_address', 'last_modified'
+        ))
+        total_rep = sum(x[1] for x in peers)
+        cumulative_below = total_rep
+        ranking = []
+        for rank, (domain, reputation, first_registered, payout_address, last_modified) in enumerate(peers):
+            ranking.append({
+                'domain': domain,
+                'reputation': reputation,
+                'rank': rank,
+                'percent': (reputation * 100 / total_rep) if total_rep else 0,
+                'percentile': (cumulative_below * 100 / total_rep) if total_rep else 0,
+                'payout_address': payout_address,
+                'first_registered': first_registered,
+                'last_modified': last_modified,
+            })
+            cumulative_below -= reputation
+
+        caches[settings.PEER_CACHE].set("peer-ranking", ranking, settings.PEER_CACHE_SECONDS)
+        return ranking
+
+    @classmethod
+    def dicts_for(cls, domains=None, current=None):
+        """
+        as_dict for many peers at once, taken from the cached ranking instead
+        of three queries per peer, every peer in rank order when domains
+        isn't given. current is passed on to ranking().
+        """
+        ranked = cls.ranking(current)
+        if domains is None:
+            domains = [x['domain'] for x in ranked]
+        ranking = {x['domain']: x for x in ranked}
+        return [
+            dict(
+                ranking[domain],
+                first_registered=ranking[domain]['first_registered'].isoformat(),
+                last_modified=ranking[domain]['last_modified'].isoformat()
+            )
+            for domain in domains if domain in ranking
+        ]
+
+    @classmethod
+    def peers_changed(cls):
+        """
+        Drop everything derived from the peer table so it gets rebuilt on
+        next access, in every process. prop_domains comes from the epoch's
+        shuffle matrix, which peer changes don't touch.
+        """
+        caches[settings.PEER_CACHE].delete_many(["peer-ranking", "network-summary"])
+
     def as_dict(self, pk=False):
         ret = {
             'domain': self.domain,
@@ -158,15 +620,53 @@ class Peer(models.Model):
                 ret['private_key'] = my_pk
         return ret
 
+class PeerSyncState(models.Model):
+    """
+    Where the last peer registry sync from a seed node left off.
+    """
+    seed_domain = models.TextField(primary_key=True)
+    as_of = models.DateTimeField()
+    etag = models.CharField(max_length=64, blank=True, default='')
+
+    def __unicode__(self):
+        return "%s as of %s" % (self.seed_domain, self.as_of)
+
+class PeerPerformance(models.Model):
+    """
+    How a peer has answered our calls, written from main.peerstats.
+    """
+    domain = models.TextField(primary_key=True)
+    latency = models.FloatField(null=True) # seconds, moving average
+    error_rate = models.FloatField(default=0)
+    throughput = models.FloatField(null=True) # bytes per second, moving average
+    calls = models.IntegerField(default=0)
+    failures = models.IntegerField(default=0) # in a row
+    open_until = models.DateTimeField(null=True, blank=True)
+
+    def __unicode__(self):
+        return "%s %.3fs %.0f%% errors" % (
+            self.domain, self.latency or 0, self.error_rate * 100
+        )
+
 class EpochSummary(models.Model):
     epoch = models.IntegerField(primary_key=True)
     epoch_seed = models.CharField(max_length=64)
     transaction_count = models.IntegerField(default=0)
+    fee_total = models.FloatField(default=0)
 
     # statistics
     count_duration = models.DurationField()
     apply_duration = models.DurationField()
     seed_duration = models.DurationField()
+    count_peak_memory = models.BigIntegerField(null=True, blank=True) # bytes
+    apply_peak_memory = models.BigIntegerField(null=True, blank=True)
+    seed_peak_memory = models.BigIntegerField(null=True, blank=True)
+    # filled in by the epoch scheduler
+    step1_lag = models.DurationField(null=True, blank=True)
+    step1_duration = models.DurationField(null=True, blank=True)
+    step2_duration = models.DurationField(null=True, blank=True)
+
+    votes_tallied = models.BooleanField(default=False)
 
     class Meta:
         get_latest_by = 'epoch'
@@ -182,17 +682,55 @@ class EpochSummary(models.Model):
         """
         if not epoch: epoch = get_epoch_number() - 1
         cache = caches['default']
-        key = "prop-domains"
+        key = "prop-domains-%s" % epoch
         domains = cache.get(key)
-        if not domains:
+        if domains is None:
             try:
                 es = EpochSummary.objects.get(epoch=epoch)
+                timeout = epoch_cache_timeout()
             except EpochSummary.DoesNotExist:
+                # epoch not closed yet, only hold on to the stand in briefly
                 es = EpochSummary.objects.latest()
-            domains = [x.domain for x in es.consensus_nodes()['minihash1_push_to']]
-            cache.set(key, domains)
+                timeout = 60
+            domains = sorted(es.consensus_nodes()['minihash1_push_to'])
+            cache.set(key, domains, timeout)
         return domains
 
+    @classmethod
+    def network_summary(cls):
+        """
+        Figures for the public summary page. Built at epoch close and after
+        peer changes, so a page view is only a cache read.
+        """
+        summary = caches[settings.PEER_CACHE].get("network-summary")
+        if summary is None:
+            summary = cls.refresh_network_summary()
+        return summary
+
+    @classmethod
+    def refresh_network_summary(cls):
+        my_domain, _ = Peer.my_node_data()
+        peers = [dict(x, mine=(x['domain'] == my_domain)) for x in Peer.ranking()]
+
+        try:
+            latest = cls.objects.latest()
+        except cls.DoesNotExist:
+            latest = None
+
+        summary = {
+            'total_issued': LedgerEntry.total_issued(),
+            'peers': peers,
+            'last_epoch': latest and {
+                'epoch': latest.epoch,
+                'epoch_seed': latest.epoch_seed,
+                'transaction_count': latest.transaction_count,
+                'fee_total': latest.fee_total,
+                'apply_duration': latest.apply_duration,
+            }
+        }
+        caches[settings.PEER_CACHE].set("network-summary", summary, settings.PEER_CACHE_SECONDS)
+        return summary
+
     def calculate_mini_hashes(self, limit=5):
         return make_mini_hashes(self.epoch_seed, limit)
 
@@ -201,67 +739,134 @@ class EpochSummary(models.Model):
         if cls.objects.filter(epoch=epoch).exists():
             raise Exception("Epoch %s consensus already performed" % epoch)
 
+        if settings.USE_MEMPOOL:
+            # the pool doing ingestion is usually in another process
+            mempool.flush()
+            if not wait_for_writes(time.time()):
+                print("close_epoch: mempool writes still queued, closing anyway")
+
         stat_start = datetime.datetime.now()
-        txs = ValidatedTransaction.filter_for_epoch(epoch)
-        tx_count = txs.count()
+        with PeakMemory() as count_memory:
+            totals = ValidatedTransaction.filter_for_epoch(epoch).aggregate(
+                count=models.Count('txid'), fees=models.Sum('fee_amount')
+            )
+        tx_count = totals['count']
         stat_count_end = datetime.datetime.now()
 
-        ValidatedTransaction.apply_to_ledger(epoch)
+        with PeakMemory() as apply_memory:
+            ValidatedTransaction.apply_to_ledger(epoch)
+            if settings.USE_MEMPOOL:
+                # pools in other processes drop it once they see the summary
+                mempool.discard_epoch(epoch)
         stat_apply_end = datetime.datetime.now()
 
-        epoch_seed = make_epoch_seed(
-            tx_count, LedgerEntry.objects.count(),
-            LedgerEntry.objects.order_by('-amount', 'address'),
-            lambda x: x.address
-        )
+        with PeakMemory() as seed_memory:
+            if settings.USE_LEDGER_STORE:
+                # apply_to_ledger has committed and the store took the
+                # amounts it wrote, so this only checks the ledger version.
+                # After a sharded commit, or when called inside a transaction
+                # (the updates wait for it to commit), it's a full reload.
+                ledger_store.ensure_current(force=True)
+                ledger_count = ledger_store.count()
+                addresses = ledger_store.seed_order()
+            else:
+                # addresses are streamed, never held as a list or as model instances
+                ledger_count = LedgerEntry.objects.count()
+                addresses = LedgerEntry.objects.order_by('-amount', 'address').values_list(
+                    'address', flat=True
+                ).iterator()
+            epoch_seed = make_epoch_seed(
+                tx_count, ledger_count, addresses, lambda address: address
+            )
         stat_epoch_seed_end = datetime.datetime.now()
 
-        return cls.objects.create(
+        es = cls.objects.create(
             epoch_seed=epoch_seed, transaction_count=tx_count, epoch=epoch,
+            fee_total=float("%.8f" % (totals['fees'] or 0)),
             count_duration=(stat_count_end - stat_start),
             apply_duration=(stat_apply_end - stat_count_end),
-            seed_duration=(stat_epoch_seed_end - stat_apply_end)
+            seed_duration=(stat_epoch_seed_end - stat_apply_end),
+            count_peak_memory=count_memory.bytes,
+            apply_peak_memory=apply_memory.bytes,
+            seed_peak_memory=seed_memory.bytes,
         )
+        if settings.USE_LEDGER_STORE:
+            ledger_store.checkpoint(epoch)
+        es.make_shuffle_matrix()
+        caches['default'].delete("prop-domains-%s" % epoch)
+        # the summary shows the last epoch, rebuilt on the next page view
+        caches[settings.PEER_CACHE].delete("network-summary")
+        return es
 
     def make_shuffle_matrix(self):
-        cache = caches['default']
-        key = "matrix-%s" % self.epoch
-        matrix = make_matrix(
-            Peer.objects.all(), self.epoch_seed, sort_key=lambda x: x.domain
+        """
+        Builds the shuffle matrix for this epoch and caches it in compact form:
+        the sorted list of peer domains, the matrix as arrays of integer
+        indexes into that list, and the peers in rank order (and the reverse)
+        as indexes too. Called right after the epoch is closed. Everything
+        consensus_nodes looks up comes from this one snapshot of the peer
+        table, so peers joining or leaving mid-epoch can't put the ranks and
+        the matrix out of step.
+        """
+        peers = list(Peer.objects.values_list('domain', 'reputation', 'first_registered'))
+        ranked = sorted(peers, key=lambda x: (-x[1], x[2]))
+        ascending = sorted(peers, key=lambda x: (x[1], x[2]))
+        domains = sorted(x[0] for x in peers)
+        index = {domain: i for i, domain in enumerate(domains)}
+        matrix = make_matrix(domains, self.epoch_seed, sort_key=lambda x: x)
+        compact = {
+            'domains': domains,
+            'matrix': [
+                [array(str('I'), (index[domain] for domain in row)) for row in column]
+                for column in matrix
+            ],
+            'ranked': array(str('I'), (index[x[0]] for x in ranked)),
+            'ascending': array(str('I'), (index[x[0]] for x in ascending)),
+        }
+        caches['default'].set(
+            "matrix-%s" % self.epoch, compact, epoch_cache_timeout()
         )
-        cache.set(key, matrix)
-        return matrix
+        return compact
 
     def shuffle_matrix(self):
-        cache = caches['default']
-        key = "matrix-%s" % self.epoch
-        matrix = cache.get(key)
-        if not matrix:
+        matrix = caches['default'].get("matrix-%s" % self.epoch)
+        if not matrix or 'ranked' not in matrix:
             matrix = self.make_shuffle_matrix()
         return matrix
 
     def consensus_nodes(self, domain=None, matrix_depth=5):
         """
-        Gets all the appropriate nodes for the consensus process for the
-        next epoch for a given node domain.
+        Gets the domains of all the appropriate nodes for the consensus process
+        for the next epoch for a given node domain. A peer that registered
+        after the epoch closed has no part in it's consensus.
         """
-        peers = list(Peer.objects.all().order_by('reputation', 'first_registered'))
         if not domain:
-            node = Peer.my_node()
-        else:
-            node = Peer.objects.get(domain=domain)
+            domain, _ = Peer.my_node_data()
 
+        compact = self.shuffle_matrix()
+        domains = compact['domains']
         pushes = {}
-        matrix = self.shuffle_matrix()
-        for i, column in enumerate(matrix):
-            pushes['minihash%s_push_to' % i] = set(row[node.rank()] for row in column)
-            pushes['minihash%s_pushed_from' % i] = set(peers[row.index(node)] for row in column)
+        try:
+            me = domains.index(domain)
+        except ValueError:
+            for i in range(len(compact['matrix'])):
+                pushes['minihash%s_push_to' % i] = set()
+                pushes['minihash%s_pushed_from' % i] = set()
+            return pushes
+
+        rank = compact['ranked'].index(me)
+        ascending = compact['ascending']
+        for i, column in enumerate(compact['matrix']):
+            pushes['minihash%s_push_to' % i] = set(domains[row[rank]] for row in column)
+            pushes['minihash%s_pushed_from' % i] = set(
+                domains[ascending[row.index(me)]] for row in column
+            )
 
         return pushes
 
     def peers_pushing_to_me(self, minihash_index=0):
         """
-        All peers that will push a given hash to me.
+        Domains of all peers that will push a given hash to me.
         """
         return self.consensus_nodes()["minihash%s_pushed_from" % minihash_index]
 
@@ -274,20 +879,35 @@ class EpochSummary(models.Model):
         minihashes = self.calculate_mini_hashes()
 
         for minihash_index in range(5):
-            for node in work["minihash%s_push_to" % minihash_index]:
-                results[node.domain].append(minihashes[minihash_index])
-                random.shuffle(results[node.domain])
+            for node_domain in work["minihash%s_push_to" % minihash_index]:
+                results[node_domain].append(minihashes[minihash_index])
+                random.shuffle(results[node_domain])
 
         return {key: ''.join(data) for key, data in results.items()}
 
+    def cached_consensus_pulls(self, domain=None):
+        """
+        consensus_pulls, worked out once per domain for the epoch instead of
+        for every penalty vote.
+        """
+        if not domain:
+            domain, _ = Peer.my_node_data()
+        cache = caches['default']
+        key = "consensus-pulls-%s-%s" % (self.epoch, domain)
+        pulls = cache.get(key)
+        if pulls is None:
+            pulls = self.consensus_pulls(domain=domain)
+            cache.set(key, pulls, epoch_cache_timeout())
+        return pulls
+
     def consensus_pulls(self, domain=None):
         work = self.consensus_nodes(domain=domain)
         results = defaultdict(list)
         minihashes = self.calculate_mini_hashes()
 
         for minihash_index in range(5):
-            for node in work["minihash%s_pushed_from" % minihash_index]:
-                results[node.domain].append(minihashes[minihash_index])
+            for node_domain in work["minihash%s_pushed_from" % minihash_index]:
+                results[node_domain].append(minihashes[minihash_index])
 
         return dict(results)
 
@@ -295,20 +915,72 @@ class ValidatedRejection(models.Model):
     tx = models.ForeignKey("ValidatedTransaction")
     peer = models.ForeignKey("Peer")
 
+    class Meta:
+        unique_together = ('tx', 'peer')
+
     @classmethod
-    def validate_rejection_from_peer(self, peer, txid, signature):
+    def validate_rejection_from_peer(cls, peer, txid, signature):
+        """
+        Store a rejection made by a peer and queue it to be passed on.
+        Returns False when we already had it, or when we never saw the
+        transaction, in which case it is neither validated nor forwarded.
+        """
+        if cls.objects.filter(tx_id=txid, peer=peer).exists():
+            return False
+        tx = ValidatedTransaction.objects.filter(txid=txid).first()
+        if not tx:
+            return False
+
         validate_rejection_authorization(
             peer.domain, txid, signature, peer.payout_address
         )
-        tx,c = ValidatedTransaction.objects.get_or_create(txid=txid)
-        ValidatedRejection.objects.create(tx=tx, peer=node)
-        propagate_to_assigned_peers(rejection, type="rejections")
+        rejection, created = cls.objects.get_or_create(tx=tx, peer=peer)
+        if created:
+            rejection_batcher.add({
+                'domain': peer.domain, 'txid': txid, 'signature': signature
+            })
+        return created
+
+    @classmethod
+    def accept_batch(cls, batch):
+        """
+        A signed batch of rejections relayed by a peer. Rejections we already
+        have are skipped before any signature is checked, each new one is
+        still validated against the peer that made it, in it's own savepoint
+        so one bad rejection doesn't undo the rest of the batch. Returns how
+        many were new.
+        """
+        relay = Peer.objects.get(domain=batch['domain'])
+        if not ecdsa_verify(rejection_batch_message(batch), batch['signature'], relay.payout_address):
+            raise Exception("Invalid rejection batch signature from %s" % relay.domain)
+
+        known = set(cls.objects.filter(
+            tx_id__in=[x['txid'] for x in batch['rejections']]
+        ).values_list('tx_id', 'peer_id'))
+        peers = Peer.objects.in_bulk([x['domain'] for x in batch['rejections']])
+
+        accepted = 0
+        for rejection in batch['rejections']:
+            peer = peers.get(rejection['domain'])
+            if not peer or (rejection['txid'], peer.domain) in known:
+                continue
+            try:
+                with transaction.atomic():
+                    if cls.validate_rejection_from_peer(peer, rejection['txid'], rejection['signature']):
+                        accepted += 1
+            except (InvalidObject, RejectedObject, IntegrityError):
+                continue
+        return accepted
 
 
 class ValidatedTransaction(models.Model):
     txid = models.CharField(max_length=64, primary_key=True)
-    timestamp = models.DateTimeField()
+    timestamp = models.DateTimeField(db_index=True)
     applied = models.BooleanField(default=False)
+    folded = models.BooleanField(default=False)
+    staged_epoch = models.IntegerField(null=True, db_index=True)
+    input_amount = models.FloatField(default=0)
+    fee_amount = models.FloatField(default=0)
 
     @classmethod
     def variable_length_short_txid(cls, min_length=0):
@@ -334,38 +1006,68 @@ class ValidatedTransaction(models.Model):
 
     @classmethod
     def validate_raw_tx(cls, tx):
+        if settings.USE_MEMPOOL and tx['txid'] in mempool:
+            return
+        # the pool only holds unapplied transactions
         if ValidatedTransaction.objects.filter(txid=tx['txid']).exists():
             return
         try:
+            if settings.USE_MEMPOOL and mempool.conflicting_spends(tx):
+                raise RejectedObject("Conflicts with a pending spend")
             validate_transaction(tx, ledger=ledger)
+            cls.record(tx)
         except RejectedObject as exc:
-            reject = make_transaction_rejection(
-                tx, exc, Peer.my_node().as_dict(pk=True),
-                [x.as_dict() for x in Peer.object.all()]
-            )
-            propagate_to_assigned_peers(obj=reject, type="rejections")
+            my_domain, my_pk = Peer.my_node_data()
+            peers = Peer.dicts_for()
+            mine = [dict(x, private_key=my_pk) for x in peers if x['domain'] == my_domain]
+            if not mine:
+                raise Peer.DoesNotExist("%s is not a registered peer" % my_domain)
+            reject = make_transaction_rejection(tx, exc, mine[0], peers)
             cls.record(tx, as_reject=True)
+            rejection_batcher.add(reject)
             return
 
-        cls.record(tx)
         propagate_to_assigned_peers(obj=tx, type="transaction")
 
     @classmethod
     def record(cls, tx, as_reject=False):
+        """
+        Record a transaction, through the mempool when it's turned on (which
+        writes it to the database in the background).
+        """
         if 'txid' not in tx: tx['txid'] = make_txid(tx)
+        if settings.USE_MEMPOOL:
+            timestamp = dateutil.parser.parse(tx['timestamp']).replace(tzinfo=None)
+            mempool.add(tx, timestamp, as_reject=as_reject)
+        else:
+            cls.write(tx, as_reject=as_reject)
+
+    @classmethod
+    def write(cls, tx, as_reject=False):
+        input_amount = sum(amount for address, amount, sig in tx['inputs'])
+        output_amount = sum(amount for address, amount in tx['outputs'])
         obj = cls.objects.create(
             txid=tx['txid'],
-            timestamp=dateutil.parser.parse(tx['timestamp']).replace(tzinfo=None)
+            timestamp=dateutil.parser.parse(tx['timestamp']).replace(tzinfo=None),
+            input_amount=input_amount,
+            fee_amount=float("%.8f" % (input_amount - output_amount))
         )
-        for address, amount, sig in tx['inputs']:
-            ValidatedMovement.objects.create(
-                tx=obj, address=address, amount=(amount * -1)
-            )
-
-        for address, amount in tx['outputs']:
-            ValidatedMovement.objects.create(
-                tx=obj, address=address, amount=amount
-            )
+        # the transaction's epoch, timestamp and fee are copied onto each
+        # movement so address history needs no join
+        copied = {
+            'epoch': get_epoch_number(obj.timestamp),
+            'tx_timestamp': obj.timestamp,
+            'tx_fee': obj.fee_amount,
+        }
+        movements = [
+            ValidatedMovement(tx=obj, address=address, amount=(amount * -1), **copied)
+            for address, amount, sig in tx['inputs']
+        ]
+        movements += [
+            ValidatedMovement(tx=obj, address=address, amount=amount, **copied)
+            for address, amount in tx['outputs']
+        ]
+        ValidatedMovement.objects.bulk_create(movements)
 
         if as_reject:
             ValidatedRejection.objects.create(tx=obj, peer=Peer.my_node())
@@ -375,45 +1077,114 @@ class ValidatedTransaction(models.Model):
 
     @classmethod
     def filter_for_epoch(cls, epoch=None):
-        return cls.objects.filter(**filter_for_epoch())
+        return cls.objects.filter(**filter_for_epoch(epoch))
 
     def epoch(self):
         return get_epoch_number(self.timestamp)
 
-    def rejected_reputation_percent(self):
-        rejects = ValidatedRejection.objects.filter(tx=self)
-        total_percentile = 0
-        for r in rejects:
-            total_percentile += r.peer.rep_percent()
-        return total_percentile
+    def rejected_reputation_percent(self, ranking=None):
+        """
+        Percent of all reputation held by the peers that rejected this
+        transaction. When doing this for many transactions, prefetch
+        validatedrejection_set and pass in Peer.ranking() keyed by domain.
+        """
+        if ranking is None:
+            ranking = {x['domain']: x for x in Peer.ranking()}
+        return sum(
+            ranking[r.peer_id]['percent'] for r in self.validatedrejection_set.all()
+            if r.peer_id in ranking
+        )
 
     def fee(self):
-        fee = 0
-        for m in self.validatedmovement_set.all():
-            fee += m.amount * -1
-        return float("%.8f" % fee)
+        return self.fee_amount
+
+    @classmethod
+    def fold(cls, epoch=None, until=None):
+        """
+        Stage the movements of transactions not folded yet into
+        StagedLedgerDelta, leaving the ledger itself untouched. Called in
+        the background during the epoch (see the foldledger command) with
+        until set to the end of the propagation window, so that the work
+        left for close_epoch is small. Returns how many transactions were
+        folded.
+        """
+        txs = cls.objects.filter(folded=False, applied=False)
+        if epoch:
+            txs = txs.filter(**filter_for_epoch(epoch))
+        if until:
+            txs = txs.filter(timestamp__lte=until)
+        txids = txs.order_by('txid').values_list('txid', 'timestamp')
+
+        folded = 0
+        last_txid = ''
+        while True:
+            # one chunk of txids at a time, so memory doesn't grow with the epoch
+            chunk = list(txids.filter(txid__gt=last_txid)[:FOLD_CHUNK_SIZE])
+            if not chunk:
+                break
+            last_txid = chunk[-1][0]
+            with transaction.atomic():
+                # epochs are locked in order, before any transaction row, so
+                # a folder and close_epoch can't deadlock
+                targets = {}
+                for tx_epoch in sorted(set(get_epoch_number(ts) for txid, ts in chunk)):
+                    targets[tx_epoch] = LedgerEpoch.open_epoch(tx_epoch)
+
+                # claiming the rows first means two folders running at once
+                # can't stage the same transaction twice, rows another folder
+                # already claimed are left out
+                claimed = list(cls.objects.select_for_update().filter(
+                    txid__in=[txid for txid, ts in chunk], folded=False
+                ).values_list('txid', 'timestamp'))
+                if not claimed:
+                    continue
+                staged = defaultdict(list)
+                for txid, timestamp in claimed:
+                    staged[targets[get_epoch_number(timestamp)]].append(txid)
+                for staged_epoch, staged_txids in staged.items():
+                    cls.objects.filter(txid__in=staged_txids).update(
+                        folded=True, staged_epoch=staged_epoch
+                    )
+
+                totals = defaultdict(dict)
+                movements = ValidatedMovement.objects.filter(
+                    tx__in=[txid for txid, ts in claimed]
+                ).values_list('address', 'amount', 'tx__timestamp')
+                for address, amount, timestamp in movements.iterator():
+                    by_address = totals[targets[get_epoch_number(timestamp)]]
+                    total, last_updated = by_address.get(address, (0, timestamp))
+                    by_address[address] = (total + amount, max(last_updated, timestamp))
+
+                for staged_epoch, by_address in totals.items():
+                    StagedLedgerDelta.stage(staged_epoch, by_address)
+            folded += len(claimed)
+        return folded
 
     @classmethod
     def apply_to_ledger(cls, epoch):
         """
-        Called at the begining of end of each epoch. Applies all valid
-        transactions into the LedgerEntry table.
+        Called at the begining of end of each epoch. Folds whatever
+        transactions are left and commits the epoch's staged deltas into
+        the LedgerEntry table. Only the transactions staged into this epoch
+        are marked applied, ones folded late into a later epoch are applied
+        when that one closes.
         """
-        movements = ValidatedMovement.objects.filter(
-            tx__in=cls.filter_for_epoch(epoch)
-        )
-        for movement in movements:
-            try:
-                le = LedgerEntry.objects.get(address=movement.address)
-                le.amount=le.amount + movement.amount
-                le.last_updated=movement.tx.timestamp
-                le.save()
-            except LedgerEntry.DoesNotExist:
-                LedgerEntry.objects.create(
-                    address=movement.address,
-                    amount=movement.amount,
-                    last_updated=movement.tx.timestamp
-                )
+        processes = settings.LEDGER_APPLY_PROCESSES
+        sharded = processes > 1 and not connection.in_atomic_block
+        with transaction.atomic():
+            LedgerEpoch.lock(epoch)
+            while cls.fold(epoch=epoch):
+                pass
+            LedgerEpoch.objects.filter(epoch=epoch).update(closed=True)
+            if not sharded:
+                StagedLedgerDelta.commit(epoch)
+                cls.objects.filter(staged_epoch=epoch).update(applied=True)
+                return
+        StagedLedgerDelta.commit_sharded(epoch, processes)
+        ledger_store.reset() # the shards updated their own copies
+        # a crash before this leaves nothing staged, the next run only
+        # marks them applied
+        cls.objects.filter(staged_epoch=epoch).update(applied=True)
 
 class ValidatedMovement(models.Model):
     """
@@ -423,6 +1194,12 @@ class ValidatedMovement(models.Model):
     tx = models.ForeignKey(ValidatedTransaction)
     address = models.CharField(max_length=35)
     amount = models.FloatField()
+    epoch = models.IntegerField(default=0)
+    tx_timestamp = models.DateTimeField(null=True)
+    tx_fee = models.FloatField(default=0)
+
+    class Meta:
+        index_together = [('address', 'epoch')]
 
     @property
     def disp_amount(self):
@@ -438,7 +1215,7 @@ class ValidatedMovement(models.Model):
     def adjusted_balance(cls, address, epoch=None):
         #d = timestamp - datetime.timedelta(seconds=PROPAGATION_WINDOW_SECONDS)
         movements_this_epoch = cls.objects.filter(
-            address=address,
+            address=address, tx__applied=False,
             #**filter_for_epoch(epoch=epoch, prefix='tx__')
         )
         total_adjusted = 0
@@ -447,6 +1224,42 @@ class ValidatedMovement(models.Model):
 
         return total_adjusted
 
+    @classmethod
+    def history(cls, address, cursor=None, limit=100):
+        """
+        Movements for an address, newest first, read straight off the
+        (address, epoch) index. cursor is the next_cursor from the previous
+        page. Returns (rows, next_cursor), next_cursor is None on the last
+        page.
+        """
+        movements = cls.objects.filter(address=address)
+        if cursor:
+            epoch, id = cursor
+            movements = movements.filter(
+                models.Q(epoch__lt=epoch) | models.Q(epoch=epoch, id__lt=id)
+            )
+        rows = list(movements.order_by('-epoch', '-id').values_list(
+            'id', 'tx_id', 'amount', 'epoch', 'tx_timestamp', 'tx_fee'
+        )[:limit + 1])
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = (rows[-1][3], rows[-1][0])
+        return [row[1:] for row in rows], next_cursor
+
+    @classmethod
+    def adjusted_balances(cls, addresses):
+        """
+        Same as adjusted_balance, but for many addresses in one grouped query.
+        """
+        totals = cls.objects.filter(
+            address__in=addresses, tx__applied=False
+        ).values('address').annotate(
+            total=models.Sum('amount')
+        ).order_by()
+        return {x['address']: x['total'] for x in totals}
+
 class EpochHash(models.Model):
     epoch = models.IntegerField()
     peer = models.ForeignKey(Peer)
@@ -469,6 +1282,14 @@ class EpochHash(models.Model):
             signature=sig
         )
 
+    @classmethod
+    def accept_push(cls, obj):
+        """
+        Validate and store an EpochHashPush object received from a peer.
+        """
+        peer = Peer.objects.get(domain=obj['from_domain'])
+        return cls.save_push(peer, obj['epoch'], obj['hashes'], obj['signature'])
+
     def as_dict(self):
         return {
             'epoch': self.epoch,
@@ -506,32 +1327,109 @@ class NodePenaltyVote(models.Model):
     penalized_peer = models.ForeignKey(Peer, related_name="penalization_subject")
     vote_for = models.BooleanField(default=False)
     voting_peer = models.ForeignKey(Peer, related_name="penalization_vote")
+    received = models.DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        unique_together = ('epoch', 'penalized_peer', 'voting_peer')
+
+    @staticmethod
+    def voting_closes(epoch):
+        """
+        Pushes for an epoch are made and checked at the start of the next
+        one, the votes on them are taken until that next epoch ends.
+        """
+        return get_epoch_range(epoch + 1)[1]
 
     @classmethod
     def make_vote(cls, penalty_obj):
         """
-        penalty_obj is the object that is returned from NodePenaltyVote.make from
-        staeonlib.
+        penalty_obj is the object that is returned from NodePenalization.make from
+        staeonlib. Votes are counted once the epoch is over, see tally.
         """
-        correct_hash = penalty['correct_hash']
+        correct_hash = penalty_obj['correct_hash']
         to_domain = penalty_obj['push']['to_domain']
         from_domain = penalty_obj['push']['from_domain']
         epoch = penalty_obj['push']['epoch']
+        if datetime.datetime.now() >= cls.voting_closes(epoch):
+            raise RejectedObject("Voting on epoch %s is closed" % epoch)
         es = EpochSummary.objects.get(epoch=epoch)
-        pushes = es.consensus_pulls(domain=to_domain)
-
-        accusee = Peer.objects.get(domain=from_domain)
-        accuser = Peer.objects.get(domain=to_domain)
-        penalty = NodePenalization(obj, accuser.payout_address).validate(
+        pulls = es.cached_consensus_pulls(domain=to_domain)
+
+        peers = Peer.objects.in_bulk([from_domain, to_domain])
+        if from_domain not in peers or to_domain not in peers:
+            raise InvalidObject("Penalty between unknown peers")
+        accusee = peers[from_domain]
+        accuser = peers[to_domain]
+        NodePenalization(penalty_obj, accuser.payout_address).validate(
             accusee.payout_address
         )
 
         vote_for = (
-            from_domain not in pushes.keys() or
-            correct_hash not in pushes[from_domain]
+            from_domain not in pulls.keys() or
+            correct_hash not in pulls[from_domain]
         )
 
-        return cls.objects.create(
-            voting_peer=accuser, vote_for=vote_for,
-            penalized_peer=accusee, epoch=epoch
+        vote, created = cls.objects.get_or_create(
+            voting_peer=accuser, penalized_peer=accusee, epoch=es,
+            defaults={'vote_for': vote_for}
         )
+        return vote
+
+    @classmethod
+    def tally(cls, epoch):
+        """
+        Count the votes cast on an epoch in one grouped query, each vote
+        weighted by the voter's reputation. Every peer that the majority
+        voted to penalize has it's reputation cut by one bulk update, then
+        the ranking is rebuilt once. Only runs once per epoch. Returns the
+        penalized domains.
+
+        Every node has to penalize the same peers, so only votes received
+        before voting_closes, from peers registered before the epoch ended,
+        are counted, and make_vote turns later ones away. The tally is run at
+        the start of the epoch after that, before close_epoch, so every
+        node weighs the votes by the same reputations. Nodes still only
+        agree when they received the same votes in time; the votes aren't
+        part of the epoch hash, so a node that missed some isn't caught by
+        consensus, it's reputations drift from the rest until it resyncs
+        the peer table.
+        """
+        with transaction.atomic():
+            claimed = EpochSummary.objects.filter(
+                epoch=epoch, votes_tallied=False
+            ).update(votes_tallied=True)
+            if not claimed:
+                return []
+
+            def voting_rep(vote_for):
+                return models.Sum(models.Case(
+                    models.When(vote_for=vote_for, then=models.F('voting_peer__reputation')),
+                    default=0, output_field=models.FloatField()
+                ))
+
+            votes = cls.objects.filter(
+                epoch_id=epoch, received__lt=cls.voting_closes(epoch),
+                voting_peer__first_registered__lt=get_epoch_range(epoch)[1]
+            )
+            totals = votes.values('penalized_peer').annotate(
+                rep_for=voting_rep(True), rep_against=voting_rep(False)
+            ).order_by()
+            penalized = sorted(
+                x['penalized_peer'] for x in totals if x['rep_for'] > x['rep_against']
+            )
+            if penalized:
+                Peer.objects.filter(domain__in=penalized).update(
+                    reputation=models.F('reputation') * settings.PENALTY_REPUTATION_FACTOR,
+                    last_modified=datetime.datetime.now()
+                )
+
+        if penalized:
+            # bulk updates don't send the signals that would do this
+            Peer.peers_changed()
+            Peer.rebuild_ranking()
+        return penalized
+
+@receiver(post_save, sender=Peer)
+@receiver(post_delete, sender=Peer)
+def invalidate_peer_caches(sender, **kwargs):
+    Peer.peers_changed()
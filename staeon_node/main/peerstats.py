@@ -0,0 +1,222 @@
+"""
+Performance of every peer we make HTTP calls to, and a circuit breaker per
+peer. All outbound calls go through request(), which times the call and
+records latency, errors and throughput as moving averages.
+
+After PEER_BREAKER_FAILURES failures in a row a peer's circuit opens and
+calls to it fail right away with CircuitOpen, without touching the network,
+for PEER_BREAKER_SECONDS (doubling every time it opens again, up to
+PEER_BREAKER_MAX_SECONDS). Then one trial call is let through, which closes
+it again if it succeeds.
+
+Stats are kept in memory and written to PeerPerformance, so short lived
+processes like syncledger can use what the web workers learned to pick the
+fastest peers. They are never written during a call: web workers write them
+after a request is finished and the epoch scheduler between steps, each at
+most every PEER_STATS_FLUSH_SECONDS, and commands when they exit. At the
+same points, and as often, what other processes wrote is read back in for
+every peer this one has nothing newer about.
+"""
+import time
+import atexit
+import datetime
+import threading
+
+import requests
+from django.conf import settings
+from django.core.signals import request_finished
+from django.utils.six.moves.urllib.parse import urlparse
+
+ALPHA = 0.2 # weight of the newest sample in the moving averages
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    pass
+
+class Stats(object):
+    def __init__(self, latency=None, error_rate=0.0, throughput=None, calls=0,
+                 failures=0, open_until=0, opened=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throughput = throughput
+        self.calls = calls
+        self.failures = failures # in a row
+        self.open_until = open_until
+        self.opened = opened # times opened in a row, for the backoff
+        self.trial = False
+
+    def score(self):
+        """
+        Lower is better. Peers we know nothing about are taken to answer
+        in half the sync timeout.
+        """
+        latency = self.latency if self.latency is not None else settings.PEER_SYNC_TIMEOUT / 2.0
+        return latency * (1 + 4 * self.error_rate)
+
+def average(old, new):
+    return new if old is None else old + ALPHA * (new - old)
+
+class PeerStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.dirty = set()
+        self.loaded = False
+        self.flushed = self.reloaded = time.time()
+
+    def _read(self):
+        from .models import PeerPerformance
+        return list(PeerPerformance.objects.all())
+
+    def _merge(self, rows):
+        """
+        Take the stats in rows, except for peers with calls recorded here
+        that haven't been flushed yet. The backoff and trial are this
+        process's own.
+        """
+        for perf in rows:
+            if perf.domain in self.dirty:
+                continue
+            stats = self.stats.setdefault(perf.domain, Stats())
+            stats.latency = perf.latency
+            stats.error_rate = perf.error_rate
+            stats.throughput = perf.throughput
+            stats.calls = perf.calls
+            stats.failures = perf.failures
+            stats.open_until = time.mktime(perf.open_until.timetuple()) if perf.open_until else 0
+            if not stats.open_until:
+                stats.opened = 0
+
+    def _load(self):
+        self._merge(self._read())
+        self.loaded = True
+
+    def reload(self):
+        """
+        Read in what other processes have flushed.
+        """
+        rows = self._read()
+        with self.lock:
+            self.reloaded = time.time()
+            self._merge(rows)
+            self.loaded = True
+
+    def get(self, domain):
+        with self.lock:
+            if not self.loaded:
+                self._load()
+            return self.stats.setdefault(domain, Stats())
+
+    def allow(self, domain):
+        """
+        False while the peer's circuit is open. Once it's due, only one
+        caller at a time gets to try it.
+        """
+        stats = self.get(domain)
+        with self.lock:
+            if not stats.open_until:
+                return True
+            if time.time() < stats.open_until or stats.trial:
+                return False
+            stats.trial = True
+            return True
+
+    def is_open(self, domain):
+        """
+        Like not allow(), without claiming the trial call.
+        """
+        stats = self.get(domain)
+        return time.time() < stats.open_until or stats.trial
+
+    def available(self, domains):
+        return [domain for domain in domains if not self.is_open(domain)]
+
+    def record(self, domain, seconds, ok, size=0):
+        stats = self.get(domain)
+        with self.lock:
+            stats.calls += 1
+            stats.error_rate = average(stats.error_rate, 0.0 if ok else 1.0)
+            stats.trial = False
+            if ok:
+                stats.latency = average(stats.latency, seconds)
+                if size and seconds > 0:
+                    stats.throughput = average(stats.throughput, size / seconds)
+                stats.failures = stats.opened = stats.open_until = 0
+            else:
+                stats.failures += 1
+                if stats.open_until or stats.failures >= settings.PEER_BREAKER_FAILURES:
+                    backoff = settings.PEER_BREAKER_SECONDS * 2 ** stats.opened
+                    stats.open_until = time.time() + min(backoff, settings.PEER_BREAKER_MAX_SECONDS)
+                    stats.opened += 1
+            self.dirty.add(domain)
+
+    def end_trial(self, domain):
+        stats = self.get(domain)
+        with self.lock:
+            stats.trial = False
+
+    def rank(self, domains):
+        """
+        The domains that aren't failing, fastest first.
+        """
+        return sorted(self.available(domains), key=lambda domain: self.get(domain).score())
+
+    def flush_if_due(self, **kwargs):
+        """
+        flush() if there's something to write and the last one was at least
+        PEER_STATS_FLUSH_SECONDS ago, and reload() as often. Takes signal
+        arguments.
+        """
+        now = time.time()
+        if self.dirty and now - self.flushed >= settings.PEER_STATS_FLUSH_SECONDS:
+            self.flush()
+        if self.loaded and now - self.reloaded >= settings.PEER_STATS_FLUSH_SECONDS:
+            self.reload()
+
+    def flush(self):
+        from .models import PeerPerformance
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+            self.flushed = time.time()
+            rows = [(domain, self.stats[domain]) for domain in dirty]
+        for domain, stats in rows:
+            PeerPerformance.objects.update_or_create(domain=domain, defaults={
+                'latency': stats.latency,
+                'error_rate': stats.error_rate,
+                'throughput': stats.throughput,
+                'calls': stats.calls,
+                'failures': stats.failures,
+                'open_until': (
+                    datetime.datetime.fromtimestamp(stats.open_until)
+                    if stats.open_until else None
+                ),
+            })
+
+peer_stats = PeerStats()
+request_finished.connect(peer_stats.flush_if_due, dispatch_uid="peer-stats-flush")
+atexit.register(peer_stats.flush)
+
+def request(method, url, **kwargs):
+    """
+    requests.request, timed and recorded against the url's domain. Raises
+    CircuitOpen instead of calling a peer that's failing.
+    """
+    domain = urlparse(url).netloc
+    if not peer_stats.allow(domain):
+        raise CircuitOpen("%s is failing, not calling it" % domain)
+    start = time.time()
+    try:
+        response = requests.request(method, url, **kwargs)
+        # a 304 is a success, anything 500 and up means the peer is in
+        # trouble, except a 503 with Retry-After: that peer is up, just busy
+        busy = response.status_code == 503 and 'Retry-After' in response.headers
+        peer_stats.record(
+            domain, time.time() - start, ok=response.status_code < 500 or busy,
+            size=len(response.content)
+        )
+    except requests.exceptions.RequestException:
+        peer_stats.record(domain, time.time() - start, ok=False)
+        raise
+    finally:
+        # whatever else went wrong, the trial call (if this was it) is over
+        peer_stats.end_trial(domain)
+    return response
@@ -0,0 +1,153 @@
+"""
+Opt-in sampling profiler for views and management commands. Off unless
+PROFILE_DIR is set, and then only for the names in PROFILE_TARGETS, so when
+it's off a profiled view costs one settings lookup.
+
+While a profiled call runs, a thread samples it's stack every
+PROFILE_INTERVAL seconds. The samples are written in the folded format
+flamegraph.pl and speedscope read ("outer;inner;innermost count" per line),
+to PROFILE_DIR/epoch-<epoch>/<name>-<time>-<pid>.folded, and a line about it
+is logged to the main.profiling logger. On Python 3, with PROFILE_TRACEMALLOC
+on, a tracemalloc snapshot of the call is dumped next to it as .tracemalloc
+(load it with tracemalloc.Snapshot.load). Python 2.7 has no tracemalloc, so
+there only the stacks are saved.
+
+Commands are profiled every time they run, views only for a
+PROFILE_REQUEST_RATE fraction of requests.
+"""
+import os
+import sys
+import time
+import random
+import logging
+import datetime
+import threading
+import functools
+from collections import Counter
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from staeon.consensus import get_epoch_number
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+logger = logging.getLogger(__name__)
+
+_tracing = {'users': 0}
+_tracing_lock = threading.Lock()
+
+def enabled(name):
+    return bool(settings.PROFILE_DIR) and name in settings.PROFILE_TARGETS
+
+def frame_name(frame):
+    code = frame.f_code
+    return "%s (%s)" % (code.co_name, os.path.basename(code.co_filename))
+
+class Sampler(object):
+    """
+    Counts the stacks of one thread, sampled from another.
+    """
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="profiler")
+        self.thread.daemon = True
+
+    def _run(self):
+        while not self.done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+
+def _start_tracemalloc():
+    if not (tracemalloc and settings.PROFILE_TRACEMALLOC):
+        return False
+    with _tracing_lock:
+        if not _tracing['users'] and not tracemalloc.is_tracing():
+            tracemalloc.start(settings.PROFILE_TRACEMALLOC_FRAMES)
+        _tracing['users'] += 1
+    return True
+
+def _stop_tracemalloc(path):
+    snapshot = tracemalloc.take_snapshot()
+    with _tracing_lock:
+        _tracing['users'] -= 1
+        if not _tracing['users']:
+            tracemalloc.stop()
+    snapshot.dump(path)
+
+def _output_path(name, epoch):
+    directory = os.path.join(settings.PROFILE_DIR, "epoch-%s" % epoch)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass # made by another process in the meantime
+    return os.path.join(directory, "%s-%s-%s" % (
+        name, datetime.datetime.now().strftime("%H%M%S.%f"), os.getpid()
+    ))
+
+@contextmanager
+def profile(name):
+    """
+    Profile the block under this name, if it's one of PROFILE_TARGETS.
+    """
+    if not enabled(name):
+        yield
+        return
+
+    epoch = get_epoch_number()
+    sampler = Sampler(threading.current_thread().ident, settings.PROFILE_INTERVAL)
+    tracing = _start_tracemalloc()
+    sampler.start()
+    start = time.time()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        path = _output_path(name, epoch)
+        try:
+            if tracing:
+                _stop_tracemalloc(path + ".tracemalloc")
+            with open(path + ".folded", 'w') as f:
+                for stack, count in sampler.stacks.most_common():
+                    f.write("%s %d\n" % (stack, count))
+        except (IOError, OSError) as exc:
+            logger.warning("could not write %s: %s", path, exc)
+        else:
+            logger.info(
+                "%s took %.3fs, %s samples in %s.folded",
+                name, time.time() - start, sum(sampler.stacks.values()), path
+            )
+
+def profiled(name, sample=False):
+    """
+    Decorator for views (sample=True, profiles PROFILE_REQUEST_RATE of the
+    requests) and command handle methods.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled(name) or (sample and random.random() >= settings.PROFILE_REQUEST_RATE):
+                return func(*args, **kwargs)
+            with profile(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,118 @@
+"""
+Resident epoch scheduler, instead of running consensus_step1/consensus_step2
+from cron. Each step fires at a fixed offset from the start of the epoch as
+given by get_epoch_range, not at cron's minute granularity, and the process
+stays up between epochs so the peer ranking, shuffle matrix and prop domains
+stay cached. While waiting it keeps folding the ledger, so close_epoch only
+has the last few seconds of transactions left to do.
+"""
+from __future__ import print_function
+
+import sys
+import time
+import datetime
+import traceback
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from staeon.consensus import get_epoch_number, get_epoch_range
+from staeon.network import PROPAGATION_WINDOW_SECONDS
+
+from .models import Peer, EpochSummary, LedgerBucket, ValidatedTransaction
+from .consensus import push_epoch_hashes, check_epoch_hashes
+from .peerstats import peer_stats
+from .profiling import profile
+
+class EpochScheduler(object):
+    def __init__(self, node=None, out=None):
+        self.node = node or Peer.my_node()
+        self.out = out or sys.stdout
+        self.step1_delay = datetime.timedelta(seconds=(
+            PROPAGATION_WINDOW_SECONDS if settings.EPOCH_STEP1_DELAY is None
+            else settings.EPOCH_STEP1_DELAY
+        ))
+        self.step2_delay = datetime.timedelta(seconds=settings.EPOCH_STEP2_DELAY)
+
+    def log(self, message):
+        print("[%s] %s" % (datetime.datetime.now().isoformat(), message), file=self.out)
+
+    def run_forever(self):
+        epoch = get_epoch_number()
+        if EpochSummary.objects.filter(epoch=epoch - 1).exists():
+            epoch += 1 # the last epoch is already closed, wait for the next
+        while True:
+            self.run_epoch(epoch)
+            epoch += 1
+
+    def run_epoch(self, epoch):
+        """
+        Close the epoch before this one and run both consensus steps for it,
+        timed from the start of this one.
+        """
+        start, end = get_epoch_range(epoch)
+        closing = epoch - 1
+
+        step1_at = start + self.step1_delay
+        self.wait_until(step1_at)
+        lag = datetime.datetime.now() - step1_at
+        t0 = datetime.datetime.now()
+        if not self.run_step("consensus_step1", push_epoch_hashes, closing):
+            return
+        EpochSummary.objects.filter(epoch=closing).update(
+            step1_lag=lag, step1_duration=datetime.datetime.now() - t0
+        )
+        self.log("epoch %s closed, step 1 started %.3fs late" % (closing, lag.total_seconds()))
+
+        self.wait_until(start + self.step2_delay)
+        t0 = datetime.datetime.now()
+        result = self.run_step("consensus_step2", check_epoch_hashes, closing)
+        if result:
+            not_present, wrong, penalties = result
+            EpochSummary.objects.filter(epoch=closing).update(
+                step2_duration=datetime.datetime.now() - t0
+            )
+            self.log("epoch %s step 2: %s not present, %s wrong" % (
+                closing, len(not_present), len(wrong)
+            ))
+
+        self.warm()
+
+    def run_step(self, name, step, epoch):
+        close_old_connections()
+        try:
+            with profile(name):
+                return step(self.node, epoch) or True
+        except Exception:
+            self.log("epoch %s %s failed:\n%s" % (epoch, name, traceback.format_exc()))
+            return None
+        finally:
+            peer_stats.flush_if_due()
+
+    def wait_until(self, when):
+        """
+        Sleep until the given time, folding the ledger in the meantime as
+        long as that can't make us late.
+        """
+        fold_every = settings.LEDGER_FOLD_SECONDS
+        while True:
+            remaining = (when - datetime.datetime.now()).total_seconds()
+            if remaining <= 0:
+                return
+            if remaining > fold_every:
+                close_old_connections()
+                ValidatedTransaction.fold(until=datetime.datetime.now() - datetime.timedelta(
+                    seconds=PROPAGATION_WINDOW_SECONDS
+                ))
+                peer_stats.flush_if_due()
+                remaining = (when - datetime.datetime.now()).total_seconds()
+            time.sleep(max(min(remaining, fold_every), 0))
+
+    def warm(self):
+        """
+        Fill the caches the next epoch's traffic will need.
+        """
+        close_old_connections()
+        Peer.ranking()
+        EpochSummary.prop_domains()
+        LedgerBucket.tree()
@@ -0,0 +1,344 @@
+"""
+Runs many logical nodes in one process (or a process pool) to see how the
+gossip and consensus protocol behaves at scale without deploying anything.
+
+Every simulated node gets it's own sqlite database (copied from a migrated
+template), it's own cache, and it's own identity. NodeRouter sends all
+queries to the database of whichever node is active, and InMemoryTransport
+collects outbound messages instead of POSTing them. The coordinator then
+delivers those messages with simulated latency and loss, one tick at a time,
+and drives close_epoch, step 1 and step 2 across all nodes.
+"""
+from __future__ import print_function
+
+import os
+import time
+import heapq
+import random
+import shutil
+import hashlib
+import datetime
+import tempfile
+import threading
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+from multiprocessing import Pool
+
+from bitcoin import random_key, encode_privkey, privtoaddr
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.db import connections, router
+
+from staeon.consensus import get_epoch_number
+from staeon.transaction import make_transaction
+
+from .models import Peer, LedgerEntry, LedgerBucket, EpochSummary
+from .consensus import push_epoch_hashes, check_epoch_hashes
+from .batching import rejection_batcher
+from .statetree import bucket_for
+from . import transport
+
+cpu_time = getattr(time, 'process_time', None) or time.clock
+
+_active = threading.local()
+
+class SimulatedNode(object):
+    def __init__(self, index, workdir):
+        self.domain = "node%04d.sim" % index
+        self.private_key = encode_privkey(random_key(), 'wif_compressed')
+        self.payout_address = privtoaddr(self.private_key)
+        self.alias = "sim-%04d" % index
+        self.db_path = os.path.join(workdir, "%s.sqlite3" % self.alias)
+
+class NodeRouter(object):
+    """
+    Sends every query to the database of the active simulated node.
+    """
+    def db_for_read(self, model, **hints):
+        return getattr(_active, 'alias', None)
+
+    def db_for_write(self, model, **hints):
+        return getattr(_active, 'alias', None)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+def _add_database(alias, path):
+    if alias not in connections.databases:
+        connections.databases[alias] = {
+            'ENGINE': 'django.db.backends.sqlite3', 'NAME': path
+        }
+
+@contextmanager
+def activate(alias, cache_name=None, domain=None, private_key=None):
+    """
+    Act as a node: route queries to it's database, use it's cache and
+    identity. Django keeps caches per thread, so the node's cache is
+    swapped into the current thread's cache table.
+    """
+    caches['default'] # makes sure this thread's cache table exists
+    previous_cache = caches._caches.caches['default']
+    _active.alias = alias
+    caches._caches.caches['default'] = LocMemCache(cache_name or alias, {})
+    Peer.set_node_identity(domain, private_key)
+    try:
+        yield
+    finally:
+        _active.alias = None
+        caches._caches.caches['default'] = previous_cache
+        Peer.set_node_identity()
+
+class InMemoryTransport(object):
+    """
+    Stand in for HTTPTransport. Messages are held in an outbox until the
+    coordinator picks them up and schedules their delivery.
+    """
+    def __init__(self):
+        self.outbox = []
+
+    def propagate(self, domains, obj, type):
+        sender, _ = Peer.my_node_data()
+        for domain in domains:
+            self.outbox.append((sender, domain, type, obj))
+
+    def collect(self):
+        outbox, self.outbox = self.outbox, []
+        return outbox
+
+def run_node(task):
+    """
+    Runs one unit of work as one node. Module level so it can be sent to a
+    process pool. Returns the node's domain, the CPU seconds used, the
+    messages it sent and the result of the work.
+    """
+    node, phase, payload = task
+    _add_database(node.alias, node.db_path)
+    with activate(node.alias, domain=node.domain, private_key=node.private_key):
+        start = cpu_time()
+        if phase == 'deliver':
+            result = Counter()
+            for type, obj in payload:
+                try:
+                    transport.handle_message(type, obj)
+                    result['processed'] += 1
+                except Exception:
+                    result['failed'] += 1
+        elif phase == 'step1':
+            result = push_epoch_hashes(node, payload).epoch_seed
+        elif phase == 'step2':
+            not_present, wrong, penalties = check_epoch_hashes(node, payload)
+            result = (len(not_present), len(wrong))
+        # one rejection window per node per tick
+        rejection_batcher.flush()
+        cpu = cpu_time() - start
+        outbox = transport.get_transport().collect()
+    connections[node.alias].close()
+    return node.domain, cpu, outbox, result
+
+class Simulation(object):
+    def __init__(self, node_count, latency=50, jitter=20, loss=0.0, tick=10,
+                 processes=0, seed=None, workdir=None):
+        """
+        latency, jitter and tick are in milliseconds, loss is the chance from
+        0 to 1 that any single message is dropped.
+        """
+        self.node_count = node_count
+        self.latency = latency / 1000.0
+        self.jitter = jitter / 1000.0
+        self.loss = loss
+        self.tick = tick / 1000.0
+        self.processes = processes
+        self.random = random.Random(seed)
+        self.workdir = workdir or tempfile.mkdtemp(prefix="staeon-sim-")
+
+        self.pool = None
+        self.nodes = []
+        self.queue = []
+        self.clock = 0
+        self.busy_until = defaultdict(float)
+        self.sent = Counter()
+        self.delivered = Counter()
+        self.dropped = Counter()
+        self.cpu = defaultdict(lambda: defaultdict(float))
+        self.last_delivery = {}
+        self._sequence = 0
+
+    def setup(self, transactions=0):
+        """
+        Migrate one template database, fill it with the shared starting state
+        (peers, a genesis epoch, funded addresses) and copy it for every node.
+        Returns the pre-signed transactions to inject.
+        """
+        self.nodes = [SimulatedNode(i, self.workdir) for i in range(self.node_count)]
+        self.by_domain = {node.domain: node for node in self.nodes}
+        self.epoch = get_epoch_number()
+
+        template = os.path.join(self.workdir, "template.sqlite3")
+        _add_database("sim-template", template)
+        call_command('migrate', database="sim-template", interactive=False, verbosity=0)
+
+        now = datetime.datetime.now()
+        txs = []
+        with activate("sim-template"):
+            Peer.objects.bulk_create([
+                Peer(
+                    domain=node.domain, payout_address=node.payout_address,
+                    reputation=self.random.random() * 100,
+                    first_registered=now - datetime.timedelta(minutes=i)
+                ) for i, node in enumerate(self.nodes)
+            ])
+            EpochSummary.objects.create(
+                epoch=self.epoch - 1,
+                epoch_seed=hashlib.sha256(str(self.epoch)).hexdigest(),
+                count_duration=datetime.timedelta(0),
+                apply_duration=datetime.timedelta(0),
+                seed_duration=datetime.timedelta(0),
+            )
+
+            entries = []
+            for i in range(transactions):
+                tx, entry = self._make_funded_tx(now)
+                txs.append(tx)
+                entries.append(entry)
+            LedgerEntry.objects.bulk_create(entries)
+            LedgerBucket.rebuild()
+        connections["sim-template"].close()
+
+        for node in self.nodes:
+            shutil.copy(template, node.db_path)
+            _add_database(node.alias, node.db_path)
+        return txs
+
+    def _make_funded_tx(self, now, fee=0.01):
+        spend_priv = encode_privkey(random_key(), 'wif_compressed')
+        spend_addr = privtoaddr(spend_priv)
+        receive_addr = privtoaddr(random_key())
+        amount = float("%.8f" % (self.random.random() * 5 + 0.1))
+        tx = make_transaction(
+            [[spend_addr, amount, spend_priv]],
+            [[receive_addr, float("%.8f" % (amount - fee))]]
+        )
+        entry = LedgerEntry(
+            address=spend_addr, amount=amount, bucket=bucket_for(spend_addr),
+            last_updated=now - datetime.timedelta(hours=1)
+        )
+        return tx, entry
+
+    def send(self, sender, domain, type, obj, at):
+        self.sent[type] += 1
+        if self.random.random() < self.loss:
+            self.dropped[type] += 1
+            return
+        delay = max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0)
+        self._sequence += 1
+        heapq.heappush(self.queue, (at + delay, self._sequence, domain, type, obj))
+
+    def _run_tasks(self, tasks):
+        if self.pool:
+            return self.pool.imap_unordered(run_node, tasks)
+        return (run_node(task) for task in tasks)
+
+    def _finish(self, phase, domain, cpu, outbox, started):
+        """
+        Account for a node's CPU time and send what it produced. The node is
+        busy for as long as it spent on the CPU, it's messages leave after.
+        """
+        self.cpu[phase][domain] += cpu
+        done = max(started, self.busy_until[domain]) + cpu
+        self.busy_until[domain] = done
+        for sender, to_domain, type, obj in outbox:
+            self.send(sender, to_domain, type, obj, done)
+
+    def run_network(self):
+        """
+        Deliver queued messages tick by tick until nothing is left in flight.
+        Everything arriving at a node within one tick is processed as one
+        batch.
+        """
+        while self.queue:
+            self.clock = max(self.clock, self.queue[0][0]) + self.tick
+            batches = defaultdict(list)
+            while self.queue and self.queue[0][0] <= self.clock:
+                at, _, domain, type, obj = heapq.heappop(self.queue)
+                batches[domain].append((type, obj))
+                self.delivered[type] += 1
+                self.last_delivery[type] = at
+
+            tasks = [
+                (self.by_domain[domain], 'deliver', messages)
+                for domain, messages in batches.items()
+            ]
+            for domain, cpu, outbox, result in self._run_tasks(tasks):
+                self._finish('deliver', domain, cpu, outbox, self.clock)
+
+    def run_phase(self, phase, payload):
+        started = self.clock
+        results = {}
+        tasks = [(node, phase, payload) for node in self.nodes]
+        for domain, cpu, outbox, result in self._run_tasks(tasks):
+            self._finish(phase, domain, cpu, outbox, started)
+            results[domain] = result
+        return results
+
+    def run(self, transactions=0):
+        wall = {}
+        previous_transport = transport.set_transport(InMemoryTransport())
+        previous_window, rejection_batcher.window = rejection_batcher.window, 0
+        router.routers.insert(0, NodeRouter())
+        try:
+            t0 = time.time()
+            txs = self.setup(transactions)
+            wall['setup'] = time.time() - t0
+
+            connections.close_all() # forked workers must not share connections
+            self.pool = Pool(self.processes) if self.processes else None
+
+            t0 = time.time()
+            for tx in txs:
+                entry_node = self.random.choice(self.nodes)
+                self.send("client", entry_node.domain, "transaction", tx, self.clock)
+            self.run_network()
+            close_start = self.clock
+            wall['transactions'] = time.time() - t0
+
+            t0 = time.time()
+            seeds = self.run_phase('step1', self.epoch)
+            self.run_network()
+            wall['step1'] = time.time() - t0
+
+            t0 = time.time()
+            checks = self.run_phase('step2', self.epoch)
+            wall['step2'] = time.time() - t0
+        finally:
+            if self.pool:
+                self.pool.close()
+                self.pool.join()
+            router.routers.pop(0)
+            rejection_batcher.window = previous_window
+            transport.set_transport(previous_transport)
+
+        converged = [
+            domain for domain, (missing, wrong) in checks.items()
+            if not missing and not wrong
+        ]
+        return {
+            'nodes': self.node_count,
+            'epoch': self.epoch,
+            'transactions': len(txs),
+            'transaction_spread': close_start,
+            'convergence_time': (
+                self.last_delivery.get('epoch hash', close_start) - close_start
+                if len(converged) == self.node_count else None
+            ),
+            'converged_nodes': len(converged),
+            'distinct_seeds': len(set(seeds.values())),
+            'sent': dict(self.sent),
+            'delivered': dict(self.delivered),
+            'dropped': dict(self.dropped),
+            'cpu': {phase: dict(times) for phase, times in self.cpu.items()},
+            'wall': wall,
+        }
+
+    def cleanup(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
@@ -0,0 +1,94 @@
+"""
+Hash tree over the ledger, so two nodes can find which parts of their
+LedgerEntry tables differ without comparing every entry.
+
+Addresses are split into 16 ** BUCKET_DIGITS buckets by the first hex digits
+of sha256(address). A bucket's hash is the sum (mod 2 ** 256) of the hashes
+of the entries in it, so it's updated in place when an entry changes without
+reading the rest of the bucket (see LedgerBucket). Every inner node hashes
+it's 16 children and the root ('') covers the whole ledger. Walking down
+from the root, comparing children with a peer, finds the differing buckets
+in BUCKET_DIGITS round trips.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import itertools
+
+HEX = '0123456789abcdef'
+BUCKET_DIGITS = 3
+MODULUS = 2 ** 256
+EMPTY = '0' * 64
+
+def bucket_for(address):
+    return hashlib.sha256(address.encode('utf-8')).hexdigest()[:BUCKET_DIGITS]
+
+def entry_hash(address, amount):
+    entry = "%s %.8f" % (address, amount)
+    return int(hashlib.sha256(entry.encode('utf-8')).hexdigest(), 16)
+
+def add_hashes(digest, added=0, removed=0):
+    """
+    Add and remove entry hashes from a bucket digest.
+    """
+    return "%064x" % ((int(digest, 16) + added - removed) % MODULUS)
+
+def prefixes(length):
+    return [''.join(x) for x in itertools.product(HEX, repeat=length)]
+
+def bucket_ranges(count):
+    """
+    Split the buckets into count contiguous (first, last) ranges of about
+    the same size.
+    """
+    total = len(HEX) ** BUCKET_DIGITS
+    bounds = [total * i // count for i in range(count + 1)]
+    return [
+        ("%0*x" % (BUCKET_DIGITS, lo), "%0*x" % (BUCKET_DIGITS, hi - 1))
+        for lo, hi in zip(bounds, bounds[1:]) if hi > lo
+    ]
+
+def build_tree(leaves):
+    """
+    leaves is {bucket: digest}, buckets left out are empty. Returns
+    {prefix: digest} for every node in the tree.
+    """
+    nodes = {bucket: leaves.get(bucket, EMPTY) for bucket in prefixes(BUCKET_DIGITS)}
+    for length in range(BUCKET_DIGITS - 1, -1, -1):
+        for prefix in prefixes(length):
+            children = ''.join(nodes[prefix + x] for x in HEX)
+            nodes[prefix] = hashlib.sha256(children.encode('ascii')).hexdigest()
+    return nodes
+
+def describe(tree, prefix):
+    """
+    What the state endpoint returns for one node: it's hash, plus it's
+    children's hashes unless it's a bucket.
+    """
+    node = {'hash': tree[prefix]}
+    if len(prefix) < BUCKET_DIGITS:
+        node['children'] = [tree[prefix + x] for x in HEX]
+    return node
+
+def differing_buckets(tree, fetch):
+    """
+    Compare our tree against a peer's. fetch takes a list of prefixes and
+    returns the peer's describe() for each, keyed by prefix.
+    """
+    differing = []
+    pending = ['']
+    while pending:
+        nodes = fetch(pending)
+        pending = []
+        for prefix, node in nodes.items():
+            if node['hash'] == tree[prefix]:
+                continue
+            for x, digest in zip(HEX, node['children']):
+                child = prefix + x
+                if digest == tree[child]:
+                    continue
+                if len(child) == BUCKET_DIGITS:
+                    differing.append(child)
+                else:
+                    pending.append(child)
+    return sorted(differing)
@@ -0,0 +1,272 @@
+"""
+Persistent gossip streams between assigned peers. Instead of one HTTPS form
+POST per transaction, rejection, registration or epoch hash push, each peer
+gets one long lived connection that carries every message type, written back
+to back without waiting on a response.
+
+Each message is one frame: a 4 byte big endian payload length, a 1 byte
+message type (index into MESSAGE_TYPES) and the JSON payload. Whenever a
+stream can't take a message (peer down, queue full, unknown type) it goes out
+over the HTTP endpoints instead.
+
+The receiver acknowledges every frame it has handled with a 4 byte count of
+the frames handled so far on that connection. The sender keeps each message
+until it's acknowledged, when the stream breaks it reconnects once and sends
+everything unacknowledged again, and if that fails too those messages go
+over HTTP. A message can so arrive twice, but isn't lost with the stream.
+"""
+from __future__ import print_function
+
+import json
+import ssl
+import time
+import socket
+import select
+import struct
+import threading
+from collections import deque
+
+from django.conf import settings
+from django.db import connection
+from django.utils.six.moves import queue, socketserver
+
+from .transport import HTTPTransport, handle_message
+
+MESSAGE_TYPES = ['transaction', 'rejections', 'epoch hash', 'peers', 'rejection batch']
+MESSAGE_CODES = {type: code for code, type in enumerate(MESSAGE_TYPES)}
+
+HEADER = struct.Struct(str('>IB'))
+ACK = struct.Struct(str('>I'))
+ACK_POLL = 0.5 # seconds between reading acks while the stream is idle
+MAX_FRAME_SIZE = 1024 * 1024
+MAX_PIPELINE = 500 # frames written with one sendall
+
+def encode_frame(type, obj):
+    payload = json.dumps(obj).encode('utf-8')
+    return HEADER.pack(len(payload), MESSAGE_CODES[type]) + payload
+
+def read_frame(rfile):
+    """
+    Read one frame, returns (type, obj) or None when the stream ends.
+    """
+    header = rfile.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    length, code = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE or code >= len(MESSAGE_TYPES):
+        raise ValueError("Invalid frame (type %s, %s bytes)" % (code, length))
+    payload = rfile.read(length)
+    if len(payload) < length:
+        return None
+    return MESSAGE_TYPES[code], json.loads(payload.decode('utf-8'))
+
+class PeerStream(object):
+    """
+    Outbound stream to one peer. Messages are queued and written by a
+    background thread, which drains everything waiting into one write.
+    Written messages stay in unacked until the peer acknowledges them.
+    """
+    def __init__(self, domain, fallback):
+        self.domain = domain
+        self.fallback = fallback
+        self.queue = queue.Queue(settings.GOSSIP_STREAM_QUEUE)
+        self.sock = None
+        self.down_until = 0
+        self.unacked = deque()
+        self.acked = 0 # frames acknowledged on the current connection
+        self.ack_data = b''
+        thread = threading.Thread(target=self._run, name="stream-%s" % domain)
+        thread.daemon = True
+        thread.start()
+
+    def send(self, type, obj):
+        """
+        Returns False when the message could not be queued and the caller
+        should use HTTP instead.
+        """
+        if time.time() < self.down_until:
+            return False
+        try:
+            self.queue.put_nowait((type, obj))
+        except queue.Full:
+            return False
+        return True
+
+    def close(self):
+        """
+        Stop the stream once what's queued before this has been written.
+        """
+        self.queue.put(None)
+
+    def _connect(self):
+        sock = socket.create_connection(
+            (self.domain, settings.GOSSIP_STREAM_PORT),
+            timeout=settings.GOSSIP_STREAM_TIMEOUT
+        )
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if settings.GOSSIP_STREAM_TLS:
+            context = ssl.create_default_context()
+            sock = context.wrap_socket(sock, server_hostname=self.domain)
+        return sock
+
+    def _close(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+
+    def _readable(self):
+        pending = getattr(self.sock, 'pending', None) # data already decrypted
+        return (pending and pending()) or select.select([self.sock], [], [], 0)[0]
+
+    def _read_acks(self):
+        """
+        Drop the messages the peer has acknowledged, without waiting for
+        acks that haven't arrived.
+        """
+        while self._readable():
+            data = self.sock.recv(4096)
+            if not data:
+                raise socket.error("stream closed by %s" % self.domain)
+            self.ack_data += data
+        count = len(self.ack_data) // ACK.size
+        if count:
+            handled = ACK.unpack_from(self.ack_data, (count - 1) * ACK.size)[0]
+            self.ack_data = self.ack_data[count * ACK.size:]
+            for i in range(min(handled - self.acked, len(self.unacked))):
+                self.unacked.popleft()
+            self.acked = handled
+        if len(self.unacked) > settings.GOSSIP_STREAM_QUEUE:
+            raise socket.error("%s stopped acknowledging" % self.domain)
+
+    def _deliver(self, batch):
+        """
+        Write the batch. When the stream is broken, reconnect once and write
+        everything unacknowledged again. Returns False if that failed too.
+        """
+        self.unacked.extend(batch)
+        for attempt in range(2):
+            try:
+                if not self.sock:
+                    self.sock = self._connect()
+                    self.acked, self.ack_data = 0, b''
+                    batch = list(self.unacked)
+                self._read_acks()
+                self.sock.sendall(b''.join(encode_frame(*x) for x in batch))
+                return True
+            except (socket.error, ssl.SSLError):
+                self._close()
+        return False
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=ACK_POLL)]
+            except queue.Empty:
+                batch = []
+            while batch and batch[-1] and len(batch) < MAX_PIPELINE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            closing = batch and batch[-1] is None
+            if closing:
+                batch.pop()
+
+            if not batch:
+                if closing:
+                    self._close()
+                    return
+                if self.sock and self.unacked:
+                    try:
+                        self._read_acks()
+                    except (socket.error, ssl.SSLError):
+                        self._close() # resent with the next batch
+                continue
+
+            if time.time() < self.down_until:
+                failed = batch
+            elif self._deliver(batch):
+                failed = []
+            else:
+                self.down_until = time.time() + settings.GOSSIP_STREAM_RETRY
+                failed, self.unacked = list(self.unacked), deque()
+
+            for type, obj in failed:
+                self.fallback.propagate([self.domain], obj, type)
+            if closing:
+                self._close()
+                return
+
+class StreamTransport(object):
+    def __init__(self, fallback=None):
+        self.fallback = fallback or HTTPTransport()
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def stream(self, domain):
+        with self.lock:
+            if domain not in self.streams:
+                self.streams[domain] = PeerStream(domain, self.fallback)
+            return self.streams[domain]
+
+    def close(self):
+        with self.lock:
+            for stream in self.streams.values():
+                stream.close()
+            self.streams = {}
+
+    def propagate(self, domains, obj, type):
+        over_http = [
+            domain for domain in domains
+            if type not in MESSAGE_CODES or not self.stream(domain).send(type, obj)
+        ]
+        if over_http:
+            return self.fallback.propagate(over_http, obj, type)
+
+class GossipHandler(socketserver.StreamRequestHandler):
+    """
+    Reads frames off one inbound stream and handles them in order, the same
+    way the HTTP views would, acknowledging each one once it's handled.
+    """
+    def handle(self):
+        handled = 0
+        while True:
+            try:
+                frame = read_frame(self.rfile)
+            except ValueError as exc:
+                print("%s: %s, closing stream" % (self.client_address[0], exc))
+                return
+            if not frame:
+                return
+
+            type, obj = frame
+            try:
+                handle_message(type, obj)
+            except Exception as exc:
+                print("%s: rejected %s: %s" % (self.client_address[0], type, exc))
+            handled += 1
+            try:
+                self.wfile.write(ACK.pack(handled))
+            except (socket.error, ssl.SSLError):
+                return
+
+    def finish(self):
+        socketserver.StreamRequestHandler.finish(self)
+        connection.close()
+
+class GossipServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, ssl_context=None):
+        self.ssl_context = ssl_context
+        socketserver.TCPServer.__init__(self, address, GossipHandler)
+
+    def get_request(self):
+        sock, address = self.socket.accept()
+        if self.ssl_context:
+            # handshake happens on first read, in the handler's thread
+            sock = self.ssl_context.wrap_socket(
+                sock, server_side=True, do_handshake_on_connect=False
+            )
+        return sock, address
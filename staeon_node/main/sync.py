@@ -4,18 +4,23 @@ import datetime
 import requests
 
 import dateutil.parser
-from main.models import Peer, LedgerEntry
+from django.conf import settings
+from django.db import transaction
+from main.models import Peer, LedgerEntry, LedgerBucket, EpochSummary, PeerSyncState
+from main import statetree, wire, peerstats
+from main.peerstats import peer_stats
 from staeon.network import SEED_NODES
 
-def _update_ledger(response):
-    j = response.json()
+def _update_ledger(j):
     for data in j['data']:
         address, amount, last_updated = data
-        le,c = LedgerEntry.objects.get_or_create(address=address)
-        le.amount = balance
-        le.last_updated = last_updated
-        le.save()
-    return last_updated
+        LedgerEntry.objects.update_or_create(address=address, defaults={
+            'amount': float(amount),
+            'last_updated': dateutil.parser.parse(last_updated).replace(tzinfo=None),
+        })
+    # rebuilt after any write outside apply_deltas, it's also what bumps
+    # the ledger version the ledger store in every process checks
+    LedgerBucket.rebuild()
 
 def sync_ledger():
     try:
@@ -29,55 +34,155 @@ def sync_ledger():
         ) if last_update else "Never"
     ))
 
-    peers = Peer.objects.all().order_by("?")
-    for peer in peers:
-        url = "https://%s/staeon/sync?start=%s" % (
-            peer.domain, last_update or "None"
-        )
+    # fastest peers first, the ones that are failing are skipped
+    domains = peer_stats.rank(Peer.objects.values_list('domain', flat=True))
+    for domain in domains:
+        url = "https://%s/staeon/ledger/" % domain
         print("Trying: %s" % url)
         try:
-            response = requests.get(url, timeout=3).json()
-        except (requests.exceptions.ConnectionError, ValueError)as exc:
+            response = wire.get(url, params={
+                'sync_start': (last_update or datetime.datetime(1970, 1, 1)).isoformat()
+            }, timeout=settings.PEER_SYNC_TIMEOUT)
+        except (requests.exceptions.RequestException, ValueError) as exc:
             print("fail: %s" % exc)
             continue # try next node
 
         _update_ledger(response)
+        break
+    peer_stats.flush()
+
+def _fetch_state(domain, prefixes):
+    nodes = {}
+    for i in range(0, len(prefixes), 100):
+        j = wire.get(
+            "https://%s/staeon/state/" % domain,
+            params={'prefixes': ",".join(prefixes[i:i + 100])},
+            timeout=settings.PEER_SYNC_TIMEOUT
+        )
+        nodes.update(j['nodes'])
+    return j['epoch'], nodes
+
+def repair_ledger(domain):
+    """
+    Find the buckets where our ledger differs from the peer's by walking
+    both state trees, then replace our entries in just those buckets with
+    the peer's. Both nodes have to have closed the same epoch. Returns the
+    buckets that were re-synced.
+    """
+    try:
+        my_epoch = EpochSummary.objects.latest().epoch
+    except EpochSummary.DoesNotExist:
+        my_epoch = None
+
+    def fetch(prefixes):
+        epoch, nodes = _fetch_state(domain, prefixes)
+        if epoch != my_epoch:
+            raise Exception(
+                "%s is at epoch %s, we are at %s" % (domain, epoch, my_epoch)
+            )
+        return nodes
+
+    differing = statetree.differing_buckets(LedgerBucket.tree(), fetch)
+    for bucket in differing:
+        url = "https://%s/staeon/ledger/" % domain
+        j = wire.get(
+            url, params={'bucket': bucket}, timeout=settings.PEER_SYNC_TIMEOUT
+        )
+        entries = [
+            LedgerEntry(
+                address=address, amount=float(amount), bucket=bucket,
+                last_updated=dateutil.parser.parse(last_updated).replace(tzinfo=None)
+            ) for address, amount, last_updated in j['data']
+        ]
+        with transaction.atomic():
+            LedgerEntry.objects.filter(bucket=bucket).delete()
+            LedgerEntry.objects.bulk_create(entries)
+            # bumps the bucket's version too, see main.ledgerstore
+            LedgerBucket.rebuild([bucket])
+        print("re-synced bucket %s (%s entries)" % (bucket, len(entries)))
+    return differing
 
-def _update_peers(j):
+def _update_peers(peers):
     """
-    Extracts the peers from seed node and enters them into the database.
-    Returns True when it fetches the last page.
+    Bulk upsert a page of peers from a seed node. New peers are inserted in
+    one query, existing ones are only written when something changed.
     """
-    if not j['peers']:
-        return True # empty list, fetching complete
-    for peer in j['peers']:
-        p, c = Peer.objects.get_or_create(domain=peer['domain'])
-        p.reputation = peer['reputaion']
-        p.payout_address = peer['payout_address']
-        p.first_registered = dateutil.parser.parse(peer['first_registered'])
-        p.save()
-    return False
+    now = datetime.datetime.now()
+    existing = Peer.objects.in_bulk([x['domain'] for x in peers])
+    new = []
+    with transaction.atomic():
+        for peer in peers:
+            fields = {
+                'reputation': peer['reputation'],
+                'payout_address': peer['payout_address'],
+                'first_registered': dateutil.parser.parse(
+                    peer['first_registered']
+                ).replace(tzinfo=None),
+            }
+            p = existing.get(peer['domain'])
+            if not p:
+                new.append(Peer(domain=peer['domain'], **fields))
+            elif any(getattr(p, name) != value for name, value in fields.items()):
+                Peer.objects.filter(domain=p.domain).update(last_modified=now, **fields)
+        Peer.objects.bulk_create(new)
+
+    # bulk queries don't send the signals that would do this
+    Peer.peers_changed()
 
 def _sync_from_seed(seed_domain):
+    """
+    Fetch every peer that changed on the seed since our last sync from it,
+    or the whole registry the first time. Returns False if the seed is down.
+    """
+    try:
+        state = PeerSyncState.objects.get(seed_domain=seed_domain)
+    except PeerSyncState.DoesNotExist:
+        state = PeerSyncState(seed_domain=seed_domain)
+
+    params = {'page_size': settings.PEER_PAGE_MAX, 'page': 1}
+    headers = {}
+    if state.as_of:
+        params['since'] = state.as_of.isoformat()
+    if state.etag:
+        headers['If-None-Match'] = state.etag
+
+    url = "https://%s/staeon/peers/" % seed_domain
+    as_of = etag = None
     while True:
-        url = "https://%s/staeon/peers?page=%s" % (seed_domain, page)
         try:
-            response = requests.get(url).json()
-        except (requests.exceptions.ConnectionError, ValueError) as exc:
+            response = peerstats.request(
+                'get', url, params=params, headers=headers, timeout=settings.PEER_SYNC_TIMEOUT
+            )
+            if response.status_code == 304:
+                return True # nothing changed since last time
+            j = response.json()
+        except (requests.exceptions.RequestException, ValueError) as exc:
             print("fail: %s" % exc)
             return False # seed is down, try another seed
 
-        if _update_peers(response):
-            return True
-        else:
-            page += 1
+        if params['page'] == 1:
+            as_of = dateutil.parser.parse(j['as_of']).replace(tzinfo=None)
+            etag = response.headers.get('ETag', '')
+            headers = {}
 
-def sync_peers():
-    page = 1
-    for seed_domain in SEED_NODES:
-        if _sync_from_seed(seed_domain):
-            break # break when sync completes
-    else:
-        print "peer sync not complete, try again later"
-        return False
+        if not j['peers']:
+            break # empty list, fetching complete
+        _update_peers(j['peers'])
+        params['page'] += 1
+
+    state.as_of = as_of
+    state.etag = etag
+    state.save()
     return True
+
+def sync_peers():
+    try:
+        for seed_domain in peer_stats.rank(SEED_NODES):
+            if _sync_from_seed(seed_domain):
+                break # break when sync completes
+        else:
+            print("peer sync not complete, try again later")
+            return False
+        return True
+    finally:
+        peer_stats.flush()
@@ -0,0 +1,266 @@
+"""
+How gossip messages leave this node, and what happens to them when they
+arrive. Everything outbound goes through propagate(), which hands off to the
+installed transport. HTTPTransport (form POSTs to each peer's views) is the
+default, the simulator swaps in an in-memory one with set_transport().
+HTTPTransport doesn't post in the calling thread, it hands each post to the
+relay, which makes them on a few threads of it's own.
+"""
+from __future__ import print_function
+
+import json
+import time
+import heapq
+import atexit
+import itertools
+import threading
+import functools
+
+import requests
+from django.conf import settings
+from django.db import connection
+from django.utils.six.moves import queue
+
+from staeon.consensus import propagate_to_peers
+from staeon.transaction import make_txid
+from staeon.peer_registration import validate_peer_registration
+
+from . import wire, peerstats
+
+def retry_after(response):
+    try:
+        return max(int(response.headers.get('Retry-After', 1)), 1)
+    except ValueError:
+        return 1
+
+RELAY_IDLE_CLOSE = 30 # seconds a relay thread waits before closing it's connection
+
+class Relay(object):
+    """
+    Makes gossip posts on GOSSIP_RELAY_THREADS threads, so the request that
+    caused them isn't kept waiting on peers. At most GOSSIP_RELAY_QUEUE posts
+    wait, past that new ones are dropped. A post a peer turns away with a 503
+    is held on one heap until it's Retry-After is up, a single scheduler
+    thread puts it back on the queue then. With no threads each post is made
+    in the calling thread and retries are only made by run_due().
+    """
+    def __init__(self, threads=None, size=None, clock=time.time):
+        self.threads = settings.GOSSIP_RELAY_THREADS if threads is None else threads
+        self.queue = queue.Queue(settings.GOSSIP_RELAY_QUEUE if size is None else size)
+        self.clock = clock
+        self.retries = [] # heap of (due, n, post, attempt)
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.started = False
+        self.dropped = 0
+
+    def start(self):
+        with self.cond:
+            if self.started:
+                return
+            self.started = True
+        if not self.threads:
+            return
+        targets = [self._work_forever] * self.threads + [self._schedule_forever]
+        for i, target in enumerate(targets):
+            thread = threading.Thread(target=target, name="gossip-relay-%s" % i)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, post, attempt=0):
+        """
+        Queue the post, returns False if it was dropped because the queue is
+        full.
+        """
+        self.start()
+        if not self.threads:
+            self.send(post, attempt)
+            return True
+        try:
+            self.queue.put_nowait((post, attempt))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def send(self, post, attempt=0):
+        """
+        Make the post, and when the peer turns it away with a 503 because
+        it's too busy, schedule it again for after the Retry-After it asked
+        for, up to GOSSIP_RETRIES times.
+        """
+        try:
+            response = post()
+        except requests.exceptions.RequestException:
+            return # peer is down, nothing else to do
+        if response.status_code == 503 and attempt < settings.GOSSIP_RETRIES:
+            with self.cond:
+                due = self.clock() + retry_after(response)
+                heapq.heappush(self.retries, (due, next(self.counter), post, attempt + 1))
+                self.cond.notify()
+
+    def _pop_due(self):
+        due, now = [], self.clock()
+        while self.retries and self.retries[0][0] <= now:
+            when, n, post, attempt = heapq.heappop(self.retries)
+            due.append((post, attempt))
+        return due
+
+    def run_due(self):
+        """
+        Submit every retry that's due.
+        """
+        with self.cond:
+            due = self._pop_due()
+        for post, attempt in due:
+            self.submit(post, attempt)
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for the queued posts to be made. Retries
+        still waiting for their time aren't waited for.
+        """
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.05)
+        return not self.queue.unfinished_tasks
+
+    def _schedule_forever(self):
+        while True:
+            with self.cond:
+                due = self._pop_due()
+                if not due:
+                    timeout = self.retries[0][0] - self.clock() if self.retries else None
+                    self.cond.wait(timeout)
+            for post, attempt in due:
+                self.submit(post, attempt)
+
+    def _work_forever(self):
+        while True:
+            try:
+                post, attempt = self.queue.get(timeout=RELAY_IDLE_CLOSE)
+            except queue.Empty:
+                connection.close() # don't hold a connection while idle
+                continue
+            try:
+                self.send(post, attempt)
+            except Exception as exc:
+                print("gossip relay: post failed: %s" % exc)
+            finally:
+                self.queue.task_done()
+
+relay = Relay()
+# commands like consensus_step1 exit right after queueing their pushes
+atexit.register(lambda: relay.wait(settings.GOSSIP_RELAY_EXIT_WAIT))
+
+class HTTPTransport(object):
+    # message types posted here instead of by staeon, so every call goes
+    # through peerstats and a peer that's busy can be retried: (endpoint,
+    # form field holding the JSON, or None to post the object's own fields)
+    FORM_POSTS = {
+        'transaction': ('transaction', 'tx'),
+        'rejections': ('rejections', None),
+        'rejection batch': ('rejections', 'batch'),
+        'epoch hash': ('consensus/push', 'obj'),
+        'peers': ('peers', 'registration'),
+    }
+    # where each message type is posted when WIRE_FORMAT is set
+    ENDPOINTS = {
+        'transaction': 'transaction',
+        'rejections': 'rejections',
+        'rejection batch': 'rejections',
+        'epoch hash': 'consensus/push',
+        'peers': 'peers',
+    }
+
+    def __init__(self, relay=None):
+        self.relay = relay
+
+    def propagate(self, domains, obj, type):
+        domains = peerstats.peer_stats.available(domains)
+        if settings.WIRE_FORMAT and type in self.ENDPOINTS:
+            return self.post_encoded(domains, obj, self.ENDPOINTS[type])
+        if type in self.FORM_POSTS:
+            return self.post_form(domains, obj, *self.FORM_POSTS[type])
+        return propagate_to_peers(domains, obj=obj, type=type)
+
+    def post_encoded(self, domains, obj, endpoint):
+        for domain in domains:
+            url = "https://%s/staeon/%s/" % (domain, endpoint)
+            self.send(functools.partial(wire.post, url, obj, timeout=5))
+
+    def post_form(self, domains, obj, endpoint, field):
+        data = {field: json.dumps(obj)} if field else obj
+        for domain in domains:
+            url = "https://%s/staeon/%s/" % (domain, endpoint)
+            self.send(functools.partial(peerstats.request, 'post', url, data=data, timeout=5))
+
+    def send(self, post):
+        (self.relay or relay).submit(post)
+
+_transport = None
+
+def get_transport():
+    """
+    The installed transport. Unless one was set, that is StreamTransport when
+    GOSSIP_STREAMS is on, otherwise plain HTTP.
+    """
+    global _transport
+    if not _transport:
+        if settings.GOSSIP_STREAMS:
+            from .streams import StreamTransport
+            _transport = StreamTransport()
+        else:
+            _transport = HTTPTransport()
+    return _transport
+
+def set_transport(transport):
+    """
+    Install a new transport, returns the one it replaced.
+    """
+    global _transport
+    previous, _transport = _transport, transport
+    return previous
+
+def propagate(domains, obj, type):
+    return get_transport().propagate(domains, obj, type)
+
+def _handle_transaction(obj):
+    from .models import ValidatedTransaction
+    if 'txid' not in obj: obj['txid'] = make_txid(obj)
+    return ValidatedTransaction.validate_raw_tx(obj)
+
+def _handle_rejection(obj):
+    from .models import Peer, ValidatedRejection
+    peer = Peer.objects.get(domain=obj['domain'])
+    return ValidatedRejection.validate_rejection_from_peer(
+        peer, obj['txid'], obj['signature']
+    )
+
+def _handle_rejection_batch(obj):
+    from .models import ValidatedRejection
+    return ValidatedRejection.accept_batch(obj)
+
+def _handle_epoch_hash(obj):
+    from .models import EpochHash
+    return EpochHash.accept_push(obj)
+
+def _handle_registration(obj):
+    from .models import Peer
+    validate_peer_registration(obj)
+    return Peer.accept_registration(obj)
+
+HANDLERS = {
+    'transaction': _handle_transaction,
+    'rejections': _handle_rejection,
+    'rejection batch': _handle_rejection_batch,
+    'epoch hash': _handle_epoch_hash,
+    'peers': _handle_registration,
+}
+
+def handle_message(type, obj):
+    """
+    Process a message received from a peer, the same way the matching view
+    would.
+    """
+    return HANDLERS[type](obj)
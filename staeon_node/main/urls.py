@@ -3,7 +3,7 @@ from django.views.generic import TemplateView
 
 from views import (
     accept_tx, consensus_push, consensus_penalty, peers, network_summary,
-    rejections, ledger
+    rejections, ledger, balances, state_tree, address_history
 )
 
 urlpatterns = [
@@ -15,5 +15,8 @@ urlpatterns = [
     url(r'^rejections/', rejections, name="rejections"),
 
     url(r'^ledger/', ledger),
+    url(r'^balances/', balances),
+    url(r'^state/', state_tree),
+    url(r'^history/', address_history),
     url(r'^summary/', network_summary, name="summary"),
 ]
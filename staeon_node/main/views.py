@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import json
+import hashlib
+import datetime
 import dateutil.parser
 from bitcoin import ecdsa_sign, ecdsa_verify, ecdsa_recover, pubtoaddr
 
@@ -8,11 +10,15 @@ from django.shortcuts import render
 from django.http import JsonResponse, HttpResponse, HttpResponseBadRequest
 from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
 from django.db.models import Q
+from django.views.decorators.http import condition
+from django.conf import settings
 
 from .models import (
     LedgerEntry, Peer, ValidatedTransaction, ValidatedRejection, EpochHash,
-    ValidatedMovement
+    ValidatedMovement, EpochSummary, LedgerBucket, NodePenaltyVote
 )
+from . import statetree, wire
+from .profiling import profiled
 
 from staeon.peer_registration import validate_peer_registration
 from staeon.transaction import validate_transaction, make_txid
@@ -20,16 +26,24 @@ from staeon.consensus import (
     validate_rejection_authorization, get_epoch_number, get_epoch_range,
     propagate_to_peers, make_transaction_rejection
 )
-from staeon.exceptions import InvalidTransaction, RejectedTransaction
+from staeon.exceptions import (
+    InvalidTransaction, RejectedTransaction, InvalidObject, RejectedObject
+)
+
+MAX_BALANCE_ADDRESSES = 500
+MAX_STATE_PREFIXES = 256
+HISTORY_PAGE_SIZE = 100
+HISTORY_PAGE_MAX = 1000
 
 def send_tx(request):
     return render(request, "send_tx.html")
 
 @csrf_exempt
+@profiled('accept_tx', sample=True)
 def accept_tx(request):
     try:
-        tx = json.loads(request.POST['tx'])
-    except ValueError:
+        tx = wire.read_payload(request, 'tx')
+    except (ValueError, KeyError):
         return HttpResponseBadRequest("Invalid transaction JSON")
 
     if 'txid' not in tx: tx['txid'] = make_txid(tx)
@@ -41,18 +55,26 @@ def accept_tx(request):
 
     return HttpResponse("OK")
 
+@csrf_exempt
 def rejections(request):
-    if request.POST:
+    if request.method == 'POST':
         try:
-            node = Peer.objects.get(domain=request.POST['domain'])
+            if wire.is_encoded(request) or 'batch' in request.POST:
+                rejection = wire.read_payload(request, 'batch')
+            else:
+                rejection = request.POST
+            if 'rejections' in rejection:
+                ValidatedRejection.accept_batch(rejection)
+            else:
+                peer = Peer.objects.get(domain=rejection['domain'])
+                ValidatedRejection.validate_rejection_from_peer(
+                    peer, rejection['txid'], rejection['signature']
+                )
         except Peer.DoesNotExist:
             return HttpResponseBadRequest("Unregistered peer")
-        try:
-            ValidatedRejection.validate_rejection_from_peer(
-                peer, request.POST['txid'], request.POST['signature']
-            )
         except Exception as exc:
-            return HttpResponseBadRequest("Invalid Rejection: %s" % exc.display())
+            return HttpResponseBadRequest("Invalid Rejection: %s" % exc)
+        return HttpResponse("OK")
     else:
         # rendering the rejections page
         if 'epoch' in request.GET:
@@ -72,27 +94,69 @@ def rejections(request):
             ]})
         return render(request, "rejections.html", locals())
 
+def peer_table_stats(request):
+    """
+    Peer.table_stats, read once per request so the ETag and the body
+    describe the same table.
+    """
+    if not hasattr(request, '_peer_table_stats'):
+        request._peer_table_stats = Peer.table_stats()
+    return request._peer_table_stats
+
+def peers_etag(request):
+    """
+    Changes whenever any peer is added or modified, or the page asked for
+    changes. 'since' is left out so a client asking for changes since it's
+    last sync gets a 304 when there were none.
+    """
+    if request.method != 'GET':
+        return None
+    count, last_modified = peer_table_stats(request)
+    query = request.GET.copy()
+    query.pop('since', None)
+    return hashlib.md5(("%s|%s|%s" % (
+        count, last_modified, query.urlencode()
+    )).encode('utf-8')).hexdigest()
+
+@csrf_exempt
+@profiled('peers', sample=True)
+@condition(etag_func=peers_etag)
 def peers(request):
-    page_size = 5
     if request.method == 'GET':
-        peers = Peer.objects.order_by("first_registered")
+        as_of = datetime.datetime.now()
+        try:
+            page_size = min(
+                int(request.GET.get('page_size', settings.PEER_PAGE_SIZE)),
+                settings.PEER_PAGE_MAX
+            )
+            page = int(request.GET.get('page', 1))
+            since = None
+            if 'since' in request.GET:
+                since = dateutil.parser.parse(request.GET['since']).replace(tzinfo=None)
+        except (ValueError, OverflowError):
+            return HttpResponseBadRequest("Invalid page, page_size or since")
+        if page_size < 1 or page < 1:
+            return HttpResponseBadRequest("page and page_size start at 1")
+
+        peers = Peer.objects.order_by("first_registered", "domain")
+        if since:
+            peers = peers.filter(last_modified__gt=since)
 
+        # the bodies come from a ranking of the same table the ETag describes
+        current = peer_table_stats(request)
         if 'top' in request.GET:
-            peers = filter(lambda x: x['percentile'] > 50, peers)
-        elif 'page' in request.GET:
-            page = int(request.GET['page'])
-            print "peers[%s:%s]" % (page_size * (page - 1), page_size * page)
-            peers = peers[page_size * (page - 1):page_size * page]
+            domains = [x['domain'] for x in Peer.ranking(current) if x['percentile'] > 50]
         else:
-            peers = peers[:page_size]
+            domains = peers.values_list('domain', flat=True)[page_size * (page - 1):page_size * page]
 
         return JsonResponse({
-            'peers': [x.as_dict() for x in peers]
+            'peers': Peer.dicts_for(domains, current),
+            'as_of': as_of.isoformat(),
         })
     else:
         # handling new peer registration
         try:
-            reg = json.loads(request.POST['registration'])
+            reg = wire.read_payload(request, 'registration')
         except Exception as exc:
             return HttpResponseBadRequest("Invalid registration JSON: %s" % str(exc))
 
@@ -107,45 +171,43 @@ def peers(request):
         except Exception as exc:
             return HttpResponseBadRequest("Registration Invalid: %s" % exc)
 
-        try:
-            p = Peer.objects.get(
-                Q(domain=reg['domain']) | Q(payout_address=reg['payout_address'])
-            )
-            p.domain = reg['domain']
-            p.payout_address = reg['payout_address']
-            p.save()
-        except Peer.DoesNotExist:
-            Peer.objects.create(
-                domain=reg['domain'],
-                payout_address=reg['payout_address'],
-                first_registered=ts
-            )
-
-        propagate_to_assigned_peers(reg, "peers")
+        Peer.accept_registration(reg)
 
         return HttpResponse("OK")
 
+@csrf_exempt
 def consensus_penalty(request):
-    if request.POST:
-        obj = json.loads(request.POST['obj'])
-        NodePenaltyVote.make_vote(obj)
+    if request.method == 'POST':
+        try:
+            obj = wire.read_payload(request, 'obj')
+        except (ValueError, KeyError):
+            return HttpResponseBadRequest("Invalid penalty JSON")
+        try:
+            NodePenaltyVote.make_vote(obj)
+        except InvalidObject as exc:
+            return HttpResponseBadRequest("Invalid: %s" % exc)
+        except RejectedObject as exc:
+            return HttpResponseBadRequest("Rejected: %s" % exc)
 
     return HttpResponse("OK")
 
+@csrf_exempt
 def consensus_push(request):
     """
     During the consensus process, other nodes will push their ledger hash and
     this view will accept it. Also handles ledger hash pulls via GET.
     """
-    if request.POST:
+    if request.method == 'POST':
         # accepting push
-        obj = json.loads(request.POST['obj'])
-        peer = Peer.objects.get(domain=obj['domain'])
+        try:
+            obj = wire.read_payload(request, 'obj')
+        except (ValueError, KeyError):
+            return HttpResponseBadRequest("Invalid Epoch Hash Push JSON")
 
         try:
-            EpochHash.save_push(
-                peer, obj['epoch'], obj['hashes'], obj['signature'],
-            )
+            EpochHash.accept_push(obj)
+        except Peer.DoesNotExist:
+            return HttpResponseBadRequest("Unregistered peer")
         except InvalidObject as exc:
             return HttpResponseBadRequest("Invalid Epoch Hash Push: %s" % exc)
         except RejectedObject as exc:
@@ -162,16 +224,25 @@ def consensus_push(request):
     #     })
 
 
+@profiled('ledger', sample=True)
 def ledger(request):
     if "sync_start" in request.GET:
         start = dateutil.parser.parse(request.GET['sync_start'])
         ledgers = LedgerEntry.objects.filter(last_updated__gt=start).order_by('-last_updated')
-        return JsonResponse({
+        return wire.response(request, {
             'data': [
                 [x.address, "%.8f" % x.amount, x.last_updated.isoformat()]
                 for x in ledgers[:500]
             ]
         })
+    elif 'bucket' in request.GET:
+        ledgers = LedgerEntry.objects.filter(bucket=request.GET['bucket'])
+        return wire.response(request, {
+            'data': [
+                [x.address, "%.8f" % x.amount, x.last_updated.isoformat()]
+                for x in ledgers
+            ]
+        })
     elif 'address' in request.GET:
         address = request.GET['address']
         try:
@@ -186,8 +257,88 @@ def ledger(request):
         )
         return HttpResponse(str(adjusted_balance))
 
+@csrf_exempt
+def balances(request):
+    """
+    Balances for many addresses in one round trip. Addresses are passed
+    comma separated via GET or POST.
+    """
+    data = request.POST if request.method == 'POST' else request.GET
+    addresses = [x.strip() for x in data.get('addresses', '').split(",") if x.strip()]
+    if not addresses:
+        return HttpResponseBadRequest("No addresses given")
+    if len(addresses) > MAX_BALANCE_ADDRESSES:
+        return HttpResponseBadRequest(
+            "Too many addresses, limit is %s" % MAX_BALANCE_ADDRESSES
+        )
+
+    confirmed = LedgerEntry.balances(addresses)
+    pending = ValidatedMovement.adjusted_balances(addresses)
+    return JsonResponse({
+        'balances': {
+            address: "%.8f" % (confirmed.get(address, 0) + pending.get(address, 0))
+            for address in addresses
+        }
+    })
+
+def address_history(request):
+    """
+    Paginated movements for one address, newest first. Pass the returned
+    next_cursor back as cursor for the next page.
+    """
+    address = request.GET.get('address')
+    if not address:
+        return HttpResponseBadRequest("No address given")
+    try:
+        limit = min(int(request.GET.get('limit', HISTORY_PAGE_SIZE)), HISTORY_PAGE_MAX)
+        cursor = request.GET.get('cursor')
+        if cursor:
+            epoch, id = [int(x) for x in cursor.split("-")]
+            cursor = (epoch, id)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid limit or cursor")
+    if limit < 1:
+        return HttpResponseBadRequest("Invalid limit or cursor")
+
+    rows, next_cursor = ValidatedMovement.history(address, cursor, limit)
+    return JsonResponse({
+        'address': address,
+        'movements': [
+            {
+                'txid': txid,
+                'amount': "%.8f" % amount,
+                'epoch': epoch,
+                'timestamp': timestamp and timestamp.isoformat(),
+                'fee': "%.8f" % fee,
+            } for txid, amount, epoch, timestamp, fee in rows
+        ],
+        'next_cursor': next_cursor and "%s-%s" % next_cursor,
+    })
+
+def state_tree(request):
+    """
+    Nodes of the ledger state tree, with their children's hashes, for
+    finding which buckets differ from ours. Prefixes are passed comma
+    separated, the root is the empty prefix.
+    """
+    prefixes = request.GET.get('prefixes', '').split(",")
+    if len(prefixes) > MAX_STATE_PREFIXES:
+        return HttpResponseBadRequest(
+            "Too many prefixes, limit is %s" % MAX_STATE_PREFIXES
+        )
+    tree = LedgerBucket.tree()
+    if any(prefix not in tree for prefix in prefixes):
+        return HttpResponseBadRequest("Invalid prefix")
+
+    try:
+        epoch = EpochSummary.objects.latest().epoch
+    except EpochSummary.DoesNotExist:
+        epoch = None
+    return wire.response(request, {
+        'epoch': epoch,
+        'nodes': {prefix: statetree.describe(tree, prefix) for prefix in prefixes},
+    })
+
 def network_summary(request):
-    peers = Peer.objects.order_by('-reputation')
-    total_issued = LedgerEntry.total_issued()
-    epoch = get_epoch_number()
-    return render(request, "staeon_summary.html", locals())
+    context = dict(EpochSummary.network_summary(), epoch=get_epoch_number())
+    return render(request, "staeon_summary.html", context)
@@ -0,0 +1,123 @@
+"""
+Encoding of node to node payloads. Peers send objects as the whole request
+body, either JSON or (when the msgpack package is installed) msgpack,
+optionally deflate compressed, instead of a JSON string inside a form field.
+Responses to ledger sync requests are encoded however the client's Accept
+and Accept-Encoding headers ask. Plain form posts and JSON responses keep
+working for nodes that don't do any of this.
+"""
+import json
+import zlib
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+from . import peerstats
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+
+def _default(obj):
+    # datetimes and such, the same way JsonResponse would do them
+    return DjangoJSONEncoder().default(obj)
+
+def formats():
+    """
+    Content types this node can decode, most compact first.
+    """
+    return [MSGPACK, JSON] if msgpack else [JSON]
+
+def encode(obj, content_type=JSON, compress=False):
+    """
+    Returns the body and the headers to send it with.
+    """
+    if content_type == MSGPACK:
+        body = msgpack.packb(obj, use_bin_type=True, default=_default)
+    else:
+        body = json.dumps(obj, cls=DjangoJSONEncoder).encode('utf-8')
+    headers = {'Content-Type': content_type}
+    if compress and len(body) >= settings.WIRE_COMPRESS_MIN:
+        body = zlib.compress(body)
+        headers['Content-Encoding'] = 'deflate'
+    return body, headers
+
+def decode(body, content_type=JSON, content_encoding=''):
+    """
+    Raises ValueError for anything that doesn't decode, or that inflates to
+    more than WIRE_MAX_DECODED_SIZE bytes.
+    """
+    try:
+        if 'deflate' in content_encoding:
+            limit = settings.WIRE_MAX_DECODED_SIZE
+            inflater = zlib.decompressobj()
+            # only ever inflates up to the limit, so a small body can't
+            # expand into gigabytes in memory
+            body = inflater.decompress(body, limit or 0)
+            if inflater.unconsumed_tail:
+                raise ValueError("Body inflates to more than %s bytes" % limit)
+        if content_type == MSGPACK:
+            if not msgpack:
+                raise ValueError("msgpack is not installed")
+            return msgpack.unpackb(body, raw=False)
+        return json.loads(body.decode('utf-8'))
+    except ValueError:
+        raise
+    except Exception as exc: # zlib.error and msgpack's own exceptions
+        raise ValueError(str(exc))
+
+def is_encoded(request):
+    return request.content_type in (JSON, MSGPACK)
+
+def read_payload(request, field):
+    """
+    The object a peer posted: the encoded request body, or for form posts
+    the JSON in the named field.
+    """
+    if is_encoded(request):
+        return decode(
+            request.body, request.content_type,
+            request.META.get('HTTP_CONTENT_ENCODING', '')
+        )
+    return json.loads(request.POST[field])
+
+def response(request, obj, status=200):
+    """
+    Encode obj the way the client asked for, JSON unless it accepts msgpack.
+    """
+    content_type = JSON
+    if msgpack and MSGPACK in request.META.get('HTTP_ACCEPT', ''):
+        content_type = MSGPACK
+    compress = 'deflate' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+    body, headers = encode(obj, content_type, compress)
+    resp = HttpResponse(body, content_type=content_type, status=status)
+    if 'Content-Encoding' in headers:
+        resp['Content-Encoding'] = headers['Content-Encoding']
+    resp['Vary'] = 'Accept, Accept-Encoding'
+    return resp
+
+def post(url, obj, timeout):
+    """
+    POST obj as the request body, in WIRE_FORMAT.
+    """
+    content_type = MSGPACK if settings.WIRE_FORMAT == 'msgpack' and msgpack else JSON
+    body, headers = encode(obj, content_type, settings.WIRE_COMPRESS)
+    return peerstats.request('post', url, data=body, headers=headers, timeout=timeout)
+
+def get(url, params=None, timeout=None):
+    """
+    GET from a peer, asking for the most compact format we can read, and
+    return the decoded object. requests undoes the deflate by itself.
+    """
+    resp = peerstats.request('get', url, params=params, timeout=timeout, headers={
+        'Accept': ", ".join(formats()),
+        'Accept-Encoding': 'deflate, gzip',
+    })
+    resp.raise_for_status()
+    content_type = resp.headers.get('Content-Type', JSON).split(";")[0].strip()
+    return decode(resp.content, content_type)
@@ -47,6 +47,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'main.admission.AdmissionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -129,4 +130,167 @@ USE_TZ = False
 STATIC_URL = '/static/'
 
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # shared by every worker. Deployments should point it at memcached or
+    # redis with SHARED_CACHE in local_settings, the DatabaseCache (it's table
+    # is made by wallet's migrations) is only the fallback when there is none.
+    'shared': getattr(local_settings, 'SHARED_CACHE', None) or {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'staeon_cache',
+    },
+}
+
+# Wallet login throttling: at most LOGIN_TRIES failures per username in any
+# LOGIN_TRY_WINDOW seconds (in LOGIN_THROTTLE_BUCKETS steps), counted in
+# LOGIN_THROTTLE_CACHE. It has to be shared by all workers.
 LOGIN_TRIES = 5
+LOGIN_TRY_WINDOW = 15 * 60
+LOGIN_THROTTLE_BUCKETS = 15
+LOGIN_THROTTLE_CACHE = 'shared'
+
+# Password hashing for logins runs in a pool of LOGIN_HASH_WORKERS threads,
+# with at most LOGIN_HASH_QUEUE logins in flight per process. A login waits
+# at most LOGIN_HASH_WAIT seconds for it's hash before it's turned away.
+LOGIN_HASH_WORKERS = 2
+LOGIN_HASH_QUEUE = 8
+LOGIN_HASH_WAIT = 5
+
+# Optional persistent gossip streams between assigned peers (see main.streams).
+# Messages that can't go over a stream fall back to the HTTP endpoints.
+GOSSIP_STREAMS = False
+GOSSIP_STREAM_PORT = 8334
+GOSSIP_STREAM_TLS = True
+GOSSIP_STREAM_CERT = None  # certificate and key for the gossipserver command
+GOSSIP_STREAM_KEY = None
+GOSSIP_STREAM_TIMEOUT = 5  # seconds to connect or write
+GOSSIP_STREAM_RETRY = 30  # seconds to use HTTP after a stream fails
+GOSSIP_STREAM_QUEUE = 10000  # messages waiting per peer before falling back
+
+# Threaded ingest server for node to node endpoints (manage.py ingestserver),
+# meant to sit behind the same TLS terminator as the WSGI app.
+INGEST_WORKERS = 16  # threads running views, the rest only read requests
+INGEST_BACKLOG = 1024
+INGEST_IDLE_TIMEOUT = 60  # seconds before an idle connection is closed
+INGEST_MAX_CONNECTIONS = 512  # open at once, more are answered 503
+
+# Outbound rejections are collected this many seconds, then sent as one
+# signed batch per peer.
+REJECTION_BATCH_SECONDS = 2
+
+# /staeon/peers/ page size, clients can ask for up to PEER_PAGE_MAX.
+PEER_PAGE_SIZE = 100
+PEER_PAGE_MAX = 1000
+PEER_SYNC_TIMEOUT = 10  # seconds per page request to a seed node
+
+# Peer ranking and the network summary are kept in PEER_CACHE, which every
+# worker has to share, and dropped when peers change. PEER_CACHE_SECONDS
+# bounds how stale they get if a change is missed (e.g. a bulk update).
+PEER_CACHE = 'shared'
+PEER_CACHE_SECONDS = 60
+
+# Keep unapplied transactions in an in-memory pool (main.mempool) for
+# validation, writing them to the database in the background. Only turn on
+# when one process does all transaction ingestion.
+USE_MEMPOOL = False
+# close_epoch waits up to this many seconds for the ingest process to write
+# what it's pool has queued, which it reports through this cache.
+MEMPOOL_WRITE_WAIT = 30
+MEMPOOL_WRITTEN_CACHE = 'shared'
+
+# Seconds between runs of the foldledger command, which stages transactions
+# older than the propagation window so close_epoch only has to commit them.
+LEDGER_FOLD_SECONDS = 5
+
+# Peers that the (reputation weighted) majority votes to penalize for an
+# epoch keep this fraction of their reputation.
+PENALTY_REPUTATION_FACTOR = 0.9
+
+# How outbound gossip is encoded. None keeps staeon's form posts, 'json' or
+# 'msgpack' (if installed) sends the object as the request body. Peers accept
+# all three either way.
+WIRE_FORMAT = None
+WIRE_COMPRESS = True  # deflate bodies of at least WIRE_COMPRESS_MIN bytes
+WIRE_COMPRESS_MIN = 512
+# Largest a deflated body may inflate to, like DATA_UPLOAD_MAX_MEMORY_SIZE
+# for the compressed body itself. None for no limit.
+WIRE_MAX_DECODED_SIZE = 2621440  # i.e. 2.5 MB
+
+# The epochscheduler command runs consensus step 1 (closing the previous
+# epoch) this many seconds after each epoch starts, and step 2 this many.
+# None means PROPAGATION_WINDOW_SECONDS.
+EPOCH_STEP1_DELAY = None
+EPOCH_STEP2_DELAY = 60
+
+# Concurrent requests per process for each request class (see
+# main.admission), over that they get a 503 with Retry-After. Consensus
+# requests are never limited, keep these below the number of worker threads
+# so some are always left for them. Only turn this on with threaded workers,
+# the counts are per process.
+ADMISSION_CONTROL = False
+REQUEST_CLASS_LIMITS = {'ingest': 8, 'read': 8}
+
+# Times a gossip POST turned away with a 503 is sent again, each after the
+# Retry-After the peer asked for.
+GOSSIP_RETRIES = 3
+# Gossip POSTs are made on this many threads per process, with up to
+# GOSSIP_RELAY_QUEUE waiting (more are dropped). 0 posts in the calling thread.
+# A process exiting waits up to GOSSIP_RELAY_EXIT_WAIT seconds for the queue.
+GOSSIP_RELAY_THREADS = 4
+GOSSIP_RELAY_QUEUE = 10000
+GOSSIP_RELAY_EXIT_WAIT = 30
+
+# For this many seconds after each epoch starts ingestion is limited to
+# CONSENSUS_WINDOW_INGEST_LIMIT, leaving room for step 1 and step 2.
+CONSENSUS_WINDOW_SECONDS = 90
+CONSENSUS_WINDOW_INGEST_LIMIT = 2
+
+# With more than 1, close_epoch commits the ledger in this many processes,
+# each taking a range of state tree buckets in it's own transaction. Needs a
+# database that handles concurrent writers (not sqlite).
+LEDGER_APPLY_PROCESSES = 0
+
+# Keep the ledger in memory as sorted columns (main.ledgerstore) for balance
+# lookups and the epoch seed. LedgerEntry is still written, and read when
+# applying epochs. At epoch close the columns are saved to
+# LEDGER_CHECKPOINT_PATH if set. At most every LEDGER_STORE_REFRESH_SECONDS
+# the ledger version is checked and the columns reloaded if another process
+# wrote the ledger.
+USE_LEDGER_STORE = False
+LEDGER_CHECKPOINT_PATH = None
+LEDGER_STORE_REFRESH_SECONDS = 5
+
+# A peer's circuit opens after this many failed calls in a row, and calls
+# to it fail right away for PEER_BREAKER_SECONDS, doubling every time it
+# fails again up to PEER_BREAKER_MAX_SECONDS (see main.peerstats).
+PEER_BREAKER_FAILURES = 3
+PEER_BREAKER_SECONDS = 30
+PEER_BREAKER_MAX_SECONDS = 30 * 60
+PEER_STATS_FLUSH_SECONDS = 30
+
+# Sampling profiler (main.profiling), off while PROFILE_DIR is None. Only
+# the views and commands named in PROFILE_TARGETS are profiled, commands on
+# every run and views for PROFILE_REQUEST_RATE of the requests. Stacks are
+# sampled every PROFILE_INTERVAL seconds, on Python 3 PROFILE_TRACEMALLOC
+# also saves a tracemalloc snapshot of each profiled call (Python 2.7 has no
+# tracemalloc). Where each profile went is logged to main.profiling.
+PROFILE_DIR = None
+PROFILE_TARGETS = ('accept_tx', 'ledger', 'peers', 'consensus_step1', 'consensus_step2', 'syncall')
+PROFILE_REQUEST_RATE = 0.01
+PROFILE_INTERVAL = 0.005
+PROFILE_TRACEMALLOC = True
+PROFILE_TRACEMALLOC_FRAMES = 10
+
+# The profiler logs where each profile went to the console.
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'main.profiling': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
@@ -18,13 +18,25 @@ from django.contrib import admin
 from django.contrib.auth import logout as dj_logout
 from django import http
 
+from wallet.scrypt_auth_backend import LoginBusy
+
 def logout(request):
     dj_logout(request)
     return http.HttpResponseRedirect("/wallet")
 
+def admin_login(request, **kwargs):
+    # admins log in through the same bounded hashing pool as the wallet
+    try:
+        return admin.site.login(request, **kwargs)
+    except LoginBusy:
+        response = http.HttpResponse("Too many logins in progress, try again shortly.", status=503)
+        response['Retry-After'] = 1
+        return response
+
 admin.site.site_header = 'Staeon-node Administration'
 
 urlpatterns = [
+    url(r'^admin/login/$', admin_login),
     url(r'^admin/', admin.site.urls),
     url(r'^staeon/', include("main.urls")),
     url(r'^wallet/', include("wallet.urls")),
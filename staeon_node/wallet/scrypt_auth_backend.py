@@ -1,7 +1,66 @@
+import threading
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
 import scrypt
+from django.conf import settings
 from django.contrib.auth.hashers import check_password
 from django.contrib.auth.models import User
 
+class LoginBusy(Exception):
+    """
+    Raised when too many logins are already waiting on password hashing.
+    """
+    pass
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+_hash_slots = threading.BoundedSemaphore(settings.LOGIN_HASH_QUEUE)
+
+def _get_hash_pool():
+    global _hash_pool
+    with _hash_pool_lock:
+        if not _hash_pool:
+            _hash_pool = ThreadPool(settings.LOGIN_HASH_WORKERS)
+    return _hash_pool
+
+def _hash_and_release(slots, func, args):
+    try:
+        return func(*args)
+    finally:
+        slots.release()
+
+def run_in_hash_pool(func, *args):
+    """
+    Run a password hashing function in the bounded login pool. At most
+    LOGIN_HASH_WORKERS hashes run at once and at most LOGIN_HASH_QUEUE logins
+    wait for one, beyond that LoginBusy is raised right away so a login storm
+    can't tie up the workers the consensus endpoints need. The request waits
+    at most LOGIN_HASH_WAIT seconds for it's hash, after that it gets
+    LoginBusy too. It's slot is held until the hash is done, not until the
+    request gives up, so abandoned hashes still count against the queue.
+    """
+    slots = _hash_slots
+    if not slots.acquire(False):
+        raise LoginBusy()
+    try:
+        result = _get_hash_pool().apply_async(_hash_and_release, (slots, func, args))
+    except Exception:
+        slots.release()
+        raise
+    try:
+        return result.get(settings.LOGIN_HASH_WAIT)
+    except TimeoutError:
+        raise LoginBusy()
+
+def password_matches(username, password, encoded):
+    if check_password(password, encoded):
+        return True
+
+    # try running password through same scrypt params as front end.
+    encoded_password = scrypt.hash(str(password), str(username), 16384, 8, 1).encode('hex')
+    return check_password(encoded_password, encoded)
+
 class ScryptLoginBackend(object):
     """
     All user passwords are ran through scrypt to protect user's money.
@@ -15,12 +74,7 @@ class ScryptLoginBackend(object):
         except User.DoesNotExist:
             return None
 
-        if check_password(password, user.password):
-            return user
-
-        # try running password through same scrypt params as front end.
-        encoded_password = scrypt.hash(str(password), str(username), 16384, 8, 1).encode('hex')
-        if check_password(encoded_password, user.password):
+        if run_in_hash_pool(password_matches, username, password, user.password):
             return user
         return None
 
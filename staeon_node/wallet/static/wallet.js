@@ -82,32 +82,37 @@ function total_balance_for_tags(tags) {
   return balance;
 }
 
-function fetch_balance(address_tag) {
-  var address = $("#" + address_tag + " .address").text();
-
-  return $.ajax({
-    'url': "http://" + get_random_node() + "/staeon/ledger/?address=" + address
-  }).success(function(response) {
-    var container = $("#" + address_tag);
-    var ele = container.find(".balance");
-    if(ele.length) {
-      ele.text(response);
-    } else {
-      container.append('<span class="balance">' + response + "</span>");
-    }
-    currently_fetching -= 1;
-  });
+function set_balance(address_tag, balance) {
+  var container = $("#" + address_tag);
+  var ele = container.find(".balance");
+  if(ele.length) {
+    ele.text(balance);
+  } else {
+    container.append('<span class="balance">' + balance + "</span>");
+  }
 }
 
 var balances = []
 var currently_fetching = 0;
 function make_balance_fetches(address_tags) {
-  var fetchers = [];
-  $.each(address_tags, function(i, address_tag) {
-    currently_fetching += 1;
-    fetchers.push(fetch_balance(address_tag));
+  // one request for the whole batch of addresses
+  if(address_tags.length == 0) {
+    return [];
+  }
+  var addresses = $.map(address_tags, function(address_tag) {
+    return $("#" + address_tag + " .address").text();
   });
-  return fetchers
+  currently_fetching += address_tags.length;
+
+  return [$.ajax({
+    'url': "http://" + get_random_node() + "/staeon/balances/",
+    'data': {'addresses': addresses.join(",")}
+  }).success(function(response) {
+    $.each(address_tags, function(i, address_tag) {
+      set_balance(address_tag, response.balances[addresses[i]]);
+      currently_fetching -= 1;
+    });
+  })];
 }
 
 function make_sequential_fetchers(start, stop, change) {
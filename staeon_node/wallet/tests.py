@@ -1,6 +1,95 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import time
+import threading
 
-# Create your tests here.
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+
+from . import scrypt_auth_backend
+from .throttle import recent_failures, record_failure, seconds_until_next_try
+
+@override_settings(LOGIN_TRIES=3, LOGIN_TRY_WINDOW=300, LOGIN_THROTTLE_BUCKETS=5)
+class ThrottleTest(TestCase):
+    def setUp(self):
+        caches['shared'].clear()
+
+    def test_failures_count_inside_window(self):
+        self.assertEqual(recent_failures('alice', now=1000), 0)
+        record_failure('alice', now=1000)
+        record_failure('alice', now=1010)
+        self.assertEqual(recent_failures('alice', now=1020), 2)
+        self.assertEqual(recent_failures('bob', now=1020), 0)
+
+    def test_failures_slide_out_of_window(self):
+        record_failure('alice', now=1000) # bucket 16, 960-1020
+        record_failure('alice', now=1100)
+        self.assertEqual(recent_failures('alice', now=1259), 2)
+        self.assertEqual(recent_failures('alice', now=1260), 1)
+        self.assertEqual(recent_failures('alice', now=1400), 0)
+
+    def test_slots_cap_one_bucket(self):
+        for i in range(5):
+            record_failure('alice', now=1000)
+        self.assertEqual(recent_failures('alice', now=1000), 3)
+
+    def test_seconds_until_next_try(self):
+        record_failure('alice', now=1000)
+        record_failure('alice', now=1100)
+        self.assertEqual(seconds_until_next_try('alice', now=1100), 0)
+        record_failure('alice', now=1150)
+        # the failure at 1000 leaves the window at 1260
+        self.assertEqual(seconds_until_next_try('alice', now=1200), 60)
+
+    def test_login_view_blocks(self):
+        for i in range(3):
+            response = self.client.post('/wallet/login', {'username': 'alice', 'password': 'x'})
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response.json()['tries_left'], 2 - i)
+        response = self.client.post('/wallet/login', {'username': 'alice', 'password': 'x'})
+        self.assertIn('login_timeout', response.json())
+
+class LoginBusyTest(TestCase):
+    def setUp(self):
+        self.slots = scrypt_auth_backend._hash_slots
+        scrypt_auth_backend._hash_slots = threading.BoundedSemaphore(1)
+        scrypt_auth_backend._hash_slots.acquire()
+
+    def tearDown(self):
+        scrypt_auth_backend._hash_slots = self.slots
+
+    def test_admin_login_busy(self):
+        from django.contrib.auth.models import User
+        User.objects.create_user('admin', password='x', is_staff=True)
+        response = self.client.post('/admin/login/', {'username': 'admin', 'password': 'x'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+
+class HashPoolTest(TestCase):
+    def setUp(self):
+        self.slots = scrypt_auth_backend._hash_slots
+        scrypt_auth_backend._hash_slots = threading.BoundedSemaphore(1)
+
+    def tearDown(self):
+        scrypt_auth_backend._hash_slots = self.slots
+
+    def test_result_frees_slot(self):
+        self.assertEqual(scrypt_auth_backend.run_in_hash_pool(lambda a, b: a + b, 1, 2), 3)
+        self.assertTrue(scrypt_auth_backend._hash_slots.acquire(False))
+
+    @override_settings(LOGIN_HASH_WAIT=0.05)
+    def test_slow_hash_gives_up_but_keeps_slot(self):
+        done = threading.Event()
+        with self.assertRaises(scrypt_auth_backend.LoginBusy):
+            scrypt_auth_backend.run_in_hash_pool(done.wait, 5)
+        # the abandoned hash still holds the only slot
+        with self.assertRaises(scrypt_auth_backend.LoginBusy):
+            scrypt_auth_backend.run_in_hash_pool(lambda: True)
+        done.set()
+        for i in range(100):
+            if scrypt_auth_backend._hash_slots.acquire(False):
+                break
+            time.sleep(0.01)
+        else:
+            self.fail("slot was never released")
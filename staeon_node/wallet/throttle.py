@@ -0,0 +1,87 @@
+"""
+Sliding window throttling of failed wallet logins. Failures are counted in
+LOGIN_THROTTLE_CACHE instead of the database table of attempts, so checking
+the limit is one cache read. That cache has to be shared by every worker,
+otherwise each process would allow LOGIN_TRIES on it's own. It's the
+'shared' cache, which is memcached or redis when SHARED_CACHE is set in
+local_settings and a DatabaseCache only as the fallback.
+
+The window is split into LOGIN_THROTTLE_BUCKETS buckets of time. Each failure
+claims one of LOGIN_TRIES slots in the current bucket with cache.add, which
+is atomic on every shared backend, so two workers recording failures at the
+same time can't both take the same slot the way a read then set could.
+"""
+import time
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+
+def _cache():
+    return caches[settings.LOGIN_THROTTLE_CACHE]
+
+def _bucket_seconds():
+    return float(settings.LOGIN_TRY_WINDOW) / settings.LOGIN_THROTTLE_BUCKETS
+
+def _buckets(now):
+    """
+    Indexes of the buckets inside the window, oldest first.
+    """
+    current = int(now // _bucket_seconds())
+    return range(current - settings.LOGIN_THROTTLE_BUCKETS + 1, current + 1)
+
+def _slot_key(username, bucket, slot):
+    # usernames can contain characters memcached does not allow in keys
+    return "login-failures-%s-%s-%s" % (
+        hashlib.sha256(username.encode('utf-8')).hexdigest(), bucket, slot
+    )
+
+def failure_counts(username, now=None):
+    """
+    [(bucket, failures)] for every bucket in the window, oldest first.
+    """
+    if not now: now = time.time()
+    keys = {
+        _slot_key(username, bucket, slot): bucket
+        for bucket in _buckets(now) for slot in range(settings.LOGIN_TRIES)
+    }
+    counts = dict.fromkeys(_buckets(now), 0)
+    for key in _cache().get_many(list(keys.keys())):
+        counts[keys[key]] += 1
+    return sorted(counts.items())
+
+def recent_failures(username, now=None):
+    """
+    How many failed logins for this username are inside the window.
+    """
+    return sum(count for bucket, count in failure_counts(username, now))
+
+def record_failure(username, now=None):
+    """
+    Count a failed login. Returns the failures now inside the window.
+    """
+    if not now: now = time.time()
+    bucket = _buckets(now)[-1]
+    timeout = int(settings.LOGIN_TRY_WINDOW + _bucket_seconds()) + 1
+    for slot in range(settings.LOGIN_TRIES):
+        if _cache().add(_slot_key(username, bucket, slot), 1, timeout):
+            break
+    return recent_failures(username, now)
+
+def seconds_until_next_try(username, now=None):
+    """
+    When the window is full, the next try opens up when enough of the oldest
+    failures slide out of it.
+    """
+    if not now: now = time.time()
+    counts = failure_counts(username, now)
+    remaining = sum(count for bucket, count in counts)
+    for bucket, count in counts:
+        if remaining < settings.LOGIN_TRIES:
+            break
+        remaining -= count
+        # once it's failures are out of the window there are few enough left
+        opens = bucket * _bucket_seconds() + settings.LOGIN_TRY_WINDOW
+        if remaining < settings.LOGIN_TRIES:
+            return max(opens - now, 0)
+    return 0
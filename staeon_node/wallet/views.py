@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-import datetime
 
 from django.shortcuts import render
 from django import http
@@ -9,7 +8,9 @@ from django.views.decorators.csrf import ensure_csrf_cookie, csrf_exempt
 from django.contrib.auth import authenticate, login as init_login
 from django.conf import settings
 
-from.models import WalletSeed, FailedLogin
+from .models import WalletSeed
+from .throttle import recent_failures, record_failure, seconds_until_next_try
+from .scrypt_auth_backend import LoginBusy
 
 def serv_wallet(request):
     return render(request, "wallet.html")
@@ -53,27 +54,38 @@ def register_new_wallet_user(request):
         user=user, encrypted_mnemonic=encrypted_mnemonic
     )
 
-    user = authenticate(username=username, password=password)
+    try:
+        user = authenticate(username=username, password=password)
+    except LoginBusy:
+        return login_busy()
     init_login(request, user)
 
     return http.JsonResponse({
         'wallet_settings': wal.get_settings(),
     })
 
+def login_busy():
+    response = http.JsonResponse({
+        "login_busy": "Too many logins in progress, try again shortly."
+    }, status=503)
+    response['Retry-After'] = 1
+    return response
+
 def login(request):
     """
-    Authenticate the user. On failed attempts, record the event, and limit
-    5 failed attempts every 15 minutes.
+    Authenticate the user. On failed attempts, record the event in the
+    throttle cache, and limit 5 failed attempts every 15 minutes.
     """
     username = request.POST['username']
     password = request.POST['password']
 
-    fithteen_minutes_ago = datetime.datetime.now() - datetime.timedelta(minutes=15)
-    tries = FailedLogin.objects.filter(username=username, time__gt=fithteen_minutes_ago)
-    try_count = tries.count()
+    failures = recent_failures(username)
 
-    if try_count < settings.LOGIN_TRIES:
-        user = authenticate(username=username, password=password)
+    if failures < settings.LOGIN_TRIES:
+        try:
+            user = authenticate(username=username, password=password)
+        except LoginBusy:
+            return login_busy()
 
         if user and user.is_authenticated():
             init_login(request, user)
@@ -84,12 +96,11 @@ def login(request):
                 'wallet_settings': wal.get_settings(),
             })
         else:
-            FailedLogin.objects.create(username=username)
-            tries_left = settings.LOGIN_TRIES - try_count
+            failures = record_failure(username)
+            tries_left = settings.LOGIN_TRIES - failures
             return http.JsonResponse({"tries_left": tries_left}, status=401)
 
-    time_of_next_try = tries.latest().time + datetime.timedelta(minutes=15)
-    minutes_to_wait = (time_of_next_try - timezone.now()).total_seconds() / 60.0
+    minutes_to_wait = seconds_until_next_try(username) / 60.0
     return http.JsonResponse({
         "login_timeout": "Try again in %.1f minutes." % minutes_to_wait
     }, status=401)